@@ -0,0 +1,87 @@
+'''
+Measures how fast the search goes through a large file, in both directions.
+Run from the top of the repository:
+
+    PYTHONPATH=. python benchmarks/search_benchmark.py --size 4G --regex
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+from hexvi.app_state import SearchState
+from hexvi.file_buffer import FileBuffer
+from hexvi.searcher import Searcher
+from hexvi.util import parse_size
+
+NEEDLE = b'\x89PNG\r\n\x1A\n'
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measures how fast the search goes through a large file.')
+    parser.add_argument(
+        '--size', type=parse_size, default='4G',
+        help='size of the test file (default: 4G)')
+    parser.add_argument(
+        '--dir', default=None,
+        help='where to create the test file (default: the temporary directory)')
+    parser.add_argument(
+        '--regex', action='store_true',
+        help='also measure the regex engine on the same pattern')
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count() or 1,
+        help='threads for the regex engine (default: one per CPU)')
+    return parser.parse_args()
+
+def create_file(path, size):
+    ''' Creates a file that has the needle only at its start and its end. '''
+    with open(path, 'wb') as handle:
+        handle.write(NEEDLE)
+        block = bytes(range(256)) * 4096
+        while handle.tell() < size - len(NEEDLE):
+            handle.write(block[:size - len(NEEDLE) - handle.tell()])
+        handle.write(NEEDLE)
+
+def measure(searcher, file_buffer, offset, direction, expected, workers):
+    start = time.perf_counter()
+    match = searcher.find(
+        file_buffer.snapshot, offset, direction, workers=workers)
+    elapsed = time.perf_counter() - start
+    assert match == expected, match
+    return file_buffer.size / elapsed / 1e9
+
+def main():
+    args = parse_args()
+    handle, path = tempfile.mkstemp(dir=args.dir)
+    os.close(handle)
+    try:
+        print('Creating a %.1f GiB file...' % (args.size / 2**30))
+        create_file(path, args.size)
+        file_buffer = FileBuffer(path)
+
+        searchers = [('literal', Searcher(NEEDLE), 1)]
+        if args.regex:
+            searcher = Searcher(NEEDLE)
+            searcher.literal = None
+            searchers.append(('regex', searcher, 1))
+            if args.workers > 1:
+                searchers.append(
+                    ('regex x%d' % args.workers, searcher, args.workers))
+
+        for name, searcher, workers in searchers:
+            forward = (
+                searcher, file_buffer, 1, SearchState.DIR_FORWARD,
+                (args.size - len(NEEDLE), args.size), workers)
+            backward = (
+                searcher, file_buffer, args.size - 1, SearchState.DIR_BACKWARD,
+                (0, len(NEEDLE)), workers)
+            # read the file once so that both directions see a warm cache
+            measure(*forward)
+            print('%-10s forward:  %6.2f GB/s' % (name, measure(*forward)))
+            print('%-10s backward: %6.2f GB/s' % (name, measure(*backward)))
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ The CLI facade. Argument parsing and core lifetime management goes here.
 
 import argparse
 import os
+import sys
 import hexvi.events as events
 import hexvi.util as util
 from hexvi.app_state import AppState
@@ -18,7 +19,14 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description='hexvi - a hex editor inspired by Vim.')
     parser.add_argument(
-        metavar='FILE', nargs='*', dest='paths', help='files to edit')
+        metavar='FILE', nargs='*', dest='paths',
+        help='files to edit, - for the standard input')
+    parser.add_argument(
+        '--offset', metavar='NUM', type=util.parse_size, default=0,
+        help='edit the files starting at this offset')
+    parser.add_argument(
+        '--length', metavar='NUM', type=util.parse_size, default=None,
+        help='edit at most this many bytes of the files')
     return parser.parse_args()
 
 def main():
@@ -48,7 +56,7 @@ def main():
     paths = util.filter_unique_paths(args.paths)
     for path in paths:
         try:
-            tab_manager.open_tab(path)
+            tab_manager.open_tab(path, args.offset, args.length)
         except Exception as ex:
             events.notify(events.PrintMessage(str(ex), style='msg-error'))
     if not tab_manager.tabs:
@@ -58,7 +66,12 @@ def main():
     # print collected messages, if any
     events.unregister_handler(events.PrintMessage, print_message_handler)
     if anything_printed:
-        input('Press Enter to continue...')
+        print('Press Enter to continue...')
+        if sys.stdin.isatty():
+            sys.stdin.readline()
+        else:
+            with open('/dev/tty') as terminal:
+                terminal.readline()
 
     user_interface.run()
 
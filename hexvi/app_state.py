@@ -13,6 +13,12 @@ class SearchState(object):
     def __init__(self):
         self.direction = self.DIR_FORWARD
         self.text = None
+        self.searcher = None
+        self.job = None
+        self.index = None
+        # the pattern being typed with incsearch and where typing it started
+        self.preview = None
+        self.origin = None
 
 class AppState(object):
     '''
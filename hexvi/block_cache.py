@@ -0,0 +1,112 @@
+''' Exports BlockCache and the cache shared by all file sources. '''
+
+import threading
+from collections import OrderedDict
+
+class BlockCache(object):
+    '''
+    A cache of aligned, fixed-size file blocks with LRU eviction.
+
+    Blocks are keyed by the owner (usually a FileSource) and the block index,
+    so one cache can be shared between all the files without them stepping on
+    each other. The capacity is expressed in bytes; setting it to 0 disables
+    caching altogether.
+
+    The cache can be used from multiple threads. Loaders run without holding
+    the lock, so they need to be thread-safe themselves; two threads missing
+    the same block at the same time might both load it.
+    '''
+
+    def __init__(self, capacity, block_size=64*1024):
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._capacity = capacity
+        self._used = 0
+        self._generation = 0
+        self.block_size = block_size
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, owner, offset, size, loader):
+        '''
+        Retrieves content chunk of given size at a given offset, using
+        loader(offset, size) to read blocks that aren't cached yet.
+        '''
+        if not self._capacity:
+            return loader(offset, size)
+        if not size:
+            return b''
+        first_index = offset // self.block_size
+        last_index = (offset + size - 1) // self.block_size
+        chunks = []
+        for index in range(first_index, last_index + 1):
+            block = self._get_block(owner, index, loader)
+            block_offset = index * self.block_size
+            start = max(offset - block_offset, 0)
+            end = min(offset + size - block_offset, len(block))
+            chunks.append(memoryview(block)[start:end])
+            if len(block) < self.block_size:
+                break
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def _get_block(self, owner, index, loader):
+        key = (owner, index)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self.hits += 1
+                self._blocks.move_to_end(key)
+                return block
+            self.misses += 1
+            generation = self._generation
+        block = bytes(loader(index * self.block_size, self.block_size))
+        with self._lock:
+            if generation != self._generation:
+                # invalidated while loading, the block might be outdated
+                return block
+            old_block = self._blocks.pop(key, None)
+            if old_block is not None:
+                self._used -= len(old_block)
+            self._blocks[key] = block
+            self._used += len(block)
+            self._evict()
+        return block
+
+    def _evict(self):
+        while self._used > self._capacity and self._blocks:
+            _, block = self._blocks.popitem(last=False)
+            self._used -= len(block)
+
+    def invalidate(self, owner):
+        ''' Drops all the blocks of a given owner. '''
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._blocks if key[0] is owner]:
+                self._used -= len(self._blocks.pop(key))
+
+    def clear(self):
+        ''' Drops all the blocks and resets the counters. '''
+        with self._lock:
+            self._generation += 1
+            self._blocks.clear()
+            self._used = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get_capacity(self):
+        ''' Returns the memory budget, in bytes. '''
+        return self._capacity
+
+    def set_capacity(self, value):
+        ''' Sets the memory budget, in bytes, evicting blocks if necessary. '''
+        with self._lock:
+            self._capacity = max(0, value)
+            self._evict()
+
+    capacity = property(get_capacity, set_capacity)
+    used = property(lambda self: self._used)
+    block_count = property(lambda self: len(self._blocks))
+
+SHARED_CACHE = BlockCache(16*1024*1024)
@@ -51,14 +51,15 @@ class CommandProcessor(object):
         current_tab = self._tab_manager.current_tab
         if self._app_state.mode == AppState.MODE_REPLACE:
             current_tab.file_buffer.replace(
-                current_tab.current_offset, bytes([byte]))
+                current_tab.current_offset, bytes([byte]), coalesce=True)
             current_tab.current_offset += 1
         elif self._app_state.mode == AppState.MODE_INSERT:
             current_tab.file_buffer.insert(
-                current_tab.current_offset, bytes([byte]))
+                current_tab.current_offset, bytes([byte]), coalesce=True)
             current_tab.current_offset += 1
         else:
             raise NotImplementedError()
+        self._tab_manager.buffer_changed(current_tab.file_buffer)
 
     @handle_errors
     def exec_raw(self, command_text):
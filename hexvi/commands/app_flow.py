@@ -1,6 +1,7 @@
 ''' Commands related to application workflow '''
 
 import hexvi.events as events
+import hexvi.jobs as jobs
 from hexvi.command_registry import BaseCommand
 
 class QuitCommand(BaseCommand):
@@ -23,3 +24,10 @@ class EchoCommand(BaseCommand):
     def run(self, args):
         message = ' '.join(args)
         events.notify(events.PrintMessage(message, style='msg-info'))
+
+class CancelJobsCommand(BaseCommand):
+    ''' Stops the background jobs such as saving, but not the daemon ones. '''
+    names = ['cancel']
+    def run(self, _args):
+        if not jobs.cancel_all():
+            raise RuntimeError('Nothing to cancel')
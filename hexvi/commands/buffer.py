@@ -0,0 +1,103 @@
+''' Commands related to file buffer internals '''
+
+import hexvi.events as events
+from hexvi.block_cache import SHARED_CACHE
+from hexvi.command_registry import BaseCommand
+from hexvi.command_registry import BaseTabCommand
+
+class CacheStatsCommand(BaseCommand):
+    ''' Prints block cache usage and hit/miss counters. '''
+    names = ['cachestats']
+
+    def run(self, args):
+        if args and args[0] == 'reset':
+            SHARED_CACHE.hits = 0
+            SHARED_CACHE.misses = 0
+            return
+        events.notify(events.PrintMessage(
+            'cache: %d hits, %d misses, %d blocks, %d/%d bytes' % (
+                SHARED_CACHE.hits,
+                SHARED_CACHE.misses,
+                SHARED_CACHE.block_count,
+                SHARED_CACHE.used,
+                SHARED_CACHE.capacity),
+            style='msg-info'))
+
+class CompactCommand(BaseTabCommand):
+    ''' Merges adjacent windows of the current buffer. '''
+    names = ['compact']
+
+    def run(self, _args):
+        old_window_count, new_window_count = \
+            self.current_tab.file_buffer.compact()
+        events.notify(events.PrintMessage(
+            'windows: %d before, %d after' % (
+                old_window_count, new_window_count),
+            style='msg-info'))
+
+class FollowCommand(BaseTabCommand):
+    '''
+    Grows the current buffer as its file grows. With "pin", also keeps the
+    cursor at the end.
+    '''
+    names = ['follow']
+
+    def run(self, args):
+        if args and args[0] != 'pin':
+            raise RuntimeError('Invalid argument: %s' % args[0])
+        self._tab_manager.follow(self.current_tab.file_buffer, pin=bool(args))
+
+class NoFollowCommand(BaseTabCommand):
+    ''' Stops growing the current buffer as its file grows. '''
+    names = ['nofollow']
+
+    def run(self, _args):
+        if not self._tab_manager.unfollow(self.current_tab.file_buffer):
+            raise RuntimeError('Not following')
+
+class CheckTimeCommand(BaseTabCommand):
+    '''
+    Switches the current buffer to the version of its file that someone else
+    wrote, keeping the edits, and reports where the two overlap.
+    '''
+    names = ['checkt', 'checktime']
+
+    def run(self, _args):
+        file_buffer = self.current_tab.file_buffer
+        if not file_buffer.check_file():
+            events.notify(events.PrintMessage(
+                'File unchanged', style='msg-info'))
+            return
+        conflicts = file_buffer.rebase()
+        self._tab_manager.buffer_changed(file_buffer)
+        if not conflicts:
+            events.notify(events.PrintMessage(
+                'File changed, edits kept', style='msg-info'))
+            return
+        events.notify(events.PrintMessage(
+            'File changed under edits at %s' % ', '.join(
+                '0x%X-0x%X' % (start, end - 1) for start, end in conflicts),
+            style='msg-error'))
+
+class ReloadCommand(BaseTabCommand):
+    ''' Reads the file of the current buffer again, discarding the edits. '''
+    names = ['e!', 'edit!']
+
+    def run(self, _args):
+        file_buffer = self.current_tab.file_buffer
+        file_buffer.reload()
+        self._tab_manager.buffer_changed(file_buffer)
+
+class ChangesCommand(BaseTabCommand):
+    ''' Lists the ranges of the current buffer changed since it was saved. '''
+    names = ['changes']
+
+    def run(self, _args):
+        changes = self.current_tab.file_buffer.get_changes()
+        if not changes:
+            events.notify(events.PrintMessage('No changes', style='msg-info'))
+            return
+        events.notify(events.PrintMessage(
+            '%d changes: %s' % (len(changes), ', '.join(
+                '0x%X-0x%X' % (start, end - 1) for start, end in changes)),
+            style='msg-info'))
@@ -19,3 +19,4 @@ class DeleteCommand(BaseTabCommand):
             size = old_offset - new_offset
         self.current_tab.file_buffer.delete(offset, size)
         self.current_tab.current_offset = offset
+        self._tab_manager.buffer_changed(self.current_tab.file_buffer)
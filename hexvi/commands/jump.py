@@ -84,3 +84,25 @@ class JumpToEndOfFileCommand(BaseTabCommand):
     names = ['jump_to_end_of_file']
     def run(self, _args):
         self.current_tab.current_offset = self.current_tab.size
+
+class _BaseJumpToChangeCommand(BaseTabCommand):
+    forward = True
+    def run(self, args):
+        file_buffer = self.current_tab.file_buffer
+        offset = self.current_tab.current_offset
+        for _ in range(1 if not args else int(args[0])):
+            change = file_buffer.find_change(offset, self.forward)
+            if change is None:
+                break
+            offset = change[0]
+        if offset == self.current_tab.current_offset:
+            raise RuntimeError('No more changes')
+        self.current_tab.current_offset = offset
+
+class JumpToNextChangeCommand(_BaseJumpToChangeCommand):
+    names = ['jump_to_next_change']
+    forward = True
+
+class JumpToPrevChangeCommand(_BaseJumpToChangeCommand):
+    names = ['jump_to_prev_change']
+    forward = False
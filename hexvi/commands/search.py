@@ -1,48 +1,122 @@
 ''' Commands related to search '''
 
-import regex
-import hexvi.util
+import os
+import hexvi.events as events
+import hexvi.jobs as jobs
 from hexvi.command_registry import BaseTabCommand
+from hexvi.app_state import AppState
 from hexvi.app_state import SearchState
+from hexvi.match_index import MatchIndex
+from hexvi.searcher import Searcher
 
 class _BaseSearchCommand(BaseTabCommand):
-    def perform_user_search(self, direction, text):
+    def perform_user_search(self, direction, text, repeat=1):
         ''' High-level facade for text search in given direction '''
+        search_state = self._app_state.search_state
         if not text:
-            text = self._app_state.search_state.text
-            direction = self._app_state.search_state.direction ^ direction ^ 1
+            direction = search_state.direction ^ direction ^ 1
         else:
-            self._app_state.search_state.direction = direction
-            self._app_state.search_state.text = text
-        return self._perform_stateless_search(direction, text)
-
-    def _perform_stateless_search(self, direction, pattern):
-        ''' Implementation of incremental text search '''
-        if not pattern:
+            if text != search_state.text:
+                search_state.searcher = Searcher(text)
+                events.notify(events.SearchChange())
+            search_state.direction = direction
+            search_state.text = text
+        if not search_state.searcher:
             raise RuntimeError('No text to search for')
-        max_match_size = self._app_state.settings.max_match_size
-        if direction == SearchState.DIR_BACKWARD:
-            start_pos = self.current_tab.current_offset
-            pattern = '(?r)' + pattern
-        else:
-            start_pos = self.current_tab.current_offset + 1
-        if not hexvi.util.scan_file(
-                self.current_tab.file_buffer,
-                direction,
-                start_pos,
-                max_match_size * 2,
-                max_match_size,
-                lambda buffer, start_pos, end_pos, direction: \
-                    self._search_callback(pattern, buffer, start_pos)):
-            # TODO: if an option is enabled, show info and wrap around
-            raise RuntimeError('Not found')
-
-    def _search_callback(self, pattern, buffer, start_pos):
-        match = regex.search(pattern.encode('utf-8'), buffer)
-        if match:
-            self.current_tab.current_offset = start_pos + match.span()[0]
-            return True
-        return False
+        index = self._get_index()
+        if index is not None and index.update():
+            offset, complete = index.find(
+                self.current_tab.current_offset,
+                direction == SearchState.DIR_FORWARD,
+                repeat)
+            if offset is not None:
+                self.current_tab.current_offset = offset
+            if not complete:
+                raise RuntimeError('Not found')
+            return
+        self._start_search(search_state.searcher, direction, repeat)
+
+    def _get_index(self, create=False):
+        '''
+        Returns the match index of the last pattern in the current buffer,
+        starting to build it if there's none yet. Returns None if indexing is
+        disabled, unless asked to create the index anyway.
+        '''
+        search_state = self._app_state.search_state
+        file_buffer = self.current_tab.file_buffer
+        index = search_state.index
+        if index is not None \
+                and index.searcher is search_state.searcher \
+                and index.file_buffer is file_buffer:
+            return index
+        if index is not None and index.job:
+            index.job.cancel()
+        # an index of another pattern or buffer is of no use any more
+        search_state.index = None
+        if not create and not self._app_state.settings.search_index:
+            return None
+        search_state.index = MatchIndex(search_state.searcher, file_buffer)
+        search_state.index.build()
+        return search_state.index
+
+    def _start_search(self, searcher, direction, repeat, quiet=False):
+        '''
+        Searches in the background from the current offset, replacing the
+        search that's already running, if any. Moves the cursor to the
+        repeat-th match, or to the last one found if there are fewer.
+        '''
+        self._cancel_search()
+        search_state = self._app_state.search_state
+        tab_state = self.current_tab
+        snapshot = tab_state.file_buffer.snapshot
+        start_offset = tab_state.current_offset
+        workers = self._app_state.settings.search_workers or os.cpu_count() or 1
+
+        def search(progress):
+            offset = start_offset
+            found_offset = start_offset
+            for _ in range(repeat):
+                if direction == SearchState.DIR_FORWARD:
+                    offset += 1
+                match = searcher.find(
+                    snapshot, offset, direction, progress, workers)
+                if match is None:
+                    return found_offset, False
+                offset = found_offset = match[0]
+            return found_offset, True
+
+        def found(result):
+            if search_state.job is not job:
+                return
+            search_state.job = None
+            offset, complete = result
+            if offset != start_offset:
+                tab_state.current_offset = offset
+            if not complete and not quiet:
+                # TODO: if an option is enabled, show info and wrap around
+                raise RuntimeError('Not found')
+
+        def failed(_error):
+            if search_state.job is job:
+                search_state.job = None
+
+        job = jobs.Job(
+            'Searching',
+            search,
+            on_success=found,
+            on_failure=failed,
+            daemon=True,
+            quiet=quiet)
+        search_state.job = job
+        jobs.start(job)
+
+    def _cancel_search(self):
+        search_state = self._app_state.search_state
+        if not search_state.job:
+            return False
+        search_state.job.cancel()
+        search_state.job = None
+        return True
 
     def run(self, args):
         raise NotImplementedError()
@@ -52,13 +126,78 @@ class ForwardSearchCommand(_BaseSearchCommand):
     def run(self, args):
         text = '' if len(args) < 1 else args[0]
         repeat = 1 if len(args) < 2 else int(args[1])
-        for _ in range(repeat):
-            self.perform_user_search(SearchState.DIR_FORWARD, text)
+        self.perform_user_search(SearchState.DIR_FORWARD, text, repeat)
 
 class BackwardSearchCommand(_BaseSearchCommand):
     names = ['rsearch']
     def run(self, args):
         text = '' if len(args) < 1 else args[0]
         repeat = 1 if len(args) < 2 else int(args[1])
-        for _ in range(repeat):
-            self.perform_user_search(SearchState.DIR_BACKWARD, text)
+        self.perform_user_search(SearchState.DIR_BACKWARD, text, repeat)
+
+class PreviewSearchCommand(_BaseSearchCommand):
+    '''
+    Moves the cursor to the first match of the pattern that's being typed,
+    counting from where typing it started. Used by incsearch.
+    '''
+    names = ['search_preview']
+    def run(self, args):
+        text = '' if len(args) < 1 else args[0]
+        search_state = self._app_state.search_state
+        if search_state.origin is None:
+            search_state.origin = self.current_tab.current_offset
+        self._cancel_search()
+        self.current_tab.current_offset = search_state.origin
+        try:
+            search_state.preview = Searcher(text) if text else None
+        except RuntimeError:
+            # the pattern is probably just incomplete
+            search_state.preview = None
+        events.notify(events.SearchChange())
+        if not search_state.preview:
+            return
+        if self._app_state.mode == AppState.MODE_SEARCH_BACKWARD:
+            direction = SearchState.DIR_BACKWARD
+        else:
+            direction = SearchState.DIR_FORWARD
+        self._start_search(search_state.preview, direction, 1, quiet=True)
+
+class CancelSearchCommand(_BaseSearchCommand):
+    '''
+    Stops the search that's running, if any. Also ends the incsearch
+    preview, moving the cursor back to where it was before.
+    '''
+    names = ['cancel_search']
+    def run(self, _args):
+        search_state = self._app_state.search_state
+        self._cancel_search()
+        if search_state.origin is not None:
+            self.current_tab.current_offset = search_state.origin
+            search_state.origin = None
+            search_state.preview = None
+            events.notify(events.SearchChange())
+
+class ListMatchesCommand(_BaseSearchCommand):
+    ''' Lists the matches of the last pattern in the current buffer. '''
+    names = ['matches']
+    max_listed = 100
+
+    def run(self, _args):
+        if not self._app_state.search_state.searcher:
+            raise RuntimeError('No text to search for')
+        index = self._get_index(create=True)
+        if not index.update():
+            if not index.job:
+                index.build()
+            raise RuntimeError('Matches are still being indexed')
+        if not len(index):
+            events.notify(events.PrintMessage('No matches', style='msg-info'))
+            return
+        matches = [
+            '0x%X-0x%X' % (start, end - 1) if end > start else '0x%X' % start
+            for start, end in index.get_matches(self.max_listed)]
+        if len(index) > self.max_listed:
+            matches.append('...')
+        events.notify(events.PrintMessage(
+            '{:,} matches: {}'.format(len(index), ', '.join(matches)),
+            style='msg-info'))
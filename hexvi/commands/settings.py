@@ -11,6 +11,8 @@ class ManipulateUserSettingCommand(BaseCommand):
     def run(self, args):
         key = args[0]
         value = args[1] if len(args) > 1 else None
+        if value is None and '=' in key:
+            key, value = key.split('=', 1)
 
         if not hasattr(self._app_state.settings, key):
             raise RuntimeError('Option does not exist: ' + key)
@@ -21,6 +23,8 @@ class ManipulateUserSettingCommand(BaseCommand):
         else:
             value_type = type(getattr(self._app_state.settings, key))
             setattr(self._app_state.settings, key, value_type(value))
+            events.notify(events.SettingChange(
+                key, getattr(self._app_state.settings, key)))
 
 class ManipulateColorSettingCommand(BaseCommand):
     names = ['hi', 'highlight']
@@ -1,10 +1,12 @@
 ''' Commands related to tab management '''
 
 import os
+import hexvi.events as events
+import hexvi.jobs as jobs
 from hexvi.app_state import SearchState
 from hexvi.command_registry import BaseCommand, BaseTabCommand
 
-def _save(tab_manager, args, overwrite):
+def _save(tab_manager, args, overwrite, mode):
     if not tab_manager.current_tab:
         raise RuntimeError('No tab opened')
     filebuf = tab_manager.current_tab.file_buffer
@@ -15,7 +17,23 @@ def _save(tab_manager, args, overwrite):
         path = filebuf.path
     if not path:
         raise RuntimeError('Need path')
-    filebuf.save_to_file(path, overwrite)
+    operation = filebuf.prepare_save(path, overwrite, mode)
+    def saved(_result):
+        operation.finish()
+        events.notify(events.PrintMessage(
+            '%r written (%d bytes)' % (path, operation.size), style='msg-info'))
+    def failed(_error):
+        operation.abandon()
+    try:
+        jobs.start(jobs.Job(
+            'Saving %s' % path,
+            operation.run,
+            on_success=saved,
+            on_failure=failed,
+            key=('save', os.path.abspath(path))))
+    except RuntimeError:
+        operation.abandon()
+        raise
 
 class OpenTabCommand(BaseTabCommand):
     ''' Opens a new tab. '''
@@ -89,11 +107,19 @@ class SaveFileCommand(BaseTabCommand):
     names = ['w', 'write']
 
     def run(self, args):
-        _save(self._tab_manager, args, overwrite=False)
+        _save(
+            self._tab_manager,
+            args,
+            overwrite=False,
+            mode=self._app_state.settings.savemode)
 
 class ForceSaveFileCommand(BaseTabCommand):
     ''' Saves a file to a location on HDD overwriting it if it exists. '''
     names = ['w!', 'write!']
 
     def run(self, args):
-        _save(self._tab_manager, args, overwrite=True)
+        _save(
+            self._tab_manager,
+            args,
+            overwrite=True,
+            mode=self._app_state.settings.savemode)
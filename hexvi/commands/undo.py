@@ -0,0 +1,84 @@
+''' Commands related to undo history '''
+
+import regex
+import hexvi.events as events
+from hexvi.command_registry import BaseTabCommand
+
+_TIME_UNITS = {'s': 1, 'm': 60, 'h': 60*60, 'd': 24*60*60}
+
+class _BaseUndoCommand(BaseTabCommand):
+    def move_in_history(self, func, *args):
+        ''' Runs a FileBuffer history method and puts the cursor on the change. '''
+        offset = func(*args)
+        if offset is not None:
+            self.current_tab.current_offset = offset
+        self._tab_manager.buffer_changed(self.current_tab.file_buffer)
+        events.notify(events.PrintMessage(
+            'At change #%d' % self.current_tab.file_buffer.history.number,
+            style='msg-info'))
+
+    def parse_span(self, args):
+        '''
+        Parses the argument of :earlier and :later, which is either a number
+        of changes or a number followed by s, m, h or d for a time span.
+        Returns (count, seconds) with one of them set to None.
+        '''
+        match = regex.match(r'^(\d+)([smhd]?)$', args[0] if args else '1')
+        if not match:
+            raise RuntimeError('Invalid argument: %s' % args[0])
+        count, unit = int(match.group(1)), match.group(2)
+        if unit:
+            return None, count * _TIME_UNITS[unit]
+        return count, None
+
+    def run(self, args):
+        raise NotImplementedError()
+
+class UndoCommand(_BaseUndoCommand):
+    '''
+    Undoes the last change. With a number, goes to the state right after the
+    change with that number instead.
+    '''
+    names = ['u', 'undo']
+
+    def run(self, args):
+        file_buffer = self.current_tab.file_buffer
+        if args:
+            self.move_in_history(file_buffer.undo_to_number, int(args[0]))
+        else:
+            self.move_in_history(file_buffer.undo)
+
+class RedoCommand(_BaseUndoCommand):
+    ''' Redoes the last undone change. '''
+    names = ['red', 'redo']
+
+    def run(self, args):
+        self.move_in_history(self.current_tab.file_buffer.redo)
+
+class EarlierCommand(_BaseUndoCommand):
+    ''' Goes back by a number of changes or by a time span such as 10m. '''
+    names = ['earlier']
+
+    def run(self, args):
+        file_buffer = self.current_tab.file_buffer
+        count, seconds = self.parse_span(args)
+        if count is not None:
+            self.move_in_history(file_buffer.undo, count)
+        else:
+            self.move_in_history(
+                file_buffer.undo_to_time,
+                file_buffer.history.time - seconds)
+
+class LaterCommand(_BaseUndoCommand):
+    ''' Goes forward by a number of changes or by a time span such as 10m. '''
+    names = ['later']
+
+    def run(self, args):
+        file_buffer = self.current_tab.file_buffer
+        count, seconds = self.parse_span(args)
+        if count is not None:
+            self.move_in_history(file_buffer.redo, count)
+        else:
+            self.move_in_history(
+                file_buffer.undo_to_time,
+                file_buffer.history.time + seconds)
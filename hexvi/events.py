@@ -53,6 +53,14 @@ OffsetChange = namedtuple('OffsetChange', ['tab_state'])
 
 PaneChange = namedtuple('PaneChange', ['tab_state'])
 
+SettingChange = namedtuple('SettingChange', ['key', 'value'])
+
+JobChange = namedtuple('JobChange', ['job'])
+
+BufferChange = namedtuple('BufferChange', ['file_buffer'])
+
+SearchChange = namedtuple('SearchChange', [])
+
 ColorChange = namedtuple(
     'ColorChange',
     ['target', 'fg_style', 'bg_style', 'fg_style_high', 'bg_style_high'])
@@ -3,8 +3,26 @@ Exports FileBuffer.
 The extra Window classes should be considered implementation details.
 '''
 
+import collections
+import contextlib
+import errno
+import fcntl
+import hashlib
+import itertools
+import mmap
 import os
 import shutil
+import stat
+import struct
+import tempfile
+from hexvi.block_cache import SHARED_CACHE
+from hexvi.history import History
+from hexvi.history import merge_edits
+from hexvi.piece_tree import PieceTree
+from hexvi.piece_tree import iter_unique_pieces
+
+# ioctl request that returns the size of a block device in bytes on Linux
+_BLKGETSIZE64 = 0x80081272
 
 class Window(object):
     ''' Represents a range, which has size and offset. '''
@@ -52,67 +70,1012 @@ class ContentWindow(Window):
 
     def get(self, offset, size):
         ''' Retrieves content chunk of given size at a given offset. '''
-        raise NotImplementedError()
+        assert offset in self
+        assert offset + size in self
+        return self.read(offset - self.start_offset, size)
 
     def clone(self, offset, size):
         ''' Returns "substring" ContentWindow. '''
+        assert offset in self
+        assert offset + size in self
+        window = self.slice(offset - self.start_offset, size)
+        window.start_offset = offset
+        return window
+
+    def read(self, offset, size):
+        '''
+        Retrieves content chunk of given size at a given offset relative to
+        the window start.
+        '''
+        raise NotImplementedError()
+
+    def slice(self, offset, size):
+        '''
+        Returns "substring" ContentWindow, with the offset relative to the
+        window start. The new window starts at 0.
+        '''
         raise NotImplementedError()
 
+class ScratchFile(object):
+    '''
+    An anonymous temporary file that in-memory content can be moved to, to
+    keep memory usage in check. Content is only ever appended to it.
+    '''
+
+    def __init__(self):
+        self._handle = tempfile.TemporaryFile(buffering=0)
+        self._size = 0
+
+    def append(self, content):
+        ''' Writes content at the end of the file and returns its offset. '''
+        offset = self._size
+        view = memoryview(content).cast('B')
+        while view:
+            written = os.pwrite(self._handle.fileno(), view, self._size)
+            view = view[written:]
+            self._size += written
+        return offset
+
+    def read(self, offset, size):
+        ''' Retrieves content chunk of given size at a given offset. '''
+        return os.pread(self._handle.fileno(), size, offset)
+
+    def get_mapping(self, _offset, _size):
+        ''' Returns None: unlike a FileSource, the file isn't mapped. '''
+        return None
+
+    def close(self):
+        ''' Closes and thereby removes the file. '''
+        self._handle.close()
+
+    def fileno(self):
+        ''' Returns the underlying file descriptor. '''
+        return self._handle.fileno()
+
+    size = property(lambda self: self._size)
+
+class StreamSource(ScratchFile):
+    '''
+    A scratch file that receives the content of a stream, such as standard
+    input, which can't be read at arbitrary offsets. receive() copies the
+    stream into it and is meant to run on a worker thread, while the content
+    received so far can be read from any thread.
+
+    Like a FileBuffer, the source can take just a part of the stream, given
+    by offset and length. The bytes before it are read and thrown away.
+
+    The stream can also be given as the path of a file such as a FIFO, which
+    is then opened by receive(), as opening a FIFO waits for a writer.
+    '''
+
+    chunk_size = 64*1024
+
+    def __init__(self, stream, offset=0, length=None):
+        super().__init__()
+        self._stream = stream
+        self._skipped_size = offset
+        self._length = length
+        self._finished = False
+
+    def receive(self, progress=None):
+        '''
+        Reads the stream until it ends. progress, if given, is called with the
+        amount of bytes received after each chunk; an exception raised from it
+        stops the reading.
+        '''
+        stream = self._stream
+        try:
+            if isinstance(stream, str):
+                stream = open(stream, 'rb')
+            while self._length is None or self.size < self._length:
+                chunk = os.read(stream.fileno(), self.chunk_size)
+                if not chunk:
+                    break
+                if self._skipped_size:
+                    skipped_size = min(self._skipped_size, len(chunk))
+                    chunk = chunk[skipped_size:]
+                    self._skipped_size -= skipped_size
+                if self._length is not None:
+                    chunk = chunk[:self._length - self.size]
+                if chunk:
+                    self.append(chunk)
+                if progress:
+                    progress(self.size, 0)
+        finally:
+            if stream is not self._stream:
+                stream.close()
+            self._finished = True
+
+    finished = property(lambda self: self._finished)
+
+class _SpilledBuffer(object):
+    '''
+    Content of a BufferContentWindow that was moved to a ScratchFile. Supports
+    only as much of the bytes interface as BufferContentWindow needs.
+    '''
+
+    def __init__(self, scratch_file, file_offset, size):
+        self._scratch_file = scratch_file
+        self._file_offset = file_offset
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self[key:key + 1 or None][0]
+        start, stop, _ = key.indices(self._size)
+        return self._scratch_file.read(
+            self._file_offset + start, max(0, stop - start))
+
+    def slice(self, offset, size):
+        ''' Returns a _SpilledBuffer for a part of the content. '''
+        return _SpilledBuffer(
+            self._scratch_file, self._file_offset + offset, size)
+
 class BufferContentWindow(ContentWindow):
-    ''' A Window that has content placed in the memory. '''
+    '''
+    A Window that has content placed in the memory.
+
+    If the buffer is a bytearray, the window can be grown by appending to it.
+    Appending never touches the bytes other windows sharing the buffer can
+    see, so a grown window simply replaces the old one.
 
-    def __init__(self, offset, buffer):
-        super().__init__(offset, len(buffer))
+    The content can be moved to a ScratchFile with spill(). This is the only
+    way a window ever changes, and it doesn't change what the window holds,
+    so every snapshot that shares the window sees it as unchanged while the
+    memory gets freed for all of them at once.
+    '''
+
+    def __init__(self, offset, buffer, size=None):
+        super().__init__(offset, len(buffer) if size is None else size)
         self._buffer = buffer
 
-    def get(self, offset, size):
-        ''' Retrieves content chunk of given size at a given offset. '''
-        assert offset in self
-        assert offset + size in self
-        return self._buffer[offset-self.start_offset:offset-self.start_offset+size]
+    def read(self, offset, size):
+        return self._buffer[offset:offset+size]
 
-    def clone(self, offset, size):
-        ''' Returns "substring" BufferContentWindow. '''
-        return BufferContentWindow(offset, self.get(offset, size))
+    def slice(self, offset, size):
+        if self.spilled:
+            return BufferContentWindow(0, self._buffer.slice(offset, size))
+        return BufferContentWindow(0, bytes(self.read(offset, size)))
+
+    def spill(self, scratch_file):
+        ''' Moves the content to a scratch file. '''
+        if not self.spilled:
+            self._buffer = _SpilledBuffer(
+                scratch_file, scratch_file.append(self.buffer), self.size)
+
+    def can_grow(self):
+        ''' Returns whether the window owns the end of its buffer. '''
+        return isinstance(self._buffer, bytearray) \
+            and len(self._buffer) == self.size
+
+    def grow(self, new_content):
+        ''' Appends content to the buffer and returns the grown window. '''
+        assert self.can_grow()
+        self._buffer += new_content
+        return BufferContentWindow(
+            self.start_offset, self._buffer, self.size + len(new_content))
+
+    def get_buffer(self):
+        ''' Returns the window content, read back if it was spilled. '''
+        if self.spilled:
+            return self.read(0, self.size)
+        if len(self._buffer) != self.size:
+            return self._buffer[:self.size]
+        return self._buffer
 
     def __repr__(self):
-        return 'BufferContentWindow(%d,%r)' % (self.start_offset, self._buffer)
+        return 'BufferContentWindow(%d,%r)' % (self.start_offset, self.buffer)
 
     def __eq__(self, other):
         return isinstance(other, BufferContentWindow) \
             and self.start_offset == other.start_offset \
             and self.size == other.size \
-            and self._buffer == other.buffer
+            and self.buffer == other.buffer
+
+    buffer = property(get_buffer)
+    spilled = property(lambda self: isinstance(self._buffer, _SpilledBuffer))
+
+class FileSource(object):
+    '''
+    Provides access to the content of a physical file.
+
+    Whenever possible, the file is memory-mapped and the content is handed out
+    as memoryview slices of the mapping, which doesn't copy anything. Files
+    that can't be mapped (such as devices) are read with os.pread() through a
+    block cache that is shared with other sources.
+
+    Neither way depends on the file position, so a source can be read from
+    any number of threads at the same time.
+
+    Touching a mapping past the end of a file that got shorter kills the
+    process, so mapped reads check the size of the file first. Whatever the
+    file no longer has is read with os.pread() instead, which just comes up
+    short.
+    '''
+
+    probe_size = 1024*1024
+
+    def __init__(self, handle, cache=SHARED_CACHE):
+        self._handle = handle
+        self._cache = cache
+        self._map = None
+        self._view = None
+        self._map_file()
+
+    def _map_file(self):
+        try:
+            self._map = mmap.mmap(
+                self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        except (ValueError, OSError):
+            self._map = None
+            self._view = None
+
+    def _unmap_file(self):
+        if self._view is not None:
+            self._view.release()
+            try:
+                self._map.close()
+            except BufferError:
+                # still being read somewhere, closes once no longer referenced
+                pass
+
+    def read(self, offset, size):
+        ''' Retrieves content chunk of given size at a given file offset. '''
+        if self.get_mapping(offset, size) is not None:
+            return self._view[offset:offset+size]
+        return self._cache.read(self, offset, size, self._read_uncached)
+
+    def get_mapping(self, offset, size):
+        '''
+        Returns the mmap object of the file if the content of given size at a
+        given file offset can be read from it, or None otherwise. This is for
+        the likes of mmap.find(), which search the content where it is.
+        '''
+        if self._view is not None \
+                and offset + size <= len(self._view) \
+                and offset + size <= os.fstat(self._handle.fileno()).st_size:
+            return self._map
+        return None
 
-    buffer = property(lambda self: self._buffer)
+    def probe(self, offset, size):
+        '''
+        Returns how many bytes, up to a given size, the file has at a given
+        offset. This reads them, so it's meant for files whose size can't be
+        told upfront. They are read probe_size bytes at a time and thrown
+        away, so that jumping far into a device doesn't take as much memory.
+        '''
+        done = 0
+        while done < size:
+            chunk = os.pread(
+                self._handle.fileno(),
+                min(self.probe_size, size - done),
+                offset + done)
+            if not chunk:
+                break
+            done += len(chunk)
+        return done
+
+    def _read_uncached(self, offset, size):
+        chunks = []
+        while size > 0:
+            chunk = os.pread(self._handle.fileno(), size, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def close(self):
+        ''' Releases the mapping and closes the file. '''
+        self._unmap_file()
+        self._cache.invalidate(self)
+        self._handle.close()
+
+    def reopen(self, handle):
+        '''
+        Switches to another opened file, such as a newer version of the same
+        file, for all the windows that use this source.
+        '''
+        self.close()
+        self._handle = handle
+        self._map_file()
+
+    def invalidate(self):
+        ''' Forgets cached content, after the file was written to. '''
+        self._cache.invalidate(self)
+
+    def fileno(self):
+        ''' Returns the underlying file descriptor. '''
+        return self._handle.fileno()
+
+    mapped = property(lambda self: self._view is not None)
+    name = property(lambda self: self._handle.name)
 
 class FileContentWindow(ContentWindow):
     ''' A Window that has content placed within a physical file. '''
 
-    def __init__(self, offset, size, file_handle, file_offset):
+    def __init__(self, offset, size, source, file_offset):
         super().__init__(offset, size)
         self._file_offset = file_offset
-        self._handle = file_handle
+        self._source = source
 
-    def get(self, offset, size):
-        ''' Retrieves content chunk of given size at a given offset. '''
-        assert offset in self
-        assert offset + size in self
-        self._handle.seek(
-            self._file_offset + offset - self.start_offset, os.SEEK_SET)
-        return self._handle.read(size)
+    def read(self, offset, size):
+        content = self._source.read(self._file_offset + offset, size)
+        if len(content) < size:
+            raise RuntimeError(
+                '%r got shorter, use :e! to reload it' % self._source.name)
+        return content
 
-    def clone(self, offset, size):
-        ''' Returns "substring" FileContentWindow. '''
+    def slice(self, offset, size):
         return FileContentWindow(
-            offset,
-            size,
-            self._handle,
-            self._file_offset + offset - self.start_offset)
+            0, size, self._source, self._file_offset + offset)
 
     def __repr__(self):
         return 'FileContentWindow(%d,%d,0x%x,%d)' % (
-            self.start_offset, self._size, id(self._handle), self._file_offset)
+            self.start_offset, self._size, id(self._source), self._file_offset)
+
+    source = property(lambda self: self._source)
+    file_offset = property(lambda self: self._file_offset)
+
+class HoleWindow(Window):
+    ''' A Window without content, used to see through the overlay. '''
+
+    def slice(self, offset, size):
+        ''' Returns "substring" HoleWindow. '''
+        return HoleWindow(0, size)
+
+    def __repr__(self):
+        return 'HoleWindow(%d,%d)' % (self.start_offset, self._size)
+
+def is_seekable(path):
+    '''
+    Returns whether a file can be read at arbitrary offsets, which pipes and
+    terminals can't. FIFOs aren't opened to tell, as that waits for a writer.
+    Files that can't be looked at count as seekable, so that opening them
+    fails the usual way.
+    '''
+    try:
+        if stat.S_ISFIFO(os.stat(path).st_mode):
+            return False
+        with open(path, 'rb') as handle:
+            os.lseek(handle.fileno(), 0, os.SEEK_CUR)
+    except OSError as ex:
+        return ex.errno != errno.ESPIPE
+    return True
+
+def _get_file_size(handle):
+    '''
+    Returns the size of an opened file, or None if it can't be told without
+    reading the file, as is the case with character devices and files such as
+    the ones in /proc, which claim to be empty.
+    '''
+    file_stat = os.fstat(handle.fileno())
+    if stat.S_ISREG(file_stat.st_mode):
+        return file_stat.st_size or None
+    if stat.S_ISBLK(file_stat.st_mode):
+        try:
+            result = fcntl.ioctl(handle.fileno(), _BLKGETSIZE64, bytes(8))
+            return struct.unpack('Q', result)[0]
+        except OSError:
+            return os.lseek(handle.fileno(), 0, os.SEEK_END)
+    return None
+
+class _Extent(object):
+    '''
+    A piece of the change map of a snapshot: a run of bytes that were either
+    all changed (marked) or all left as they were since the file was read.
+    '''
+    __slots__ = ['size', 'marked']
+
+    def __init__(self, size, marked):
+        self.size = size
+        self.marked = marked
+
+    def slice(self, _offset, size):
+        ''' Returns an extent of the same kind and of a given size. '''
+        return _Extent(size, self.marked)
+
+def _mark_changes(changes, offset, size):
+    '''
+    Marks a range of a change map as changed, merging it with the changed
+    extents it touches.
+    '''
+    start, end = offset, offset + size
+    if start > 0:
+        extent, extent_offset = changes.find(start - 1)
+        if extent.marked:
+            start -= extent_offset + 1
+    if end < changes.size:
+        extent, extent_offset = changes.find(end)
+        if extent.marked:
+            end += extent.size - extent_offset
+    return changes.replace(start, end - start, _Extent(end - start, True))
+
+def _get_signature(path):
+    '''
+    Returns what tells whether a file changed: its identity, size and
+    modification time, or None if the file doesn't exist.
+    '''
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (status.st_dev, status.st_ino, status.st_size, status.st_mtime_ns)
+
+def _merge_blocks(blocks, block_size):
+    '''
+    Turns sorted block numbers into (start, end) offset pairs, one per run of
+    consecutive blocks.
+    '''
+    ranges = []
+    for block in blocks:
+        if ranges and ranges[-1][1] == block * block_size:
+            ranges[-1] = (ranges[-1][0], (block + 1) * block_size)
+        else:
+            ranges.append((block * block_size, (block + 1) * block_size))
+    return ranges
+
+def _put(tree, offset, size, new_content, coalesce):
+    '''
+    Replaces size bytes at given offset of a window tree with new content.
+    See FileBuffer.insert() for the meaning of coalesce.
+    '''
+    if coalesce:
+        if offset > 0:
+            window, window_offset = tree.find(offset - 1)
+            if isinstance(window, BufferContentWindow) \
+                    and window_offset == window.size - 1 \
+                    and window.can_grow():
+                return tree.replace(
+                    offset - window.size,
+                    window.size + size,
+                    window.grow(new_content))
+        new_content = bytearray(new_content)
+    return tree.replace(offset, size, BufferContentWindow(0, new_content))
+
+def _insert_hole(overlay, offset, size):
+    ''' Makes room in the overlay, preferably by extending existing holes. '''
+    for probe_offset in [offset, offset - 1]:
+        if probe_offset in range(overlay.size):
+            window, window_offset = overlay.find(probe_offset)
+            if isinstance(window, HoleWindow):
+                return overlay.replace(
+                    probe_offset - window_offset,
+                    window.size,
+                    HoleWindow(0, window.size + size))
+    return overlay.insert(offset, HoleWindow(0, size))
+
+def _join_holes(overlay, offset):
+    ''' Merges the overlay holes that meet at a given offset, if any. '''
+    if offset not in range(1, overlay.size):
+        return overlay
+    left_window, left_offset = overlay.find(offset - 1)
+    right_window, right_offset = overlay.find(offset)
+    if isinstance(left_window, HoleWindow) \
+            and isinstance(right_window, HoleWindow) \
+            and left_offset == left_window.size - 1 \
+            and right_offset == 0:
+        return overlay.replace(
+            offset - left_window.size,
+            left_window.size + right_window.size,
+            HoleWindow(0, left_window.size + right_window.size))
+    return overlay
+
+def _iter_layers(tree, overlay, offset, size):
+    '''
+    Yields (window, offset, size) triples covering a given range, taking the
+    windows from the overlay and from the tree wherever the overlay has holes.
+    '''
+    if not overlay:
+        yield from tree.iter_range(offset, size)
+        return
+    for window, window_offset, window_size in overlay.iter_range(offset, size):
+        if isinstance(window, HoleWindow):
+            yield from tree.iter_range(offset, window_size)
+        else:
+            yield window, window_offset, window_size
+        offset += window_size
+
+def _join_windows(left, right):
+    '''
+    Returns a single window equivalent to two adjacent ones, if that doesn't
+    involve copying any content. Returns None otherwise.
+    '''
+    if isinstance(left, HoleWindow) and isinstance(right, HoleWindow):
+        return HoleWindow(0, left.size + right.size)
+    if isinstance(left, FileContentWindow) \
+            and isinstance(right, FileContentWindow) \
+            and left.source is right.source \
+            and left.file_offset + left.size == right.file_offset:
+        return FileContentWindow(
+            0, left.size + right.size, left.source, left.file_offset)
+    return None
+
+def _compact(tree, max_buffer_size):
+    '''
+    Returns a tree with adjacent windows merged: in-memory windows as long as
+    the merged window doesn't exceed max_buffer_size, and file windows that
+    continue each other. Returns the same tree if there's nothing to merge.
+    '''
+    windows = []
+    run = []
+    run_size = 0
+    for window in itertools.chain(tree, [None]):
+        if isinstance(window, BufferContentWindow) \
+                and not window.spilled \
+                and run_size + window.size <= max_buffer_size:
+            run.append(window)
+            run_size += window.size
+            continue
+        if len(run) > 1:
+            windows.append(BufferContentWindow(
+                0, bytearray(b''.join(item.buffer for item in run))))
+        else:
+            windows.extend(run)
+        run = []
+        run_size = 0
+        if isinstance(window, BufferContentWindow) and not window.spilled:
+            run.append(window)
+            run_size += window.size
+        elif window is not None:
+            joined_window = windows and _join_windows(windows[-1], window)
+            if joined_window:
+                windows[-1] = joined_window
+            else:
+                windows.append(window)
+    if len(windows) == len(tree):
+        return tree
+    result = PieceTree()
+    for window in windows:
+        result = result.insert(result.size, window)
+    return result
+
+def _iter_patches(overlay):
+    ''' Yields (offset, window) pairs of the content windows of an overlay. '''
+    offset = 0
+    for window in overlay or []:
+        if isinstance(window, BufferContentWindow):
+            yield offset, window
+        offset += window.size
+
+class Snapshot(object):
+    '''
+    The content of a file buffer at some point in time.
+
+    Snapshots never change. Editing one returns a new snapshot that shares
+    almost all of its windows with the old one, so keeping old snapshots
+    around is cheap and reading from them is safe while the buffer is being
+    edited, including from other threads.
+    '''
+
+    def __init__(self, tree=None, overlay=None, changes=None):
+        if overlay is not None \
+                and len(overlay) == 1 \
+                and isinstance(next(iter(overlay)), HoleWindow):
+            overlay = None
+        if changes is not None and not changes.find_marked(0)[1]:
+            changes = None
+        self.tree = tree if tree is not None else PieceTree()
+        self.overlay = overlay
+        self.changes = changes
+
+    def _get_change_map(self):
+        '''
+        Returns the change map, which is a tree of _Extents spanning the
+        content that tells which bytes were changed. Snapshots without any
+        changes don't keep it.
+        '''
+        if self.changes is not None:
+            return self.changes
+        changes = PieceTree()
+        if self.size:
+            changes = changes.insert(0, _Extent(self.size, False))
+        return changes
+
+    def insert(self, offset, new_content, coalesce=False):
+        ''' Returns a snapshot with new content inserted at given offset. '''
+        assert offset in Window(0, self.size)
+        if not new_content:
+            return self
+        overlay = self.overlay
+        if overlay:
+            overlay = _insert_hole(overlay, offset, len(new_content))
+        changes = self._get_change_map() \
+            .insert(offset, _Extent(len(new_content), True))
+        return Snapshot(
+            _put(self.tree, offset, 0, new_content, coalesce),
+            overlay,
+            _mark_changes(changes, offset, len(new_content)))
+
+    def delete(self, offset, size):
+        '''
+        Returns a snapshot with a part of content removed. The change map
+        marks the byte that takes the place of the removed content, or the
+        last byte if there's none.
+        '''
+        window = Window(offset, min(self.size - offset, size))
+        assert window.start_offset in Window(0, self.size)
+        assert window.end_offset in Window(0, self.size)
+        if not window.size:
+            return self
+        overlay = self.overlay
+        if overlay:
+            overlay = _join_holes(
+                overlay.delete(window.start_offset, window.size),
+                window.start_offset)
+        changes = self._get_change_map().delete(window.start_offset, window.size)
+        if changes:
+            changes = _mark_changes(
+                changes, min(window.start_offset, changes.size - 1), 1)
+        return Snapshot(
+            self.tree.delete(window.start_offset, window.size),
+            overlay,
+            changes)
+
+    def replace(self, offset, new_content, coalesce=False):
+        '''
+        Returns a snapshot with content at given offset overridden by new
+        content. See FileBuffer.replace() for details.
+        '''
+        if not new_content:
+            return self
+        if offset + len(new_content) > self.size:
+            snapshot = self \
+                .delete(offset, len(new_content)) \
+                .insert(offset, new_content, coalesce)
+            changes = self._get_change_map() \
+                .delete(offset, self.size - offset) \
+                .insert(offset, _Extent(len(new_content), True))
+            return Snapshot(
+                snapshot.tree,
+                snapshot.overlay,
+                _mark_changes(changes, offset, len(new_content)))
+        assert offset >= 0
+        overlay = self.overlay or PieceTree().insert(
+            0, HoleWindow(0, self.size))
+        overlay = _put(overlay, offset, len(new_content), new_content, coalesce)
+        return Snapshot(
+            self.tree,
+            overlay,
+            _mark_changes(self._get_change_map(), offset, len(new_content)))
+
+    def append(self, window):
+        '''
+        Returns a snapshot with a content window added at the end, joined with
+        the last window if it continues it.
+        '''
+        tree = self.tree
+        last_window, _ = tree.find(tree.size - 1) if tree else (None, 0)
+        joined_window = last_window and _join_windows(last_window, window)
+        if joined_window:
+            tree = tree.replace(
+                tree.size - last_window.size, last_window.size, joined_window)
+        else:
+            tree = tree.insert(tree.size, window)
+        overlay = self.overlay
+        if overlay:
+            overlay = _insert_hole(overlay, overlay.size, window.size)
+        changes = self.changes
+        if changes:
+            last_extent, _ = changes.find(changes.size - 1)
+            if last_extent.marked:
+                changes = changes.insert(
+                    changes.size, _Extent(window.size, False))
+            else:
+                changes = changes.replace(
+                    changes.size - last_extent.size,
+                    last_extent.size,
+                    _Extent(last_extent.size + window.size, False))
+        return Snapshot(tree, overlay, changes)
+
+    def compact(self, max_buffer_size):
+        '''
+        Returns a snapshot with the same content and adjacent windows merged
+        wherever possible. See _compact() for details.
+        '''
+        overlay = self.overlay
+        if overlay:
+            overlay = _compact(overlay, max_buffer_size)
+        tree = _compact(self.tree, max_buffer_size)
+        if tree is self.tree and overlay is self.overlay:
+            return self
+        return Snapshot(tree, overlay, self.changes)
+
+    def get_window_count(self):
+        ''' Returns the number of windows, including the overlay ones. '''
+        return len(self.tree) + (len(self.overlay) if self.overlay else 0)
+
+    def check_consistency(self):
+        ''' See FileBuffer.check_consistency(). '''
+        self.tree.check_consistency()
+        offset = 0
+        for window in self.tree:
+            assert isinstance(window, ContentWindow), 'Bad window type'
+            offset += window.size
+        assert offset == self.size, 'Bad buffer size'
+        if self.overlay:
+            self.overlay.check_consistency()
+            assert self.overlay.size == self.size, 'Bad overlay size'
+            previous_window = None
+            for window in self.overlay:
+                assert isinstance(window, (HoleWindow, BufferContentWindow)), \
+                    'Bad overlay window type'
+                assert not isinstance(window, HoleWindow) \
+                    or not isinstance(previous_window, HoleWindow), \
+                    'Adjacent overlay holes'
+                previous_window = window
+        if self.changes:
+            self.changes.check_consistency()
+            assert self.changes.size == self.size, 'Bad change map size'
+            previous_extent = None
+            for extent in self.changes:
+                assert previous_extent is None \
+                    or extent.marked != previous_extent.marked, \
+                    'Adjacent extents of the same kind'
+                previous_extent = extent
+
+    def get(self, offset, size):
+        ''' See FileBuffer.get(). '''
+        chunks = list(self.iter_chunks(offset, size))
+        if len(chunks) == 1:
+            return chunks[0]
+        buffer = b''.join(chunks)
+        assert len(buffer) == size
+        return buffer
+
+    def get_into(self, offset, buffer):
+        ''' See FileBuffer.get_into(). '''
+        view = memoryview(buffer).cast('B')
+        size = min(len(view), self.size - offset)
+        written = 0
+        for chunk in self.iter_chunks(offset, size):
+            view[written:written+len(chunk)] = chunk
+            written += len(chunk)
+        return written
+
+    def get_mapping(self, offset, size):
+        '''
+        Returns the mmap object of the file that the content of given size at
+        a given offset comes from, along with the offset of the content in it,
+        or None if the content isn't all from one mapped part of a file.
+        '''
+        for window, window_offset, window_size in _iter_layers(
+                self.tree, self.overlay, offset, size):
+            if window_size != size or not isinstance(window, FileContentWindow):
+                return None
+            file_offset = window.file_offset + window_offset
+            mapping = window.source.get_mapping(file_offset, size)
+            return None if mapping is None else (mapping, file_offset)
+        return None
+
+    def iter_chunks(self, offset, size, chunk_size=None):
+        ''' See FileBuffer.iter_chunks(). '''
+        for window, window_offset, window_size in _iter_layers(
+                self.tree, self.overlay, offset, size):
+            if not chunk_size:
+                yield window.read(window_offset, window_size)
+                continue
+            for chunk_offset in range(0, window_size, chunk_size):
+                yield window.read(
+                    window_offset + chunk_offset,
+                    min(chunk_size, window_size - chunk_offset))
+
+    def get_windows(self):
+        ''' See FileBuffer.get_windows(). '''
+        windows = []
+        offset = 0
+        for window, window_offset, window_size in _iter_layers(
+                self.tree, self.overlay, 0, self.size):
+            if window_size != window.size:
+                window = window.slice(window_offset, window_size)
+            window.start_offset = offset
+            offset += window.size
+            windows.append(window)
+        return windows
+
+    def get_patches(self):
+        ''' See FileBuffer.get_patches(). '''
+        return [
+            (offset, bytes(window.read(0, window.size)))
+            for offset, window in _iter_patches(self.overlay)]
+
+    def get_changes(self, offset=0, size=None):
+        ''' See FileBuffer.get_changes(). '''
+        if not self.changes:
+            return []
+        if size is None:
+            size = self.size - offset
+        changes = []
+        for extent, extent_offset, extent_size \
+                in self.changes.iter_range(offset, size):
+            if extent.marked:
+                start = offset - extent_offset
+                changes.append((start, start + extent.size))
+            offset += extent_size
+        return changes
+
+    def find_change(self, offset, forward=True):
+        ''' See FileBuffer.find_change(). '''
+        if not self.changes:
+            return None
+        start, extent = self.changes.find_marked(
+            offset + 1 if forward else offset, forward)
+        if extent is None:
+            return None
+        return start, start + extent.size
+
+    def get_size(self):
+        ''' Returns the content size. '''
+        return self.tree.size
+
+    size = property(get_size)
+    windows = property(get_windows)
+    patches = property(get_patches)
+    window_count = property(get_window_count)
+
+class _TargetFile(object):
+    '''
+    Writes content to a file descriptor. Content that comes from another file
+    is copied by the kernel, which avoids passing it through Python and lets
+    file systems that support it (such as btrfs or XFS) share the extents
+    instead of duplicating them.
+    '''
+
+    def __init__(self, handle):
+        self._handle = handle
+        self._copy_functions = [self._copy_file_range, self._sendfile]
+        if not hasattr(os, 'copy_file_range'):
+            self._copy_functions.remove(self._copy_file_range)
+        if not hasattr(os, 'sendfile'):
+            self._copy_functions.remove(self._sendfile)
+
+    def write(self, content):
+        ''' Writes content at the current position. '''
+        view = memoryview(content)
+        while view:
+            view = view[os.write(self._handle, view):]
+
+    def copy(self, source, offset, size):
+        '''
+        Copies content of given size at a given offset of a FileSource to the
+        current position. Returns how many bytes were copied, which might be
+        anything down to 0 if the kernel can't do this. The caller is
+        responsible for writing the rest.
+        '''
+        try:
+            source_handle = source.fileno()
+        except (OSError, ValueError):
+            return 0
+        copied = 0
+        while copied < size and self._copy_functions:
+            try:
+                result = self._copy_functions[0](
+                    source_handle,
+                    offset + copied,
+                    min(size - copied, 1 << 30))
+            except OSError:
+                self._copy_functions.pop(0)
+                continue
+            if not result:
+                break
+            copied += result
+        return copied
+
+    def _copy_file_range(self, source_handle, offset, size):
+        return os.copy_file_range(source_handle, self._handle, size, offset)
+
+    def _sendfile(self, source_handle, offset, size):
+        return os.sendfile(self._handle, source_handle, offset, size)
+
+class SaveOperation(object):
+    '''
+    Saving of a file buffer, split so that the slow part can run on a worker
+    thread. The operation works with the content the buffer had when the
+    operation was created, not with its current content.
+    '''
+
+    buffer_size = 1024*1024
+    copy_size = 64*1024*1024
+
+    def __init__(
+            self,
+            file_buffer,
+            snapshot,
+            target_path,
+            saving_to_itself,
+            in_place_source,
+            in_place_offset=0):
+        self._file_buffer = file_buffer
+        self._in_place_source = in_place_source
+        self._in_place_offset = in_place_offset
+        self.snapshot = snapshot
+        self.target_path = target_path
+        self.saving_to_itself = saving_to_itself
+        self.size = snapshot.size
+
+    def run(self, progress=None):
+        '''
+        Writes the content to the target. Safe to call from another thread.
+
+        progress, if given, is called with the amount of bytes done and the
+        total amount of bytes after each chunk. An exception raised from it
+        aborts the operation; a partially written temporary file is removed.
+        '''
+        progress = progress or (lambda done, total: None)
+        if self.in_place:
+            self._write_in_place(progress)
+        else:
+            self._write_via_temporary_file(progress)
+
+    def finish(self):
+        ''' Updates the file buffer after run() has succeeded. '''
+        self._file_buffer._finish_save(self)
+
+    def abandon(self):
+        ''' Tells the file buffer that the operation won't be finished. '''
+        self._file_buffer._abandon_save(self)
+
+    def _write_in_place(self, progress):
+        patch_windows = list(_iter_patches(self.snapshot.overlay))
+        total = sum(window.size for _, window in patch_windows)
+        done = 0
+        handle = os.open(self.target_path, os.O_WRONLY)
+        try:
+            for offset, window in patch_windows:
+                offset += self._in_place_offset
+                view = memoryview(window.read(0, window.size))
+                while view:
+                    written = os.pwrite(handle, view, offset)
+                    view = view[written:]
+                    offset += written
+                done += window.size
+                progress(done, total)
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+            self._in_place_source.invalidate()
+
+    def _write_via_temporary_file(self, progress):
+        temporary_path = self.target_path + '.hexvi-tmp'
+        try:
+            with open(temporary_path, 'wb', buffering=0) as handle:
+                self._write_layers(_TargetFile(handle.fileno()), progress)
+        except BaseException:
+            # the file might not have been created in the first place
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temporary_path)
+            raise
+        shutil.move(temporary_path, self.target_path)
+
+    def _write_layers(self, target, progress):
+        done = 0
+        for window, window_offset, window_size in _iter_layers(
+                self.snapshot.tree, self.snapshot.overlay, 0, self.size):
+            is_file_window = isinstance(window, FileContentWindow)
+            step = self.copy_size if is_file_window else self.buffer_size
+            for chunk_offset in range(0, window_size, step):
+                chunk_size = min(step, window_size - chunk_offset)
+                copied = 0
+                if is_file_window:
+                    copied = target.copy(
+                        window.source,
+                        window.file_offset + window_offset + chunk_offset,
+                        chunk_size)
+                for write_offset in range(copied, chunk_size, self.buffer_size):
+                    target.write(window.read(
+                        window_offset + chunk_offset + write_offset,
+                        min(self.buffer_size, chunk_size - write_offset)))
+                done += chunk_size
+                progress(done, self.size)
+
+    in_place = property(lambda self: self._in_place_source is not None)
 
 class FileBuffer(object):
     '''
@@ -127,154 +1090,612 @@ class FileBuffer(object):
     the buffer splits existing content windows and introduces a new window that
     holds the text supplied by the user in the RAM.
 
+    Overwriting content without changing the size doesn't touch the windows at
+    all. Instead, the new content is put into an overlay that spans the whole
+    buffer and consists of in-memory windows and holes, through which the
+    windows underneath show.
+
     When the UI requests the file buffer to provide content at specific offset and
     of specific size, the file buffer "compiles" the final output by iterating over
     the relevant windows.
+
+    The windows are kept in a PieceTree rather than in a flat list, so that
+    neither of these operations needs to visit windows unrelated to the edited
+    or requested range. The tree also keeps the total size and the offsets of
+    windows up to date as edits happen.
+
+    Every edit produces a new Snapshot of the content and leaves the old one
+    intact. The buffer keeps a History of them, which is what undo and redo
+    move around. Snapshots can also be read while the buffer is being edited,
+    which is how saving works in the background. Each snapshot also knows
+    which of its ranges changed, through a third tree that is edited along
+    with the windows.
+
+    Editing the same area over and over leaves many small windows behind. The
+    buffer merges them once their number doubles since the last time it did,
+    provided there are at least compact_min_windows of them. In-memory
+    windows are merged up to compact_buffer_size bytes.
+
+    Once the content inserted since the last check exceeds memory_budget
+    bytes, the in-memory windows of all the snapshots are spilled to a
+    ScratchFile, except for the ones around the latest edit.
+
+    A buffer can cover just a part of a file, given by offset and length. If
+    the size of the file can't be told upfront, the buffer reads it in parts
+    of at least load_size bytes as they are requested through load(). Such
+    buffers, as well as the ones for devices, can only be saved back to their
+    file in place.
+
+    The file might change behind the buffer's back. check_file() tells
+    whether it did, and rebase() switches the buffer to the new version while
+    keeping the edits. To tell which edits ended up on top of changed content,
+    every edit first remembers digests of the file blocks of
+    digest_block_size bytes around it.
+
+    Every change to the content bumps the version of the buffer, and the
+    buffer remembers the ranges that the last max_journal_size changes
+    edited, which get_edit_since() merges. This lets whatever mirrors the
+    content, such as a MatchIndex, catch up by looking at the edited range
+    only.
+
+    Setting debug to True makes the buffer verify the tree after every edit.
     '''
 
-    def __init__(self, path=None):
-        if not path:
-            self._windows = []
-            self._path = None
+    debug = False
+    compact_min_windows = 256
+    compact_buffer_size = 64*1024
+    memory_budget = 256*1024*1024
+    load_size = 1024*1024
+    digest_block_size = 4096
+    max_journal_size = 1024
+
+    SAVE_REWRITE = 'rewrite'
+    SAVE_INPLACE = 'inplace'
+
+    # edits spanning more than this only have the blocks at their ends
+    # digested, rather than every block in between
+    _MAX_DIGESTED_SIZE = 64*1024
+
+    # rough memory footprint of one tree node along with its window, used to
+    # estimate how much memory the undo history holds onto
+    _NODE_COST = 256
+
+    def __init__(self, path=None, offset=0, length=None):
+        self._snapshot = Snapshot()
+        self._history = History(self._snapshot)
+        self._source = None
+        self._old_sources = []
+        self._path = path or None
+        self._offset = offset
+        self._length = length
+        self._loaded_size = 0
+        self._complete = True
+        self._partial = False
+        self._compacted_window_count = 0
+        self._scratch_file = None
+        self._memory = 0
+        self._disk_signature = None
+        self._digests = {}
+        self._in_place_save = None
+        self._version = 0
+        self._journal = collections.deque(maxlen=self.max_journal_size)
+        if path:
+            self._open(path)
+        if self.debug:
+            self.check_consistency()
+
+    def _open(self, path):
+        if stat.S_ISFIFO(os.stat(path).st_mode):
+            raise RuntimeError('Cannot open %r: not seekable' % path)
+        handle = open(path, 'rb')
+        try:
+            os.lseek(handle.fileno(), 0, os.SEEK_CUR)
+        except OSError:
+            handle.close()
+            raise RuntimeError('Cannot open %r: not seekable' % path)
+        self._source = FileSource(handle)
+        self._disk_signature = _get_signature(path)
+        self._partial = bool(self._offset) \
+            or self._length is not None \
+            or not stat.S_ISREG(os.fstat(handle.fileno()).st_mode)
+        file_size = _get_file_size(handle)
+        if file_size is None:
+            self._complete = False
+            self.load(1)
             return
-        self._handle = open(path, 'rb')
-        self._path = path
-        self._handle.seek(0, os.SEEK_END)
-        size = self._handle.tell()
-        self._handle.seek(0, os.SEEK_SET)
-        self._windows = [FileContentWindow(0, size, self._handle, 0)]
-
-    def __destroy__(self):
-        self._handle.close()
+        size = max(0, file_size - self._offset)
+        if self._length is not None:
+            size = min(size, self._length)
+        if size:
+            self._append_source_content(size)
 
-    def insert(self, offset, new_content):
-        ''' Inserts new content at a specified position. '''
-        self._insert(offset, new_content)
-        self._optimize_windows()
+    @classmethod
+    def from_stream(cls, source):
+        '''
+        Creates a buffer for the content of a StreamSource. The buffer grows
+        with every call to refresh() as long as the source receives content.
+        '''
+        file_buffer = cls()
+        file_buffer._source = source
+        file_buffer._complete = False
+        file_buffer._partial = True
+        file_buffer.refresh()
+        return file_buffer
 
-    def _insert(self, offset, new_content):
-        assert offset in Window(0, self.size)
-        if not new_content:
+    def refresh(self):
+        '''
+        Adds the content that the StreamSource of the buffer received since
+        the last call. Returns whether the buffer grew.
+        '''
+        if self._complete or not isinstance(self._source, StreamSource):
+            return False
+        finished = self._source.finished
+        available_size = self._source.size - self._loaded_size
+        self._complete = finished
+        if not available_size:
+            return False
+        self._append_source_content(available_size)
+        return True
+
+    def grow(self):
+        '''
+        Adds the content appended to a regular file since it was opened or
+        last grown. The new range extends the last window of every snapshot,
+        so this costs the same however big the file is. A file that shrank is
+        left alone. Returns whether the buffer grew.
+        '''
+        if not self._complete or not isinstance(self._source, FileSource):
+            return False
+        status = os.fstat(self._source.fileno())
+        if not stat.S_ISREG(status.st_mode):
+            return False
+        size = max(0, status.st_size - self._offset)
+        if self._length is not None:
+            size = min(size, self._length)
+        if size <= self._loaded_size:
+            return False
+        # the cache might hold the old last block, cut short by the old end
+        self._source.invalidate()
+        self._append_source_content(size - self._loaded_size)
+        self._disk_signature = _get_signature(self._path)
+        return True
+
+    def check_file(self):
+        '''
+        Returns whether the file was changed, replaced or deleted by someone
+        else since the buffer last read or saved it.
+        '''
+        if not self._path or not isinstance(self._source, FileSource):
+            return False
+        return _get_signature(self._path) != self._disk_signature
+
+    def rebase(self):
+        '''
+        Switches the buffer and its history to the current version of the
+        file, keeping the edits. The content that wasn't edited comes from the
+        new version, at the same file offsets as before. Nothing is read other
+        than the blocks around the edits.
+
+        Returns the (start, end) ranges of file offsets where the file changed
+        under or right next to the edits. Raises RuntimeError if the file no
+        longer has the part that the buffer covers, in which case reload() is
+        the way to go.
+        '''
+        if not self._path or not isinstance(self._source, FileSource):
+            raise RuntimeError('Buffer has no file')
+        try:
+            handle = open(self._path, 'rb')
+        except OSError as ex:
+            raise RuntimeError('Cannot open %r: %s' % (self._path, ex))
+        file_size = _get_file_size(handle)
+        if file_size is not None \
+                and file_size < self._offset + self._loaded_size:
+            handle.close()
+            raise RuntimeError(
+                '%r got shorter, use :e! to reload it' % self._path)
+        self._source.reopen(handle)
+        self._disk_signature = _get_signature(self._path)
+        # there's no telling where the file changed without reading it all
+        self._forget_edits()
+        changed_blocks = []
+        for block, digest in sorted(self._digests.items()):
+            new_digest = self._digest_block(block)
+            if new_digest != digest:
+                changed_blocks.append(block)
+                self._digests[block] = new_digest
+        self.grow()
+        return _merge_blocks(changed_blocks, self.digest_block_size)
+
+    def reload(self):
+        ''' Reads the file again, discarding the edits and the history. '''
+        if not self._path:
+            raise RuntimeError('Buffer has no file')
+        self.close()
+        self._snapshot = Snapshot()
+        self._history = History(
+            self._snapshot, self._history.max_steps, self._history.max_memory)
+        self._in_place_save = None
+        self._loaded_size = 0
+        self._complete = True
+        self._compacted_window_count = 0
+        self._memory = 0
+        self._digests = {}
+        self._forget_edits()
+        self._open(self._path)
+
+    def _digest_edited_blocks(self, offset, size):
+        '''
+        Remembers the digests of the file blocks that an edit of a given
+        range touches, along with the bytes right next to it, unless they were
+        remembered before.
+        '''
+        if not self._path or not isinstance(self._source, FileSource):
             return
-        for i, window in enumerate(self._windows):
-            if window.start_offset == offset:
-                self._windows.insert(i, BufferContentWindow(offset, new_content))
-                for j in range(i+1, len(self._windows)):
-                    self._windows[j].start_offset += len(new_content)
-                return
-            if window.end_offset == offset:
-                self._windows.insert(i+1, BufferContentWindow(offset, new_content))
-                for j in range(i+2, len(self._windows)):
-                    self._windows[j].start_offset += len(new_content)
-                return
-            if offset in window:
-                self._windows[i] = window.clone(
-                    window.start_offset, offset - window.start_offset)
-                self._windows.insert(
-                    i + 1, BufferContentWindow(offset, new_content))
-                self._windows.insert(
-                    i + 2, window.clone(
-                        offset, window.size - (offset - window.start_offset)))
-                for j in range(i+2, len(self._windows)):
-                    self._windows[j].start_offset += len(new_content)
-                return
-        self._windows.append(BufferContentWindow(offset, new_content))
+        start = max(0, offset - 1)
+        end = min(self.size, offset + size + 1)
+        if end - start > self._MAX_DIGESTED_SIZE:
+            spans = [(start, 1), (end - 1, 1)]
+        else:
+            spans = [(start, end - start)]
+        for span_offset, span_size in spans:
+            for window, window_offset, chunk_size \
+                    in self._snapshot.tree.iter_range(span_offset, span_size):
+                if not isinstance(window, FileContentWindow) \
+                        or window.source is not self._source:
+                    continue
+                file_offset = window.file_offset + window_offset
+                for block in range(
+                        file_offset // self.digest_block_size,
+                        (file_offset + chunk_size - 1)
+                        // self.digest_block_size + 1):
+                    if block not in self._digests:
+                        self._digests[block] = self._digest_block(block)
+
+    def _digest_block(self, block):
+        offset = block * self.digest_block_size
+        content = self._source.read(offset, self.digest_block_size)
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+    def load(self, size):
+        '''
+        Reads more of a file whose size couldn't be told upfront, until the
+        buffer is at least of a given size or the file ends. Returns whether
+        the buffer grew. Buffers of streams only get what they already
+        received.
+        '''
+        if self._complete or size <= self.size:
+            return False
+        if isinstance(self._source, StreamSource):
+            return self.refresh()
+        load_size = max(size - self.size, self.load_size)
+        if self._length is not None:
+            load_size = min(load_size, self._length - self._loaded_size)
+        available_size = self._source.probe(
+            self._offset + self._loaded_size, load_size)
+        if available_size < load_size or load_size == 0 \
+                or self._loaded_size + available_size == self._length:
+            self._complete = True
+        if not available_size:
+            return False
+        self._source.invalidate()
+        self._append_source_content(available_size)
+        return True
+
+    def _append_source_content(self, size):
+        '''
+        Adds the next size bytes of the source at the end of the buffer, in
+        every snapshot of the history, since they are new to all of them.
+        '''
+        window = FileContentWindow(
+            0, size, self._source, self._offset + self._loaded_size)
+        self._loaded_size += size
+        old_size = self.size
+        self._history.map(lambda snapshot: snapshot.append(window))
+        self._set_snapshot(self._history.snapshot, (old_size, 0, size))
+
+    def close(self):
+        '''
+        Closes the file and the scratch file of the buffer, if any, as well as
+        the older versions of the file that the history kept open.
+        '''
+        for source in self._old_sources:
+            source.close()
+        self._old_sources = []
+        if self._source:
+            self._source.close()
+            self._source = None
+        if self._scratch_file:
+            self._scratch_file.close()
+            self._scratch_file = None
+
+    def insert(self, offset, new_content, coalesce=False):
+        '''
+        Inserts new content at a specified position.
+
+        With coalesce, content that lands right after the end of an in-memory
+        window created the same way is appended to that window instead of
+        becoming a new one. This is meant for byte-by-byte input, which is
+        why such edits also end up in a single undo step as long as each one
+        continues where the previous one ended.
+        '''
+        self._digest_edited_blocks(offset, 0)
+        self._commit(
+            self._snapshot.insert(offset, new_content, coalesce),
+            (offset, 0, len(new_content)),
+            len(new_content),
+            coalesce)
 
     def delete(self, offset, size):
         ''' Deletes a part of content at a specified position. '''
-        self._delete(Window(offset, min(self.size - offset, size)))
-        self._refresh_offsets()
-        self._optimize_windows()
+        self._digest_edited_blocks(offset, size)
+        self._commit(
+            self._snapshot.delete(offset, size),
+            (offset, min(size, self.size - offset), 0),
+            0,
+            False)
 
-    def _delete(self, window):
-        assert window.start_offset in Window(0, self.size)
-        assert window.end_offset in Window(0, self.size)
-        if not window.size:
-            return
-        min_range_idx = None
-        max_range_idx = None
-        for i, other_window in enumerate(self._windows):
-            if window.start_offset in other_window and min_range_idx is None:
-                min_range_idx = i
-            if window.end_offset in other_window:
-                max_range_idx = i
-
-        if min_range_idx == max_range_idx:
-            chosen_window = self._windows[min_range_idx]
-            left_range = chosen_window.clone(
-                chosen_window.start_offset,
-                window.start_offset - chosen_window.start_offset)
-            right_range = chosen_window.clone(
-                window.end_offset,
-                chosen_window.end_offset - window.end_offset)
-            self._windows.pop(min_range_idx)
-            self._windows.insert(min_range_idx, left_range)
-            self._windows.insert(min_range_idx + 1, right_range)
+    def replace(self, offset, new_content, coalesce=False):
+        '''
+        Overrides content with new content at a specified position.
+        See insert() for the meaning of coalesce.
+
+        Content that fits within the buffer goes to the overlay, which leaves
+        the windows untouched. Otherwise, this deletes the old content and
+        inserts the new one.
+        '''
+        self._digest_edited_blocks(offset, len(new_content))
+        self._commit(
+            self._snapshot.replace(offset, new_content, coalesce),
+            (offset, min(len(new_content), self.size - offset), len(new_content)),
+            len(new_content),
+            coalesce)
+
+    def apply_edits(self, edits):
+        '''
+        Applies a list of (offset, size, new_content) edits as one change,
+        each replacing size bytes at given offset with new content. The edits
+        must be sorted by offset and must not overlap. Offsets refer to the
+        content before any of the edits.
+
+        Edits that keep the size go to the overlay, like replace() does. The
+        edits are applied from the last one, so that none of them moves the
+        ones still to be applied, and the result is recorded in the history
+        as a single change, which undo reverts at once.
+        '''
+        end_offset = 0
+        for offset, size, new_content in edits:
+            if offset < end_offset or size < 0:
+                raise RuntimeError('Edits must be sorted and must not overlap')
+            end_offset = offset + size
+        if end_offset > self.size:
+            raise RuntimeError('Edit past the end of the buffer')
+        snapshot = self._snapshot
+        content_size = 0
+        size_change = 0
+        for offset, size, new_content in reversed(edits):
+            self._digest_edited_blocks(offset, size)
+            if size == len(new_content):
+                snapshot = snapshot.replace(offset, new_content)
+            else:
+                snapshot = snapshot \
+                    .delete(offset, size) \
+                    .insert(offset, new_content)
+            content_size += len(new_content)
+            size_change += len(new_content) - size
+        if edits:
+            offset = edits[0][0]
+            self._commit(
+                snapshot,
+                (offset, end_offset - offset, end_offset - offset + size_change),
+                content_size,
+                False,
+                len(edits))
+
+    def _commit(self, snapshot, edit, content_size, coalesce, edit_count=1):
+        if snapshot is self._snapshot:
             return
+        offset = edit[0]
+        cost = content_size + self._NODE_COST * 3 * edit_count \
+            * (len(snapshot.tree) + 1).bit_length()
+        self._history.record(snapshot, edit, cost, coalesce)
+        self._set_snapshot(snapshot, edit)
+        if snapshot.window_count >= max(
+                self.compact_min_windows, 2 * self._compacted_window_count):
+            self.compact()
+        self._memory += content_size
+        if self._memory > self.memory_budget:
+            self._spill(offset + content_size)
 
-        if min_range_idx is not None:
-            min_range = self._windows[min_range_idx]
-            min_range = min_range.clone(
-                min_range.start_offset, window.start_offset - min_range.start_offset)
-            self._windows[min_range_idx] = min_range
-
-        if max_range_idx is not None:
-            max_range = self._windows[max_range_idx]
-            delta = window.start_offset + window.size - max_range.start_offset
-            if delta != max_range.size:
-                max_range = max_range.clone(
-                    max_range.start_offset + delta, max_range.size - delta)
-            self._windows[max_range_idx] = max_range
-
-        self._windows = [
-            other_window for other_window in self._windows \
-                if other_window.start_offset not in window \
-                or other_window.end_offset not in window]
-
-    def _refresh_offsets(self):
-        offset = 0
-        for window in self._windows:
-            window.start_offset = offset
-            offset += window.size
+    def _spill(self, hot_offset):
+        '''
+        Moves in-memory windows of all the snapshots in the history to the
+        scratch file, except for the windows of the current snapshot that
+        touch a given offset.
+        '''
+        hot_windows = []
+        for tree in [self._snapshot.tree, self._snapshot.overlay]:
+            for probe_offset in [hot_offset - 1, hot_offset]:
+                if tree and probe_offset in range(tree.size):
+                    hot_windows.append(tree.find(probe_offset)[0])
+        trees = []
+        for snapshot in self._history:
+            trees.append(snapshot.tree)
+            if snapshot.overlay:
+                trees.append(snapshot.overlay)
+        self._memory = 0
+        for window in iter_unique_pieces(trees):
+            if not isinstance(window, BufferContentWindow) or window.spilled:
+                continue
+            if any(window is hot_window for hot_window in hot_windows):
+                self._memory += window.size
+                continue
+            if not self._scratch_file:
+                self._scratch_file = ScratchFile()
+            window.spill(self._scratch_file)
+
+    def compact(self):
+        '''
+        Merges adjacent windows where possible, without affecting the content
+        or the history. Returns the number of windows before and after.
+        '''
+        old_window_count = self._snapshot.window_count
+        snapshot = self._snapshot.compact(self.compact_buffer_size)
+        if snapshot is not self._snapshot:
+            self._replace_snapshot(snapshot)
+        self._compacted_window_count = snapshot.window_count
+        return old_window_count, snapshot.window_count
+
+    def _set_snapshot(self, snapshot, edit=None):
+        self._snapshot = snapshot
+        if edit is not None:
+            self._version += 1
+            self._journal.append(edit)
+        if self.debug:
+            self.check_consistency()
+
+    def undo(self, count=1):
+        '''
+        Reverts a given number of changes. Returns the offset of the earliest
+        change reverted. Raises RuntimeError if there's nothing to undo.
+        '''
+        return self._move_in_history(self._history.undo, count)
+
+    def redo(self, count=1):
+        '''
+        Reapplies a given number of reverted changes. Returns the offset of
+        the latest change reapplied. Raises RuntimeError if there's nothing to
+        redo.
+        '''
+        return self._move_in_history(self._history.redo, count)
 
-    def _optimize_windows(self):
-        self._windows = [window for window in self._windows if window.size > 0]
+    def undo_to_number(self, number):
+        '''
+        Brings the content to the state right after the change with a given
+        number, as listed by History. Returns the offset of the change undone
+        or redone last, or None if nothing changed.
+        '''
+        return self._move_in_history(self._history.go_to_number, number)
 
-    def replace(self, offset, new_content):
-        ''' Overrides content with new content at a specified position. '''
-        self.delete(offset, len(new_content))
-        self.insert(offset, new_content)
+    def undo_to_time(self, timestamp):
+        '''
+        Brings the content to the state it had at a given Unix timestamp, as
+        far as the history allows. Returns the offset of the change undone or
+        redone last, or None if nothing changed.
+        '''
+        return self._move_in_history(self._history.go_to_time, timestamp)
+
+    def _move_in_history(self, func, *args):
+        if self._in_place_save:
+            raise RuntimeError('Cannot undo or redo while saving in place')
+        number = self._history.number
+        offset = func(*args)
+        self._set_snapshot(
+            self._history.snapshot, self._history.get_edit(number))
+        return offset
+
+    def _forget_edits(self):
+        ''' Makes get_edit_since() give up on the versions so far. '''
+        self._version += 1
+        self._journal.clear()
+
+    def get_edit_since(self, version):
+        '''
+        Returns the edit that turned the content at a given version into the
+        current one, as an (offset, size, new_size) triple: the range of given
+        size at given offset became the range of new_size bytes. Returns None
+        for the current version, as well as when the edits since a given
+        version are no longer known, in which case anything could have
+        changed.
+        '''
+        count = self._version - version
+        if not count or count > len(self._journal):
+            return None
+        edit = None
+        for next_edit in itertools.islice(
+                self._journal, len(self._journal) - count, None):
+            edit = merge_edits(edit, next_edit)
+        return edit
+
+    def check_consistency(self):
+        '''
+        Verifies the internal structure of the buffer, raising AssertionError
+        if anything is off. This is slow and meant for debugging only.
+        '''
+        self._snapshot.check_consistency()
+        assert self._snapshot is self._history.snapshot, 'Bad history'
 
     def get(self, offset, size):
-        ''' Retrieves content at specified position and size. '''
-        return self._get(Window(offset, size))
-
-    def _get(self, window):
-        buffer = b''
-        left = window.size
-        for other_window in self._windows:
-            if window.start_offset in other_window:
-                to_get = min(
-                    other_window.size \
-                        + other_window.start_offset \
-                        - window.start_offset,
-                    left)
-                buffer += other_window.get(window.start_offset, to_get)
-                left -= to_get
-            elif window.end_offset in other_window:
-                to_get = min(other_window.size, left)
-                buffer += other_window.get(other_window.start_offset, to_get)
-                left -= to_get
-            else:
-                if other_window.start_offset in window \
-                        and other_window.end_offset in window:
-                    buffer += other_window.get(
-                        other_window.start_offset, other_window.size)
-                    left -= other_window.size
-            if not left:
-                break
-        assert len(buffer) == window.size
-        return buffer
+        '''
+        Retrieves content at specified position and size.
+        The result is a bytes-like object, which might be a memoryview.
+        '''
+        return self._snapshot.get(offset, size)
+
+    def get_into(self, offset, buffer):
+        '''
+        Fills a writable buffer (such as a bytearray) with the content at
+        specified position. Returns the number of bytes written, which is less
+        than the buffer size only if the content ends before filling it.
+        '''
+        return self._snapshot.get_into(offset, buffer)
+
+    def iter_chunks(self, offset, size, chunk_size=None):
+        '''
+        Yields bytes-like chunks that together make up the content at specified
+        position and size, without joining them. Each window contributes at
+        least one chunk; with chunk_size, no chunk is bigger than that.
+        '''
+        return self._snapshot.iter_chunks(offset, size, chunk_size)
+
+    def get_windows(self):
+        '''
+        Returns the list of content windows, in order. Windows partially
+        covered by the overlay are cut to the parts that show through it.
+        '''
+        return self._snapshot.get_windows()
+
+    def get_patches(self):
+        '''
+        Returns the list of (offset, content) pairs describing the content
+        overwritten in place, in order.
+        '''
+        return self._snapshot.get_patches()
+
+    def get_changes(self, offset=0, size=None):
+        '''
+        Returns the list of (start, end) ranges of content changed since the
+        file was read or saved, in order, limited to the ones that intersect a
+        given range. A deletion counts as a change of the byte that took the
+        place of the deleted content.
+        '''
+        return self._snapshot.get_changes(offset, size)
+
+    def find_change(self, offset, forward=True):
+        '''
+        Returns the (start, end) range of the nearest change that starts after
+        a given offset, or before it if not going forward, or None if there's
+        no such change. This is O(log n).
+        '''
+        return self._snapshot.find_change(offset, forward)
+
+    def is_modified(self):
+        '''
+        Returns whether the content differs from what was read or last saved.
+        Undoing back to that state makes the buffer unmodified again.
+        '''
+        return not self._history.saved
+
+    def get_snapshot(self):
+        ''' Returns the current content as a Snapshot. This is O(1). '''
+        return self._snapshot
+
+    def get_version(self):
+        ''' Returns a number that grows with every change to the content. '''
+        return self._version
+
+    def get_history(self):
+        ''' Returns the History of the content. '''
+        return self._history
 
     def get_path(self):
         ''' Returns the path to the file. '''
@@ -282,26 +1703,167 @@ class FileBuffer(object):
 
     def get_size(self):
         ''' Returns the file size. '''
-        return sum(window.size for window in self._windows)
+        return self._snapshot.size
 
-    def save_to_file(self, target_path, overwrite):
+    def get_offset(self):
+        ''' Returns the offset of the part of the file the buffer covers. '''
+        return self._offset
+
+    def get_length(self):
+        ''' Returns the maximum length of the part the buffer covers. '''
+        return self._length
+
+    def is_complete(self):
+        ''' Returns whether the buffer has loaded all it can. '''
+        return self._complete
+
+    def get_source(self):
+        ''' Returns the FileSource or the StreamSource of the buffer. '''
+        return self._source
+
+    def save_to_file(
+            self, target_path, overwrite, mode=SAVE_REWRITE, progress=None):
+        '''
+        Saves the content to a given path.
+
+        By default, the content is written to a temporary file that then
+        replaces the target. With mode set to SAVE_INPLACE, saving the buffer
+        back to its own file writes only the overwritten extents directly into
+        it, provided that nothing was inserted or deleted. In any other case,
+        this falls back to the default behavior.
+
+        See SaveOperation.run() for the meaning of progress.
+        '''
+        operation = self.prepare_save(target_path, overwrite, mode)
+        try:
+            operation.run(progress)
+        except BaseException:
+            operation.abandon()
+            raise
+        operation.finish()
+
+    def prepare_save(self, target_path, overwrite, mode=SAVE_REWRITE):
+        '''
+        Checks whether the content can be saved to a given path and returns a
+        SaveOperation that saves the content the buffer has right now. The
+        operation can run on another thread while the buffer is being edited.
+        It has to be either finished or abandoned.
+
+        Saving in place changes what the older states in the history read,
+        so there can't be any undoing or redoing until the operation is
+        finished or abandoned, nor another save in place.
+        '''
         assert target_path
-        buffer_size = 8192
-        size = self.size
-        saving_to_itself = os.path.exists(target_path) \
+        if mode not in [self.SAVE_REWRITE, self.SAVE_INPLACE]:
+            raise RuntimeError('Bad save mode: %r' % mode)
+        saving_to_itself = self.path is not None \
+            and os.path.exists(target_path) \
             and os.path.samefile(target_path, self.path)
         if not overwrite and os.path.exists(target_path) \
                 and not saving_to_itself:
             raise RuntimeError(
                 ('File %r already exists, use :w! to overwrite' % target_path))
-        temporary_path = target_path + '.hexvi-tmp'
-        with open(temporary_path, 'wb') as handle:
-            for offset in range(0, size, buffer_size):
-                handle.write(self.get(offset, min(buffer_size, size - offset)))
-        shutil.move(temporary_path, target_path)
-        if saving_to_itself:
-            self._handle = open(target_path, 'rb')
+        in_place = saving_to_itself \
+            and (mode == self.SAVE_INPLACE or self._partial) \
+            and self._is_pristine()
+        if saving_to_itself and self._partial and not in_place:
+            raise RuntimeError(
+                'Cannot insert or delete when saving back to %r' % target_path)
+        if in_place and self._in_place_save:
+            raise RuntimeError('Already saving %r in place' % target_path)
+        operation = SaveOperation(
+            self,
+            self._snapshot,
+            target_path,
+            saving_to_itself,
+            self._source if in_place else None,
+            self._offset)
+        if in_place:
+            self._in_place_save = operation
+        return operation
+
+    def _is_pristine(self):
+        '''
+        Returns whether the windows map the source file one to one, i.e.
+        whether all the changes, if any, are in the overlay.
+        '''
+        if not isinstance(self._source, FileSource):
+            return False
+        # a rewrite save renames another file over the one that's open
+        status = os.fstat(self._source.fileno())
+        try:
+            if not os.path.samestat(status, os.stat(self._path)):
+                return False
+        except OSError:
+            return False
+        size = self._loaded_size
+        if not self._partial:
+            size = status.st_size
+        tree = self._snapshot.tree
+        if not size:
+            return not tree
+        if len(tree) != 1:
+            return False
+        window = next(iter(tree))
+        return isinstance(window, FileContentWindow) \
+            and window.source is self._source \
+            and window.file_offset == self._offset \
+            and window.size == size
+
+    def _finish_save(self, operation):
+        '''
+        Rebinds the buffer to the file it was just saved to, unless it was
+        edited in the meantime.
+
+        Saving in place changes the file that the older states in the history
+        read from, so the history is cleared in that case.
+        '''
+        self._abandon_save(operation)
+        if operation.in_place:
+            self._history = History(
+                self._snapshot,
+                self._history.max_steps,
+                self._history.max_memory)
+        if operation.saving_to_itself:
+            self._disk_signature = _get_signature(operation.target_path)
+            self._digests = {}
+            self._history.mark_saved(operation.snapshot)
+        if not operation.saving_to_itself \
+                or self._snapshot is not operation.snapshot:
+            return
+        if operation.in_place:
+            self._replace_snapshot(Snapshot(self._snapshot.tree, None))
+            return
+        # the older states in the history still read from the old file
+        if self._source:
+            self._old_sources.append(self._source)
+        self._source = FileSource(open(operation.target_path, 'rb'))
+        self._loaded_size = operation.size
+        self._complete = True
+        tree = PieceTree()
+        if operation.size:
+            tree = tree.insert(
+                0, FileContentWindow(0, operation.size, self._source, 0))
+        self._replace_snapshot(Snapshot(tree, None))
+
+    def _abandon_save(self, operation):
+        if self._in_place_save is operation:
+            self._in_place_save = None
+
+    def _replace_snapshot(self, snapshot):
+        ''' Swaps the current state for one with identical content. '''
+        self._history.replace_current(snapshot)
+        self._set_snapshot(snapshot)
 
     size = property(get_size)
     path = property(get_path)
-    windows = property(lambda self: self._windows)
+    windows = property(get_windows)
+    patches = property(get_patches)
+    snapshot = property(get_snapshot)
+    history = property(get_history)
+    version = property(get_version)
+    offset = property(get_offset)
+    length = property(get_length)
+    complete = property(is_complete)
+    modified = property(is_modified)
+    source = property(get_source)
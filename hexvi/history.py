@@ -0,0 +1,277 @@
+'''
+Exports History.
+This is what FileBuffer uses to implement undo and redo.
+'''
+
+import time
+
+def merge_edits(edit, next_edit):
+    '''
+    Merges two edits made one after another into one that spans both. Edits
+    are (offset, size, new_size) triples, telling that the range of given
+    size at given offset became a range of new_size bytes. The offsets of
+    the next edit refer to the content after the first one. Either edit can
+    be None, which stands for no edit at all.
+    '''
+    if edit is None or next_edit is None:
+        return edit or next_edit
+    offset, size, new_size = edit
+    next_offset, next_size, next_new_size = next_edit
+    start = min(offset, next_offset)
+    # the end of the merged range in the content between the two edits
+    end = max(offset + new_size, next_offset + next_size)
+    return (
+        start,
+        end - new_size + size - start,
+        end - next_size + next_new_size - start)
+
+def _invert_edit(edit):
+    offset, size, new_size = edit
+    return offset, new_size, size
+
+class _Step(object):
+    '''
+    One state of the history, along with the change that led to it, as the
+    offset of the change and the edit that spans it, and the estimated amount
+    of memory that change made it hold onto.
+    '''
+    __slots__ = [
+        'snapshot', 'number', 'offset', 'end_offset', 'edit', 'time', 'cost']
+
+    def __init__(self, snapshot, number, offset, end_offset, edit, cost):
+        self.snapshot = snapshot
+        self.number = number
+        self.offset = offset
+        self.end_offset = end_offset
+        self.edit = edit
+        self.time = time.time()
+        self.cost = cost
+
+class History(object):
+    '''
+    A linear list of buffer states.
+
+    The states are snapshots that share almost everything with each other, so
+    recording one costs as much as the edit that produced it, and moving
+    around the history only swaps them. Making a change while some changes
+    are undone discards those changes.
+
+    Every change gets a number, starting from 1 for the first one; the
+    original state is number 0. Old states are forgotten once there are more
+    than max_steps of them or once the changes they hold onto take more than
+    max_memory bytes. The current state is always kept.
+
+    One of the states can be marked as saved, which tells whether the current
+    state is different from what the file has.
+    '''
+
+    def __init__(self, snapshot, max_steps=1000, max_memory=64*1024*1024):
+        self._steps = [_Step(snapshot, 0, None, None, None, 0)]
+        self._index = 0
+        self._saved_step = self._steps[0]
+        self._memory = 0
+        self._max_steps = max_steps
+        self._max_memory = max_memory
+
+    def record(self, snapshot, edit, cost, coalesce=False):
+        '''
+        Adds a new state produced by a change spanning a given edit, which is
+        an (offset, size, new_size) triple as described in merge_edits().
+
+        With coalesce, a change that starts where the previous one, also made
+        with coalesce, ended is merged into it, so that typing a sequence of
+        bytes can be undone in one go.
+        '''
+        offset = edit[0]
+        end_offset = offset + edit[2]
+        step = self._steps[self._index]
+        for discarded_step in self._steps[self._index+1:]:
+            self._memory -= discarded_step.cost
+        del self._steps[self._index+1:]
+        if coalesce \
+                and step.number \
+                and step is not self._saved_step \
+                and step.end_offset is not None \
+                and step.end_offset == offset:
+            step.snapshot = snapshot
+            step.end_offset = end_offset
+            step.edit = merge_edits(step.edit, edit)
+            step.time = time.time()
+            step.cost += cost
+        else:
+            self._steps.append(_Step(
+                snapshot,
+                step.number + 1,
+                offset,
+                end_offset if coalesce else None,
+                edit,
+                cost))
+            self._index += 1
+        self._memory += cost
+        self._trim()
+
+    def seal(self):
+        ''' Prevents the next change from being merged into the last one. '''
+        self._steps[self._index].end_offset = None
+
+    def mark_saved(self, snapshot):
+        '''
+        Marks the state with a given snapshot as the one that was saved, or
+        forgets the saved state if no state has that snapshot.
+        '''
+        self._saved_step = None
+        for step in self._steps:
+            if step.snapshot is snapshot:
+                self._saved_step = step
+
+    def replace_current(self, snapshot):
+        '''
+        Replaces the current state with an equivalent one, without recording
+        a change.
+        '''
+        self._steps[self._index].snapshot = snapshot
+
+    def map(self, func):
+        '''
+        Replaces every state with func(state). This is meant for changes that
+        don't come from the user, like content appearing at the end of a file.
+        '''
+        for step in self._steps:
+            step.snapshot = func(step.snapshot)
+
+    def undo(self, count=1):
+        '''
+        Goes back by a given number of changes. Returns the offset of the last
+        change undone, or raises RuntimeError if there's nothing to undo.
+        '''
+        if not self._index:
+            raise RuntimeError('Already at oldest change')
+        target_index = max(0, self._index - count)
+        offset = self._steps[target_index + 1].offset
+        self._go_to_index(target_index)
+        return offset
+
+    def redo(self, count=1):
+        '''
+        Goes forward by a given number of changes. Returns the offset of the
+        last change redone, or raises RuntimeError if there's nothing to redo.
+        '''
+        if self._index == len(self._steps) - 1:
+            raise RuntimeError('Already at newest change')
+        self._go_to_index(min(len(self._steps) - 1, self._index + count))
+        return self._steps[self._index].offset
+
+    def go_to_number(self, number):
+        '''
+        Goes to the state right after the change with a given number, or to
+        the original state for 0. Returns the offset of the last change undone
+        or redone.
+        '''
+        for index, step in enumerate(self._steps):
+            if step.number == number:
+                return self._go_to(index)
+        raise RuntimeError('Undo number %d not found' % number)
+
+    def go_to_time(self, timestamp):
+        '''
+        Goes to the most recent state that is not newer than a given Unix
+        timestamp, or to the oldest state available. Returns the offset of the
+        last change undone or redone.
+        '''
+        target_index = 0
+        for index, step in enumerate(self._steps):
+            if step.time <= timestamp:
+                target_index = index
+        return self._go_to(target_index)
+
+    def get_edit(self, number):
+        '''
+        Returns the edit that turns the state right after the change with a
+        given number into the current state, or None if it's the current
+        state. Raises RuntimeError if there's no such change anymore.
+        '''
+        for index, step in enumerate(self._steps):
+            if step.number == number:
+                break
+        else:
+            raise RuntimeError('Undo number %d not found' % number)
+        edit = None
+        for step in self._steps[index+1:self._index+1]:
+            edit = merge_edits(edit, step.edit)
+        for step in reversed(self._steps[self._index+1:index+1]):
+            edit = merge_edits(edit, _invert_edit(step.edit))
+        return edit
+
+    def _go_to(self, index):
+        if index < self._index:
+            return self.undo(self._index - index)
+        if index > self._index:
+            return self.redo(index - self._index)
+        return None
+
+    def _go_to_index(self, index):
+        self._index = index
+        self.seal()
+
+    def _trim(self):
+        while self._index > 0 and (
+                len(self._steps) > self._max_steps + 1
+                or self._memory > self._max_memory):
+            if self._steps.pop(0) is self._saved_step:
+                self._saved_step = None
+            self._memory -= self._steps[0].cost
+            self._steps[0].cost = 0
+            self._index -= 1
+
+    def get_snapshot(self):
+        ''' Returns the current state. '''
+        return self._steps[self._index].snapshot
+
+    def get_number(self):
+        ''' Returns the number of the change that led to the current state. '''
+        return self._steps[self._index].number
+
+    def get_time(self):
+        ''' Returns the time when the current state was recorded. '''
+        return self._steps[self._index].time
+
+    def is_saved(self):
+        ''' Returns whether the current state is the saved one. '''
+        return self._steps[self._index] is self._saved_step
+
+    def get_memory(self):
+        ''' Returns the estimated memory the recorded changes hold onto. '''
+        return self._memory
+
+    def get_max_steps(self):
+        ''' Returns how many changes can be undone at most. '''
+        return self._max_steps
+
+    def set_max_steps(self, value):
+        ''' Limits how many changes can be undone, forgetting older ones. '''
+        self._max_steps = value
+        self._trim()
+
+    def get_max_memory(self):
+        ''' Returns how much memory the recorded changes may hold onto. '''
+        return self._max_memory
+
+    def set_max_memory(self, value):
+        ''' Limits the memory of the changes, forgetting older ones. '''
+        self._max_memory = value
+        self._trim()
+
+    def __len__(self):
+        return len(self._steps)
+
+    def __iter__(self):
+        for step in self._steps:
+            yield step.snapshot
+
+    snapshot = property(get_snapshot)
+    number = property(get_number)
+    time = property(get_time)
+    memory = property(get_memory)
+    saved = property(is_saved)
+    max_steps = property(get_max_steps, set_max_steps)
+    max_memory = property(get_max_memory, set_max_memory)
@@ -0,0 +1,152 @@
+'''
+Background jobs - running slow things on worker threads, so that the UI stays
+responsive.
+'''
+
+import threading
+import time
+import hexvi.events as events
+
+class JobCancelled(Exception):
+    ''' Raised within a job that was asked to stop. '''
+    def __init__(self):
+        super().__init__('Cancelled')
+
+class Job(object):
+    '''
+    A function running on a worker thread.
+
+    The function receives a progress callback, which it should call every now
+    and then with the amount of work done and the total amount of work. This
+    is also where cancellation is delivered, as JobCancelled.
+
+    Once the function is done, poll() calls either on_success with its result
+    or on_failure with the exception it raised, on the main thread.
+
+    Daemon jobs don't keep the program from exiting, which suits functions
+    that might block indefinitely, such as reading a pipe. cancel_all()
+    leaves them alone, since they are stopped by whatever started them.
+
+    Quiet jobs leave reporting errors to on_failure.
+    '''
+
+    def __init__(
+            self,
+            name,
+            func,
+            on_success=None,
+            on_failure=None,
+            key=None,
+            daemon=False,
+            quiet=False):
+        self.name = name
+        self.key = key
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self._func = func
+        self._on_success = on_success
+        self._on_failure = on_failure
+        self._quiet = quiet
+        self._cancelled = threading.Event()
+        self._start_time = None
+        self._thread = threading.Thread(
+            target=self._run, name=name, daemon=daemon)
+
+    def start(self):
+        ''' Starts the worker thread. '''
+        self._start_time = time.time()
+        self._thread.start()
+
+    def cancel(self):
+        ''' Asks the function to stop at its next progress report. '''
+        self._cancelled.set()
+
+    def wait(self):
+        ''' Blocks until the function is done. '''
+        self._thread.join()
+
+    def finish(self):
+        ''' Runs the callbacks. Should be called from the main thread. '''
+        if self.error:
+            if self._on_failure:
+                self._on_failure(self.error)
+            if self._quiet:
+                return
+            style = 'msg-info' if self.cancelled else 'msg-error'
+            events.notify(events.PrintMessage(
+                '%s: %s' % (self.name, self.error), style=style))
+        elif self._on_success:
+            self._on_success(self.result)
+
+    def describe(self):
+        ''' Returns a short progress summary. '''
+        if not self.done:
+            return self.name
+        elapsed = max(time.time() - self._start_time, 1e-3)
+        speed = self.done / elapsed / (1024 * 1024)
+        if not self.total:
+            return '%s (%.1f MiB/s)' % (self.name, speed)
+        return '%s %d%% (%.1f MiB/s)' % (
+            self.name, self.done * 100 // self.total, speed)
+
+    def _run(self):
+        try:
+            self.result = self._func(self._progress)
+        except BaseException as ex:
+            self.error = ex
+
+    def _progress(self, done, total):
+        if self._cancelled.is_set():
+            raise JobCancelled()
+        self.done = done
+        self.total = total
+
+    running = property(lambda self: self._thread.is_alive())
+    daemon = property(lambda self: self._thread.daemon)
+    cancelled = property(lambda self: isinstance(self.error, JobCancelled))
+
+class _JobRegistry(object):
+    ''' The container for the jobs that weren't finished yet. '''
+    _jobs = []
+
+def start(job):
+    ''' Starts a job, unless another job with the same key is running. '''
+    if job.key is not None:
+        for other_job in _JobRegistry._jobs:
+            if other_job.key == job.key:
+                raise RuntimeError('%s: already in progress' % other_job.name)
+    _JobRegistry._jobs.append(job)
+    job.start()
+    events.notify(events.JobChange(job))
+
+def poll():
+    '''
+    Finishes the jobs whose functions are done and reports progress of the
+    others. Should be called periodically from the main thread. Returns
+    whether there are any jobs left.
+    '''
+    for job in _JobRegistry._jobs[:]:
+        if not job.running:
+            _JobRegistry._jobs.remove(job)
+            try:
+                job.finish()
+            except Exception as ex:
+                events.notify(events.PrintMessage(str(ex), style='msg-error'))
+        events.notify(events.JobChange(job))
+    return bool(_JobRegistry._jobs)
+
+def cancel_all():
+    '''
+    Asks all the jobs other than the daemon ones to stop. Returns how many
+    there were.
+    '''
+    cancelled_jobs = [job for job in _JobRegistry._jobs if not job.daemon]
+    for job in cancelled_jobs:
+        job.cancel()
+    return len(cancelled_jobs)
+
+def get_jobs():
+    ''' Returns the jobs that weren't finished yet. '''
+    return _JobRegistry._jobs[:]
@@ -0,0 +1,203 @@
+''' Exports MatchIndex. '''
+
+import array
+import bisect
+import hexvi.jobs as jobs
+
+class MatchIndex(object):
+    '''
+    The sorted offsets of all the matches of a pattern in a file buffer, so
+    that going to the next or previous match is a bisection.
+
+    The index is built in the background by a job. After that, update() has
+    it follow the edits of the buffer: the buffer tells which range was
+    edited since the version the index describes, and only the matches
+    around that range are looked for again. That's the matches that could
+    run to within the searcher's context_size before it, and so look ahead
+    into it, from up to margin bytes further back, and the ones that start up
+    to context_size after it, which might look behind into it.
+    If that takes scanning more than max_sync_update_size bytes, it's done by
+    a job as well, and if it's more than max_update_size, the index is built
+    again.
+
+    A match that starts further than margin bytes before an edit and runs
+    into it is only spotted if it was already indexed, or if the content
+    within the margin looks like it could be a part of one. The index is
+    built again in both cases.
+    '''
+
+    margin = 64*1024
+    max_sync_update_size = 256*1024
+    max_update_size = 16*1024*1024
+    max_matches = 10*1000*1000
+
+    def __init__(self, searcher, file_buffer):
+        self.searcher = searcher
+        self.file_buffer = file_buffer
+        self.job = None
+        self._version = None
+        self._starts = array.array('q')
+        self._ends = array.array('q')
+        self._longest = 0
+
+    def build(self):
+        ''' Starts looking for all the matches in the background. '''
+        snapshot = self.file_buffer.snapshot
+        version = self.file_buffer.version
+
+        def found(result):
+            self._starts, self._ends, self._longest = result
+            self._version = version
+
+        self._version = None
+        self._start_job(
+            'Indexing matches',
+            lambda progress: self._find_matches(snapshot, 0, None, progress),
+            found)
+
+    def update(self):
+        '''
+        Brings the index up to date with the buffer. Returns whether the
+        index can be used, which it can't while it's being built or updated
+        in the background.
+        '''
+        if self._version is None or self.job:
+            return False
+        version = self.file_buffer.version
+        if version == self._version:
+            return True
+        edit = self.file_buffer.get_edit_since(self._version)
+        if edit is None or not self._update(version, *edit):
+            self.build()
+            return False
+        return self.ready
+
+    def find(self, offset, forward=True, count=1):
+        '''
+        Returns the start of the count-th match after or before a given
+        offset and whether there were that many. If there were fewer, returns
+        the furthest one, or None if there were none at all.
+        '''
+        if forward:
+            first = bisect.bisect_right(self._starts, offset)
+            index = min(first + count - 1, len(self._starts) - 1)
+            found = index - first + 1
+        else:
+            first = bisect.bisect_left(self._starts, offset) - 1
+            index = max(first - count + 1, 0)
+            found = first - index + 1
+        if found <= 0:
+            return None, False
+        return self._starts[index], found == count
+
+    def get_number(self, offset):
+        ''' Returns the 1-based number of the match at an offset, or None. '''
+        index = bisect.bisect_left(self._starts, offset)
+        if index < len(self._starts) and self._starts[index] == offset:
+            return index + 1
+        return None
+
+    def get_matches(self, limit=None):
+        ''' Returns the (start, end) ranges of the matches, up to a limit. '''
+        return list(zip(self._starts[:limit], self._ends[:limit]))
+
+    def is_ready(self):
+        ''' Returns whether the index describes the buffer as it is now. '''
+        return self._version == self.file_buffer.version and not self.job
+
+    def __len__(self):
+        return len(self._starts)
+
+    def _start_job(self, name, func, on_success):
+        if self.job:
+            self.job.cancel()
+
+        def found(result):
+            if self.job is job:
+                self.job = None
+                on_success(result)
+                # the buffer might have been edited in the meantime
+                self.update()
+
+        def failed(_error):
+            if self.job is job:
+                self.job = None
+                self._version = None
+
+        job = jobs.Job(
+            name, func, on_success=found, on_failure=failed, daemon=True)
+        self.job = job
+        jobs.start(job)
+
+    def _find_matches(self, snapshot, start, end, progress=None):
+        starts = array.array('q')
+        ends = array.array('q')
+        longest = 0
+        for match_start, match_end in self.searcher.iter_matches(
+                snapshot, start, end, progress):
+            if len(starts) == self.max_matches:
+                raise RuntimeError('Too many matches')
+            starts.append(match_start)
+            ends.append(match_end)
+            longest = max(longest, match_end - match_start)
+        return starts, ends, longest
+
+    def _update(self, version, offset, old_size, new_size):
+        snapshot = self.file_buffer.snapshot
+        context_size = self.searcher.context_size
+        reach_offset = max(0, offset - context_size)
+        margin_start = max(0, reach_offset - self.margin)
+        update_start = self.searcher.find_reach(
+            snapshot, reach_offset, self.margin)
+        update_end = offset + new_size + context_size
+        if margin_start and (
+                update_start == margin_start
+                or self.searcher.reaches_before(
+                    snapshot, margin_start, reach_offset, update_end)):
+            # a match might start even further back
+            return False
+        # the matches that ran into the edited range are gone too
+        for index in range(
+                bisect.bisect_left(
+                    self._starts,
+                    reach_offset - max(self.margin, self._longest)),
+                bisect.bisect_left(self._starts, update_start)):
+            if self._ends[index] >= reach_offset:
+                update_start = self._starts[index]
+                break
+        if update_end - update_start > self.max_update_size:
+            return False
+
+        first = bisect.bisect_left(self._starts, update_start)
+        last = bisect.bisect_left(
+            self._starts, offset + old_size + context_size)
+        shift = new_size - old_size
+
+        def replace_matches(result):
+            starts, ends, longest = result
+            if len(self._starts) - (last - first) + len(starts) \
+                    > self.max_matches:
+                self.build()
+                return
+            self._starts = self._starts[:first] + starts + array.array(
+                'q', (start + shift for start in self._starts[last:]))
+            self._ends = self._ends[:first] + ends + array.array(
+                'q', (end + shift for end in self._ends[last:]))
+            self._longest = max(self._longest, longest)
+            self._version = version
+
+        if update_end - update_start > self.max_sync_update_size:
+            self._start_job(
+                'Indexing matches',
+                lambda progress: self._find_matches(
+                    snapshot, update_start, update_end, progress),
+                replace_matches)
+            return True
+        try:
+            replace_matches(self._find_matches(
+                snapshot, update_start, update_end))
+        except RuntimeError:
+            return False
+        return True
+
+    ready = property(is_ready)
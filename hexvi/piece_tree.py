@@ -0,0 +1,257 @@
+'''
+Exports PieceTree and iter_unique_pieces().
+This is the structure FileBuffer uses to keep track of its content windows.
+'''
+
+import random
+
+def _size(node):
+    return node.size if node else 0
+
+def _count(node):
+    return node.count if node else 0
+
+def _marked(node):
+    return node.marked if node else 0
+
+def _is_marked(piece):
+    return bool(getattr(piece, 'marked', False))
+
+class _Node(object):
+    '''
+    One node of the tree. Nodes are never modified after being created, so
+    that any operation on the tree only needs to copy the path it touches.
+    '''
+    __slots__ = [
+        'piece', 'left', 'right', 'priority', 'size', 'count', 'marked']
+
+    def __init__(self, piece, left, right, priority):
+        self.piece = piece
+        self.left = left
+        self.right = right
+        self.priority = priority
+        self.size = _size(left) + piece.size + _size(right)
+        self.count = _count(left) + 1 + _count(right)
+        self.marked = _marked(left) + _is_marked(piece) + _marked(right)
+
+def _merge(left, right):
+    if not left:
+        return right
+    if not right:
+        return left
+    if left.priority > right.priority:
+        return _Node(
+            left.piece, left.left, _merge(left.right, right), left.priority)
+    return _Node(
+        right.piece, _merge(left, right.left), right.right, right.priority)
+
+def _split(node, offset):
+    if not node:
+        return None, None
+    left_size = _size(node.left)
+    if offset <= left_size:
+        left, right = _split(node.left, offset)
+        return left, _Node(node.piece, right, node.right, node.priority)
+    offset -= left_size
+    if offset >= node.piece.size:
+        left, right = _split(node.right, offset - node.piece.size)
+        return _Node(node.piece, node.left, left, node.priority), right
+    left_piece = node.piece.slice(0, offset)
+    right_piece = node.piece.slice(offset, node.piece.size - offset)
+    return (
+        _Node(left_piece, node.left, None, node.priority),
+        _Node(right_piece, None, node.right, node.priority))
+
+def _find_marked_after(node, offset, node_offset):
+    if not _marked(node):
+        return None
+    piece_offset = node_offset + _size(node.left)
+    if offset < piece_offset:
+        result = _find_marked_after(node.left, offset, node_offset)
+        if result:
+            return result
+    if offset <= piece_offset and _is_marked(node.piece):
+        return piece_offset, node.piece
+    return _find_marked_after(
+        node.right, offset, piece_offset + node.piece.size)
+
+def _find_marked_before(node, offset, node_offset):
+    if not _marked(node):
+        return None
+    piece_offset = node_offset + _size(node.left)
+    if piece_offset < offset:
+        result = _find_marked_before(
+            node.right, offset, piece_offset + node.piece.size)
+        if result:
+            return result
+        if _is_marked(node.piece):
+            return piece_offset, node.piece
+    return _find_marked_before(node.left, offset, node_offset)
+
+def iter_unique_pieces(trees):
+    '''
+    Yields the pieces of all given trees, in no particular order. Trees
+    derived from each other share most of their nodes, which are visited only
+    once, so this takes time proportional to the number of distinct nodes.
+    '''
+    visited = set()
+    stack = [tree._root for tree in trees if tree]
+    while stack:
+        node = stack.pop()
+        if id(node) in visited:
+            continue
+        visited.add(id(node))
+        yield node.piece
+        stack.extend(child for child in [node.left, node.right] if child)
+
+class PieceTree(object):
+    '''
+    An immutable, balanced sequence of pieces (content windows), augmented
+    with subtree sizes.
+
+    It's a treap: nodes are ordered by their position in the file and balanced
+    by random priorities. Each node knows how many bytes its subtree spans,
+    which makes it possible to locate, split, insert and remove pieces in
+    O(log n) without storing absolute offsets anywhere. Pieces only need to
+    have a size and to support slice(offset, size), with the offset relative
+    to the piece start.
+
+    Pieces can also be marked, by having a true marked attribute. Nodes count
+    the marked pieces in their subtrees, so that the nearest marked piece can
+    be found in O(log n) as well.
+
+    Every modifying operation returns a new tree and leaves the old one
+    intact.
+    '''
+
+    def __init__(self, root=None):
+        self._root = root
+
+    def get_size(self):
+        ''' Returns the total size of all the pieces. '''
+        return _size(self._root)
+
+    def __len__(self):
+        return _count(self._root)
+
+    def __bool__(self):
+        return self._root is not None
+
+    def __iter__(self):
+        stack = []
+        node = self._root
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.piece
+            node = node.right
+
+    def split(self, offset):
+        ''' Splits the tree into two trees at a given offset. '''
+        left, right = _split(self._root, offset)
+        return PieceTree(left), PieceTree(right)
+
+    def concat(self, other):
+        ''' Returns a tree that has the other tree's pieces appended. '''
+        return PieceTree(_merge(self._root, other._root))
+
+    def insert(self, offset, piece):
+        ''' Returns a tree with a piece inserted at a given offset. '''
+        left, right = _split(self._root, offset)
+        node = _Node(piece, None, None, random.random())
+        return PieceTree(_merge(_merge(left, node), right))
+
+    def delete(self, offset, size):
+        ''' Returns a tree with a given range removed. '''
+        left, right = _split(self._root, offset)
+        _, right = _split(right, size)
+        return PieceTree(_merge(left, right))
+
+    def replace(self, offset, size, piece):
+        ''' Returns a tree with a given range replaced by a piece. '''
+        left, right = _split(self._root, offset)
+        _, right = _split(right, size)
+        node = _Node(piece, None, None, random.random())
+        return PieceTree(_merge(_merge(left, node), right))
+
+    def find(self, offset):
+        '''
+        Returns the piece that contains a given offset along with the offset
+        relative to the piece start, or (None, 0) if the offset is out of
+        range.
+        '''
+        for piece, piece_offset, _ in self.iter_range(offset, 1):
+            return piece, piece_offset
+        return None, 0
+
+    def iter_range(self, offset, size):
+        '''
+        Yields (piece, offset, size) triples covering a given range, where the
+        offset is relative to the piece start.
+        '''
+        stack = []
+        node = self._root
+        while node:
+            left_size = _size(node.left)
+            if offset < left_size:
+                stack.append(node)
+                node = node.left
+            elif offset < left_size + node.piece.size:
+                offset -= left_size
+                break
+            else:
+                offset -= left_size + node.piece.size
+                node = node.right
+        while node and size > 0:
+            chunk_size = min(node.piece.size - offset, size)
+            yield node.piece, offset, chunk_size
+            size -= chunk_size
+            offset = 0
+            if node.right:
+                node = node.right
+                while node.left:
+                    stack.append(node)
+                    node = node.left
+            else:
+                node = stack.pop() if stack else None
+
+    def find_marked(self, offset, forward=True):
+        '''
+        Returns the first marked piece that starts at or after a given offset,
+        or the last one that starts before it if not going forward, along with
+        the offset where it starts. Returns (None, None) if there's no such
+        piece.
+        '''
+        if forward:
+            result = _find_marked_after(self._root, offset, 0)
+        else:
+            result = _find_marked_before(self._root, offset, 0)
+        return result or (None, None)
+
+    def check_consistency(self):
+        '''
+        Verifies that every node's sizes agree with its subtree and that the
+        nodes respect the heap order of priorities. Raises AssertionError
+        otherwise. This visits every node, so it's meant for debugging only.
+        '''
+        stack = [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            assert node.piece.size > 0, 'Empty piece'
+            assert node.size == \
+                _size(node.left) + node.piece.size + _size(node.right), \
+                'Bad subtree size'
+            assert node.count == _count(node.left) + 1 + _count(node.right), \
+                'Bad subtree count'
+            assert node.marked == _marked(node.left) \
+                + _is_marked(node.piece) \
+                + _marked(node.right), \
+                'Bad marked count'
+            for child in [node.left, node.right]:
+                if child:
+                    assert child.priority <= node.priority, 'Bad priority'
+                    stack.append(child)
+
+    size = property(get_size)
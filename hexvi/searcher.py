@@ -0,0 +1,411 @@
+''' Exports Searcher. '''
+
+import concurrent.futures
+import string
+import threading
+import regex
+from hexvi.app_state import SearchState
+
+_SPECIAL_CHARS = b'.^$*+?{}[]()|\\'
+_WORD_CHARS = (string.ascii_letters + string.digits + '_').encode('ascii')
+
+def _get_literal(pattern):
+    '''
+    Returns the bytes a pattern matches if it matches nothing else, such as
+    for "PNG" or "\\x89PNG\\r\\n", or None otherwise.
+    '''
+    literal = bytearray()
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char not in _SPECIAL_CHARS:
+            literal.append(char)
+            pos += 1
+        elif char != ord('\\') or pos + 1 == len(pattern):
+            return None
+        elif pattern[pos+1] not in _WORD_CHARS:
+            literal.append(pattern[pos+1])
+            pos += 2
+        elif pattern[pos+1:pos+2] in b'nrtfv':
+            literal.append(b'\n\r\t\f\v'[b'nrtfv'.index(pattern[pos+1])])
+            pos += 2
+        elif pattern[pos+1:pos+2] == b'x' \
+                and regex.fullmatch(b'[0-9a-fA-F]{2}', pattern[pos+2:pos+4]):
+            literal.append(int(pattern[pos+2:pos+4], 16))
+            pos += 4
+        else:
+            return None
+    return bytes(literal) or None
+
+class _Stopped(Exception):
+    ''' Raised within a segment search that's no longer needed. '''
+
+class Searcher(object):
+    '''
+    Finds matches of a regular expression in the content of a snapshot.
+
+    The pattern is compiled once, when the searcher is created. The content
+    is read in chunks of chunk_size bytes and each byte is scanned once: the
+    regex module's partial matching tells where a match might continue past
+    the end of a chunk, so only the bytes from there on are carried over to
+    the next one. This means that matches can be of any size. Chunks grow
+    along with the carried bytes, which keeps very long matches from being
+    rescanned over and over.
+
+    Searches also see up to context_size bytes before the chunk, so that
+    lookbehinds and \\b work across chunk boundaries. Likewise, a match that
+    ends less than context_size bytes before the end of a chunk is only
+    trusted once the next chunk is there, in case a lookahead, $ or \\Z
+    would see it differently.
+
+    Backward searches stop at the same matches as forward ones, just in the
+    other direction: they search forward from ever further back, until some
+    match starts before the offset they were given.
+
+    Patterns that match just one byte sequence, such as magic numbers, skip
+    the regex engine: the chunks are scanned with find() and rfind(). Chunks
+    that come straight from a memory-mapped file are scanned in the mapping
+    with mmap.find() and rfind(), and the others are read into a single
+    reused buffer first.
+
+    Regex searches can also run on several threads, as the regex module
+    releases the GIL. Each thread takes a segment and reports the first or
+    the last match that starts in it, reading past the segment only as far as
+    such a match goes.
+    '''
+
+    chunk_size = 4*1024*1024
+    context_size = 256
+    segment_size = 64*1024*1024
+    progress_interval = 0.1
+
+    def __init__(self, pattern):
+        if isinstance(pattern, str):
+            pattern = pattern.encode('utf-8')
+        try:
+            self._forward_regex = regex.compile(pattern)
+            # these find where a match could run past the end of a chunk
+            self._forward_tail_regex = regex.compile(
+                b'(?:' + pattern + b')\\Z')
+            self._backward_head_regex = regex.compile(
+                b'(?r)\\A(?:' + pattern + b')')
+        except regex.error as ex:
+            raise RuntimeError('Bad pattern: %s' % ex)
+        self.pattern = pattern
+        self.literal = _get_literal(pattern)
+
+    def find(self, snapshot, offset, direction, progress=None, workers=1):
+        '''
+        Returns the (start, end) range of the first match that starts at or
+        after a given offset, or of the last one that starts before it when
+        searching backward. Returns None if there's no such match.
+
+        progress, if given, is called with the amount of bytes scanned and
+        the total amount of bytes to scan every now and then; an exception
+        raised from it stops the search.
+
+        With more than one worker, regex searches are split into segments of
+        segment_size bytes, searched on that many threads at once.
+        '''
+        progress = progress or (lambda done, total: None)
+        if workers > 1 and not self.literal:
+            return self._find_parallel(
+                snapshot, offset, direction, progress, workers)
+        if direction == SearchState.DIR_BACKWARD:
+            if self.literal:
+                return self._find_literal_backward(snapshot, offset, progress)
+            return self._find_backward(snapshot, offset, progress)
+        assert direction == SearchState.DIR_FORWARD, 'Bad search direction'
+        if self.literal:
+            return self._find_literal_forward(snapshot, offset, progress)
+        return self._find_forward(snapshot, offset, progress)
+
+    def iter_matches(self, snapshot, offset=0, end=None, progress=None):
+        '''
+        Yields the (start, end) ranges of all the matches that start within a
+        given range, in order, including the ones that overlap. These are
+        the offsets that forward searches can stop at.
+        '''
+        progress = progress or (lambda done, total: None)
+        end = snapshot.size if end is None else min(end, snapshot.size)
+        if self.literal:
+            return self._iter_literal_matches(snapshot, offset, end, progress)
+        return self._iter_matches(snapshot, offset, end, progress)
+
+    def find_reach(self, snapshot, offset, size):
+        '''
+        Returns the lowest offset within a given size before a given offset
+        from which a match could run up to or past that offset, so that
+        changing the content there could change the match.
+        '''
+        start = max(0, offset - size)
+        buffer = snapshot.get(start, offset - start)
+        return start + self._get_carry_start(buffer, 0)
+
+    def reaches_before(self, snapshot, start, offset, end):
+        '''
+        Returns whether a match that ends between a given offset and end
+        could start before a given start, judging from the content between
+        start and end.
+        '''
+        buffer = snapshot.get(start, min(end, snapshot.size) - start)
+        match = self._backward_head_regex.search(
+            buffer, partial=True, concurrent=True)
+        return match is not None and start + match.end() >= offset
+
+    def finditer(self, buffer):
+        ''' Iterates over the matches in a bytes-like object. '''
+        return self._forward_regex.finditer(buffer)
+
+    def _get_carry_start(self, buffer, pos):
+        '''
+        Returns where the earliest match that could run past the end of a
+        buffer starts, or the buffer size if none could, such as with
+        anchored patterns.
+        '''
+        match = self._forward_tail_regex.search(
+            buffer, pos, partial=True, concurrent=True)
+        return match.start() if match else len(buffer)
+
+    def _read_literal_chunk(self, snapshot, offset, size, buffer):
+        '''
+        Returns an object with find() and rfind() that holds the content of
+        given size at a given offset, along with the position of the content
+        in it. Content that comes straight from a mapped file is searched in
+        the mapping, which saves copying it. Anything else is read into a
+        given buffer.
+        '''
+        mapping = snapshot.get_mapping(offset, size)
+        if mapping is not None:
+            return mapping
+        snapshot.get_into(offset, memoryview(buffer)[:size])
+        return buffer, 0
+
+    def _find_literal_forward(self, snapshot, offset, progress):
+        size = snapshot.size
+        overlap = len(self.literal) - 1
+        buffer = bytearray(max(self.chunk_size, overlap + 1) + overlap)
+        read_offset = offset
+        while read_offset < size:
+            read_size = min(len(buffer), size - read_offset)
+            haystack, start = self._read_literal_chunk(
+                snapshot, read_offset, read_size, buffer)
+            pos = haystack.find(self.literal, start, start + read_size)
+            if pos != -1:
+                pos += read_offset - start
+                return pos, pos + len(self.literal)
+            if read_offset + read_size == size:
+                break
+            read_offset += read_size - overlap
+            progress(read_offset - offset, size - offset)
+        return None
+
+    def _find_literal_backward(self, snapshot, offset, progress):
+        offset = min(offset, snapshot.size)
+        overlap = len(self.literal) - 1
+        buffer = bytearray(max(self.chunk_size, overlap + 1) + overlap)
+        # a match only has to start before the offset
+        read_end = min(offset + overlap, snapshot.size)
+        while read_end > overlap:
+            read_offset = max(0, read_end - len(buffer))
+            read_size = read_end - read_offset
+            haystack, start = self._read_literal_chunk(
+                snapshot, read_offset, read_size, buffer)
+            pos = haystack.rfind(self.literal, start, start + read_size)
+            if pos != -1:
+                pos += read_offset - start
+                return pos, pos + len(self.literal)
+            if read_offset == 0:
+                break
+            read_end = read_offset + overlap
+            progress(offset - read_end, offset)
+        return None
+
+    def _iter_literal_matches(self, snapshot, offset, end, progress):
+        size = snapshot.size
+        overlap = len(self.literal) - 1
+        buffer = bytearray(
+            min(max(self.chunk_size, overlap + 1), max(end - offset, 1))
+            + overlap)
+        read_offset = offset
+        while read_offset < end:
+            # nothing past the end is needed, other than to finish a match
+            read_size = min(
+                len(buffer), end - read_offset + overlap, size - read_offset)
+            haystack, start = self._read_literal_chunk(
+                snapshot, read_offset, read_size, buffer)
+            pos = haystack.find(self.literal, start, start + read_size)
+            while pos != -1:
+                match_start = read_offset + pos - start
+                if match_start >= end:
+                    return
+                yield match_start, match_start + len(self.literal)
+                pos = haystack.find(self.literal, pos + 1, start + read_size)
+            if read_offset + read_size == size:
+                return
+            read_offset += read_size - overlap
+            progress(read_offset - offset, end - offset)
+
+    def _iter_matches(self, snapshot, offset, end, progress):
+        size = snapshot.size
+        context_offset = max(0, offset - self.context_size)
+        buffer = bytes(snapshot.get(context_offset, offset - context_offset))
+        search_start = len(buffer)
+        read_offset = offset
+        while True:
+            read_size = min(
+                max(self.chunk_size, len(buffer)), size - read_offset)
+            if read_offset < end:
+                read_size = min(read_size, end - read_offset)
+            buffer += snapshot.get(read_offset, read_size)
+            read_offset += read_size
+            at_end = read_offset == size
+            buffer_offset = read_offset - len(buffer)
+            # matches that start before this are complete and can't change
+            carry_start = len(buffer) + 1 if at_end \
+                else self._get_carry_start(buffer, search_start)
+            for match in self._forward_regex.finditer(
+                    buffer, search_start, overlapped=True, concurrent=True):
+                if match.start() >= carry_start:
+                    break
+                if not at_end \
+                        and match.end() + self.context_size > len(buffer):
+                    carry_start = match.start()
+                    break
+                if buffer_offset + match.start() >= end:
+                    return
+                yield buffer_offset + match.start(), buffer_offset + match.end()
+            if at_end or buffer_offset + carry_start >= end:
+                return
+            progress(read_offset - offset, end - offset)
+            cut = max(0, carry_start - self.context_size)
+            buffer = buffer[cut:]
+            search_start = carry_start - cut
+
+    def _find_parallel(self, snapshot, offset, direction, progress, workers):
+        size = snapshot.size
+        if direction == SearchState.DIR_FORWARD:
+            total = size - offset
+            segments = [
+                (start, start + self.segment_size)
+                for start in range(offset, size, self.segment_size)]
+            search = lambda segment, segment_progress: self._find_forward(
+                snapshot, segment[0], segment_progress, segment[1])
+        else:
+            offset = min(offset, size)
+            total = offset
+            segments = [
+                (end - self.segment_size, end)
+                for end in range(offset, 0, -self.segment_size)]
+            search = lambda segment, segment_progress: self._find_backward(
+                snapshot, segment[1], segment_progress, segment[0])
+        if len(segments) <= 1:
+            return self.find(snapshot, offset, direction, progress)
+        # the outermost segments take whatever lies past the others
+        segments[-1] = (
+            (segments[-1][0], None)
+            if direction == SearchState.DIR_FORWARD
+            else (None, segments[-1][1]))
+
+        stopped = threading.Event()
+        scanned = [0] * len(segments)
+
+        def search_segment(index):
+            def segment_progress(done, _total):
+                if stopped.is_set():
+                    raise _Stopped()
+                scanned[index] = done
+            try:
+                return search(segments[index], segment_progress)
+            except _Stopped:
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(search_segment, index)
+                for index in range(len(segments))]
+            try:
+                # the first segment with a match wins, but only once all the
+                # segments before it are known to have none
+                for future in futures:
+                    while True:
+                        try:
+                            match = future.result(self.progress_interval)
+                            break
+                        except concurrent.futures.TimeoutError:
+                            progress(sum(scanned), total)
+                    if match:
+                        return match
+                return None
+            finally:
+                stopped.set()
+                for future in futures:
+                    future.cancel()
+
+    def _find_forward(self, snapshot, offset, progress, end=None):
+        size = snapshot.size
+        if offset >= size:
+            return None
+        read_limit = size if end is None else end
+        context_offset = max(0, offset - self.context_size)
+        buffer = bytes(snapshot.get(context_offset, offset - context_offset))
+        search_start = len(buffer)
+        read_offset = offset
+        while True:
+            read_size = min(
+                max(self.chunk_size, len(buffer)), size - read_offset)
+            if read_offset < read_limit:
+                read_size = min(read_size, read_limit - read_offset)
+            buffer += snapshot.get(read_offset, read_size)
+            read_offset += read_size
+            at_end = read_offset == size
+            match = self._forward_regex.search(
+                buffer, search_start, partial=not at_end, concurrent=True)
+            buffer_offset = read_offset - len(buffer)
+            if match and not match.partial:
+                # a complete match is preferred to a partial one, so check if
+                # more content could make this match longer or an earlier
+                # one possible, or change what the match sees past its end
+                if not at_end:
+                    carry_start = self._get_carry_start(buffer, search_start)
+                    if match.end() + self.context_size > len(buffer):
+                        carry_start = min(carry_start, match.start())
+                if at_end or carry_start > match.start():
+                    start = buffer_offset + match.start()
+                    if end is not None and start >= end:
+                        return None
+                    return start, buffer_offset + match.end()
+            elif at_end:
+                return None
+            else:
+                carry_start = match.start() if match else len(buffer)
+            if end is not None and buffer_offset + carry_start >= end:
+                return None
+            progress(read_offset - offset, read_limit - offset)
+            cut = max(0, carry_start - self.context_size)
+            buffer = buffer[cut:]
+            search_start = carry_start - cut
+
+    def _find_backward(self, snapshot, offset, progress, start=None):
+        offset = min(offset, snapshot.size)
+        read_limit = 0 if start is None else start
+        total = offset - read_limit
+        # the last match that starts before the offset is the first one after
+        # some point further back, so search forward from ever further back,
+        # in steps that grow up to chunk_size bytes
+        end = offset
+        step = 1
+        step_progress = lambda _done, _total: progress(offset - end, total)
+        while end > read_limit:
+            search_start = max(read_limit, end - step)
+            match = self._find_forward(
+                snapshot, search_start, step_progress, end)
+            if match:
+                for later_match in self.iter_matches(
+                        snapshot, match[0] + 1, end, step_progress):
+                    match = later_match
+                return match
+            end = search_start
+            step = min(step * 2, self.chunk_size)
+            progress(offset - end, total)
+        return None
@@ -7,8 +7,18 @@ class Settings(object):
 
     def __init__(self):
         self.scrolloff = 0
-        self.max_match_size = 8192
+        self.incsearch = 0
+        self.search_workers = 0
+        self.search_index = 0
+        self.cache_size = 16*1024*1024
+        self.savemode = 'rewrite'
+        self.undolevels = 1000
+        self.undo_memory = 64*1024*1024
+        self.memory_budget = 256*1024*1024
         self.term_colors = 16
+        # no longer used, as matches can be of any size, but old hexvirc
+        # files still set it
+        self.max_match_size = 8192
 
         self.mode_chars = {}
         for mode in AppState.NON_COMMAND_MODES:
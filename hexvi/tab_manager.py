@@ -1,10 +1,45 @@
 ''' Exports TabManager. '''
 
 import os.path
+import sys
+import threading
 import hexvi.events as events
+import hexvi.jobs as jobs
 from hexvi.app_state import SearchState
+from hexvi.block_cache import SHARED_CACHE
 from hexvi.tab_state import TabState
 from hexvi.file_buffer import FileBuffer
+from hexvi.file_buffer import StreamSource
+from hexvi.file_buffer import is_seekable
+from hexvi.watcher import FileWatcher
+
+class _Follower(object):
+    '''
+    Watches the file of a buffer on a worker thread and flags when it changed,
+    so that the main thread knows when to grow the buffer.
+    '''
+
+    poll_interval = 0.5
+
+    def __init__(self, file_buffer, pin):
+        self.file_buffer = file_buffer
+        self.pin = pin
+        self.changed = threading.Event()
+        self.job = jobs.Job(
+            'Following %s' % file_buffer.path,
+            self._watch,
+            key=('follow', file_buffer),
+            daemon=True)
+
+    def _watch(self, progress):
+        watcher = FileWatcher(self.file_buffer.path)
+        try:
+            while True:
+                progress(0, 0)
+                if watcher.wait(self.poll_interval):
+                    self.changed.set()
+        finally:
+            watcher.close()
 
 class TabManager(object):
     ''' The class responsible for managing tab lifecycles. '''
@@ -14,19 +49,33 @@ class TabManager(object):
         self._tab_index = None
         self._app_state = app_state
         self._old_tab_id = None
+        self._stream_buffers = {}
+        self._followers = {}
+        events.register_handler(events.JobChange, self._job_changed)
+        events.register_handler(events.SettingChange, self._setting_changed)
+        events.register_handler(events.ModeChange, self._mode_changed)
 
     @property
     def current_tab(self):
         return None if self._tab_index is None else self.tabs[self._tab_index]
 
     def close_current_tab(self):
-        ''' Closes currently focused tab. '''
-        # TODO: check if the file was modified
+        '''
+        Closes currently focused tab, unless it's the last one showing a
+        buffer with unsaved changes.
+        '''
+        file_buffer = self.current_tab.file_buffer
+        if file_buffer.modified \
+                and [tab.file_buffer for tab in self.tabs].count(file_buffer) == 1:
+            raise RuntimeError('No write since last change (add ! to override)')
         self._do_close_current_tab()
 
     def _do_close_current_tab(self):
         events.notify(events.TabClose(self.current_tab))
+        file_buffer = self.current_tab.file_buffer
         self.tabs = self.tabs[:self._tab_index] + self.tabs[self._tab_index+1:]
+        if file_buffer not in [tab.file_buffer for tab in self.tabs]:
+            self.unfollow(file_buffer)
         if not self.tabs:
             events.notify(events.ProgramExit())
         elif self.tab_index >= len(self.tabs):
@@ -34,9 +83,12 @@ class TabManager(object):
         else:
             events.notify(events.TabChange(self.current_tab))
 
-    def open_tab(self, path=None):
-        ''' Opens a new tab and focuses it. '''
-        file_buffer = self._get_or_create_file_buffer(path)
+    def open_tab(self, path=None, offset=0, length=None):
+        '''
+        Opens a new tab and focuses it. See FileBuffer for the meaning of
+        offset and length.
+        '''
+        file_buffer = self._get_or_create_file_buffer(path, offset, length)
         new_tab = TabState(self._app_state, file_buffer)
         self.tabs.append(new_tab)
         events.notify(events.TabOpen(new_tab))
@@ -49,6 +101,32 @@ class TabManager(object):
         self.tabs[self.tab_index] = new_tab
         events.notify(events.TabChange(self.current_tab))
 
+    def follow(self, file_buffer, pin=False):
+        '''
+        Starts growing a buffer along with its file, like tail -f does. With
+        pin, the cursor of every tab showing the buffer moves to its end
+        whenever it grows.
+        '''
+        if not file_buffer.path or not file_buffer.complete:
+            raise RuntimeError('Only files can be followed')
+        follower = self._followers.get(file_buffer)
+        if follower and follower.job.running:
+            follower.pin = pin
+            return
+        follower = _Follower(file_buffer, pin)
+        self._followers[file_buffer] = follower
+        # pick up whatever was appended before the watch started
+        follower.changed.set()
+        jobs.start(follower.job)
+
+    def unfollow(self, file_buffer):
+        ''' Stops growing a buffer along with its file. Returns whether it did. '''
+        follower = self._followers.pop(file_buffer, None)
+        if not follower:
+            return False
+        follower.job.cancel()
+        return True
+
     def cycle_tabs(self, direction):
         ''' Focuses next or previous tab. '''
         self.tab_index += 1 if direction == SearchState.DIR_FORWARD else -1
@@ -63,16 +141,92 @@ class TabManager(object):
         if self._old_tab_id != id(self.current_tab):
             events.notify(events.TabChange(self.current_tab))
             self._old_tab_id = id(self.current_tab)
+            if self.current_tab.file_buffer.check_file():
+                events.notify(events.PrintMessage(
+                    '%r changed on disk, :checktime merges it, '
+                    ':e! reloads it' % self.current_tab.file_buffer.path,
+                    style='msg-error'))
 
-    def _get_or_create_file_buffer(self, path):
+    def buffer_changed(self, file_buffer):
+        ''' Tells everyone about the content of a buffer changing. '''
+        for tab in self.tabs:
+            if tab.file_buffer is file_buffer:
+                tab.validate_offsets()
+        events.notify(events.BufferChange(file_buffer))
+
+    def _setting_changed(self, evt):
+        if evt.key == 'cache_size':
+            SHARED_CACHE.capacity = evt.value
+        elif evt.key in ['undolevels', 'undo_memory', 'memory_budget']:
+            for tab in self.tabs:
+                self._apply_buffer_settings(tab.file_buffer)
+
+    def _job_changed(self, _evt):
+        # streams are read by jobs, so this is when they might have grown
+        for file_buffer in set(tab.file_buffer for tab in self.tabs):
+            if file_buffer.refresh():
+                events.notify(events.BufferChange(file_buffer))
+        for follower in list(self._followers.values()):
+            if not follower.job.running:
+                del self._followers[follower.file_buffer]
+            elif follower.changed.is_set():
+                follower.changed.clear()
+                self._grow(follower)
+
+    def _grow(self, follower):
+        file_buffer = follower.file_buffer
+        if not file_buffer.grow():
+            return
+        self.buffer_changed(file_buffer)
+        if follower.pin:
+            for tab in self.tabs:
+                if tab.file_buffer is file_buffer:
+                    tab.current_offset = file_buffer.size
+
+    def _mode_changed(self, _evt):
+        # leaving or entering insert mode ends the current undo step
+        if self.current_tab:
+            self.current_tab.file_buffer.history.seal()
+
+    def _apply_buffer_settings(self, file_buffer):
+        file_buffer.history.max_steps = self._app_state.settings.undolevels
+        file_buffer.history.max_memory = self._app_state.settings.undo_memory
+        file_buffer.memory_budget = self._app_state.settings.memory_budget
+
+    def _get_or_create_file_buffer(self, path, offset=0, length=None):
         ''' If the file is already opened in some tab, share file buffer. '''
-        if not path:
-            return FileBuffer()
+        if path == '-' or (path and not is_seekable(path)):
+            return self._get_or_create_stream_buffer(path, offset, length)
         for tab in self.tabs:
             if tab.file_buffer.path \
                     and path \
-                    and os.path.samefile(tab.file_buffer.path, path):
+                    and os.path.samefile(tab.file_buffer.path, path) \
+                    and tab.file_buffer.offset == offset \
+                    and tab.file_buffer.length == length:
                 return tab.file_buffer
-        return FileBuffer(path)
+        file_buffer = FileBuffer(path, offset, length)
+        self._apply_buffer_settings(file_buffer)
+        return file_buffer
+
+    def _get_or_create_stream_buffer(self, path, offset=0, length=None):
+        '''
+        Starts reading the standard input, or a file such as a FIFO that can
+        only be read once from start to end, unless already done.
+        '''
+        key = path if path == '-' else os.path.realpath(path)
+        file_buffer = self._stream_buffers.get(key)
+        if not file_buffer:
+            if path == '-':
+                name = 'stdin'
+                source = StreamSource(sys.stdin.buffer, offset, length)
+            else:
+                name = path
+                source = StreamSource(path, offset, length)
+            jobs.start(jobs.Job(
+                'Reading %s' % name, source.receive, key=key, daemon=True))
+            file_buffer = FileBuffer.from_stream(source)
+            self._apply_buffer_settings(file_buffer)
+            self._stream_buffers[key] = file_buffer
+        return file_buffer
 
     tab_index = property(get_tab_index, set_tab_index)
@@ -64,6 +64,7 @@ class TabState(object):
         return self._cur_offset
 
     def set_current_offset(self, value):
+        self.file_buffer.load(value + 1)
         self._cur_offset = max(0, min(self.size, value))
         self._validate_top_offset()
         events.notify(events.OffsetChange(self))
@@ -1,16 +1,25 @@
 ''' Exports Console. '''
 
+import hexvi.events as events
 from hexvi.app_state import AppState
 from hexvi.ui.readline_edit import ReadlineEdit
 
+SEARCH_MODES = [AppState.MODE_SEARCH_FORWARD, AppState.MODE_SEARCH_BACKWARD]
+
 class Console(ReadlineEdit):
     ''' The widget where the user inputs command / search stuff. '''
 
+    # how long to wait after the last key before searching with incsearch
+    INCSEARCH_DELAY = 0.15
+
     def __init__(self, ui, cmd_processor, app_state, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._ui = ui
         self._cmd_processor = cmd_processor
         self._app_state = app_state
+        self._incsearch_alarm = None
+        self._previewing = False
+        events.register_handler(events.ModeChange, self._mode_changed)
 
     def keypress(self, pos, key):
         if self._ui.blocked:
@@ -20,7 +29,13 @@ class Console(ReadlineEdit):
             return None
         if key == 'enter':
             self._cmd_processor.accept_raw_command_input(self.edit_text)
-        return super().keypress(pos, key)
+        text = self.edit_text
+        result = super().keypress(pos, key)
+        if self.edit_text != text \
+                and self._app_state.mode in SEARCH_MODES \
+                and self._app_state.settings.incsearch:
+            self._schedule_incsearch()
+        return result
 
     def get_prompt(self):
         return self.caption
@@ -28,4 +43,26 @@ class Console(ReadlineEdit):
     def set_prompt(self, value):
         self.set_caption(value)
 
+    def _schedule_incsearch(self):
+        if self._incsearch_alarm:
+            self._ui.loop.remove_alarm(self._incsearch_alarm)
+        self._incsearch_alarm = self._ui.loop.set_alarm_in(
+            self.INCSEARCH_DELAY, self._incsearch)
+
+    def _incsearch(self, *_args):
+        self._incsearch_alarm = None
+        if self._app_state.mode in SEARCH_MODES:
+            self._previewing = True
+            self._cmd_processor.exec('search_preview', self.edit_text)
+
+    def _mode_changed(self, evt):
+        if evt.mode in SEARCH_MODES:
+            return
+        if self._incsearch_alarm:
+            self._ui.loop.remove_alarm(self._incsearch_alarm)
+            self._incsearch_alarm = None
+        if self._previewing:
+            self._previewing = False
+            self._cmd_processor.exec('cancel_search')
+
     prompt = property(get_prompt, set_prompt)
@@ -1,7 +1,6 @@
 ''' Exports Dump. '''
 
 import math
-import regex
 import urwid
 import hexvi.events as events
 
@@ -23,8 +22,14 @@ class Dump(urwid.BoxWidget):
         self._user_byte_input = ''
         events.register_handler(events.PaneChange, lambda *_: self._invalidate())
         events.register_handler(events.OffsetChange, lambda *_: self._invalidate())
+        events.register_handler(events.BufferChange, self._buffer_changed)
+        events.register_handler(events.SearchChange, lambda *_: self._invalidate())
         events.register_handler(events.TabChange, self._tab_changed)
 
+    def _buffer_changed(self, evt):
+        if self.tab_state and self.tab_state.file_buffer is evt.file_buffer:
+            self._invalidate()
+
     def _tab_changed(self, evt):
         self.tab_state = evt.tab_state
         self.tab_state.validate_offsets()
@@ -46,9 +51,15 @@ class Dump(urwid.BoxWidget):
         vis_col = self.tab_state.visible_columns
         vis_row = self.tab_state.visible_rows
 
+        self.tab_state.file_buffer.load(top_off + vis_col * vis_row)
         vis_bytes = min(vis_col * vis_row + top_off, self.tab_state.size) - top_off
 
-        buffer = self.tab_state.file_buffer.get(top_off, vis_bytes)
+        try:
+            buffer = self.tab_state.file_buffer.get(top_off, vis_bytes)
+        except RuntimeError as ex:
+            # such as the file getting shorter behind the buffer's back
+            lines = [str(ex).encode('utf-8')[:size[0]]] + [b''] * (size[1] - 1)
+            return urwid.TextCanvas([line.ljust(size[0]) for line in lines])
         off_lines, hex_lines, asc_lines = self._render_lines(buffer)
         off_hilight, hex_hilight, asc_hilight = self._render_hilight(
             off_lines, hex_lines, asc_lines)
@@ -108,8 +119,9 @@ class Dump(urwid.BoxWidget):
         hex_hilight = [[('hex', 3) for i in range(vis_col)] for l in hex_lines]
         asc_hilight = [[('asc', 1) for i in range(vis_col)] for l in asc_lines]
 
-        if self._app_state.search_state.text:
-            pattern = self._app_state.search_state.text.encode('utf8')
+        searcher = self._app_state.search_state.preview \
+            or self._app_state.search_state.searcher
+        if searcher:
             half_page = vis_col * vis_row // 2
             search_buffer_off = max(top_off - half_page, 0)
             search_buffer_shift = top_off - search_buffer_off
@@ -117,9 +129,14 @@ class Dump(urwid.BoxWidget):
             search_buffer_size = min(
                 search_buffer_size + search_buffer_off, self.tab_state.size) \
                 - search_buffer_off
-            search_buffer = self.tab_state.file_buffer.get(
-                search_buffer_off, search_buffer_size)
-            for match in regex.finditer(pattern, search_buffer):
+            try:
+                search_buffer = self.tab_state.file_buffer.get(
+                    search_buffer_off, search_buffer_size)
+            except RuntimeError:
+                # the file got shorter past the visible part, so leave the
+                # matches out rather than fail
+                search_buffer = b''
+            for match in searcher.finditer(search_buffer):
                 for i in range(len(match.group())):
                     rel_cur_off = match.start() + i - search_buffer_shift
                     pos_y = rel_cur_off // vis_col
@@ -135,6 +152,20 @@ class Dump(urwid.BoxWidget):
                     break
                 off_hilight[pos_y][pos_x] = ('off0', 1)
 
+        # mark the rows with changes in the column after the offsets
+        off_digits = self.get_offset_digits()
+        changed_rows = set()
+        for start, end in self.tab_state.file_buffer.get_changes(
+                top_off, min(vis_col * vis_row, self.tab_state.size - top_off)):
+            changed_rows.update(range(
+                max(0, (start - top_off) // vis_col),
+                min(vis_row, (end - 1 - top_off) // vis_col + 1)))
+        for pos_y in changed_rows:
+            off_lines[pos_y] = off_lines[pos_y].ljust(off_digits) + b'+'
+            off_hilight[pos_y] = off_hilight[pos_y][:off_digits] \
+                + [('off', 1)] * (off_digits - len(off_hilight[pos_y])) \
+                + [('off-changed', 1)]
+
         return off_hilight, hex_hilight, asc_hilight
 
     def keypress(self, _, key):
@@ -2,6 +2,7 @@
 
 import urwid
 import hexvi.events as events
+import hexvi.jobs as jobs
 import hexvi.util as util
 
 def _hilight(text):
@@ -22,6 +23,27 @@ class StatusBar(urwid.Widget):
         events.register_handler(events.OffsetChange, lambda *_: self._invalidate())
         events.register_handler(events.ModeChange, lambda *_: self._invalidate())
         events.register_handler(events.TabChange, lambda *_: self._invalidate())
+        events.register_handler(events.JobChange, lambda *_: self._invalidate())
+        events.register_handler(events.BufferChange, self._buffer_changed)
+
+    def _buffer_changed(self, evt):
+        # rendering only reads the index, so this is where it catches up
+        index = self._app_state.search_state.index
+        if index is not None and index.file_buffer is evt.file_buffer:
+            index.update()
+        self._invalidate()
+
+    def _describe_matches(self):
+        tab_state = self._tab_manager.current_tab
+        index = self._app_state.search_state.index
+        if index is None \
+                or index.file_buffer is not tab_state.file_buffer \
+                or not index.ready:
+            return ''
+        number = index.get_number(tab_state.current_offset)
+        if number:
+            return '[match {:,}/{:,}] '.format(number, len(index))
+        return '[{:,} matches] '.format(len(index))
 
     def rows(self, size, focus=False):
         return 1
@@ -30,15 +52,22 @@ class StatusBar(urwid.Widget):
         off_sep = ' / '
         off1 = util.fmt_hex(self._tab_manager.current_tab.current_offset)
         off2 = util.fmt_hex(self._tab_manager.current_tab.size)
+        if not self._tab_manager.current_tab.file_buffer.complete:
+            off2 += '+'
         percent = ' (%d%%)' % (
             self._tab_manager.current_tab.current_offset * (
                 100.0 / max(1, self._tab_manager.current_tab.size)))
 
         right_size = len(off1) + len(off2) + len(off_sep) + len(percent)
         left = '[%s] ' % self._app_state.mode.upper()
+        for job in jobs.get_jobs():
+            left += '[%s] ' % job.describe()
+        left += self._describe_matches()
+        modified = ' [+]' if self._tab_manager.current_tab.file_buffer.modified else ''
         left += util.trim_left(
             self._tab_manager.current_tab.long_name,
-            size[0] - (right_size + len(left) + 3))
+            size[0] - (right_size + len(left) + len(modified) + 3))
+        left += modified
 
         composite_canvas = urwid.CanvasJoin([
             (
@@ -1,7 +1,9 @@
 ''' Exports Ui '''
 
+import sys
 import urwid
 import hexvi.events as events
+import hexvi.jobs as jobs
 from hexvi.app_state import AppState
 from hexvi.ui.dialogs import ConfirmationDialog
 from hexvi.ui.main_window import MainWindow
@@ -9,8 +11,11 @@ from hexvi.ui.main_window import MainWindow
 class Ui(object):
     ''' The main UI facade. '''
 
+    JOB_POLL_INTERVAL = 0.2
+
     def __init__(self, tab_manager, cmd_processor, app_state):
         self.blocked = False
+        self._job_alarm = None
         self._app_state = app_state
         self._main_window = MainWindow(
             app_state, cmd_processor, tab_manager, self)
@@ -18,9 +23,20 @@ class Ui(object):
 
         events.register_handler(events.ProgramExit, lambda *args: self._exit())
         events.register_handler(events.ColorChange, self._color_changed)
+        events.register_handler(events.JobChange, self._job_changed)
 
+        screen = None
+        if not sys.stdin.isatty():
+            # the standard input might be what's being edited, so the keys
+            # have to come from the terminal itself
+            try:
+                screen = urwid.raw_display.Screen(input=open('/dev/tty', 'rb'))
+            except OSError:
+                pass
         self.loop = urwid.MainLoop(
-            self._main_window, unhandled_input=self._key_pressed)
+            self._main_window,
+            screen=screen,
+            unhandled_input=self._key_pressed)
 
     def show_confirmation_dialog(self, message, confirm_action, cancel_action):
         ConfirmationDialog(self, message, confirm_action, cancel_action)
@@ -41,6 +57,15 @@ class Ui(object):
             background_high=evt.bg_style_high)
         scr.clear()
 
+    def _job_changed(self, _evt):
+        if not self._job_alarm:
+            self._job_alarm = self.loop.set_alarm_in(
+                self.JOB_POLL_INTERVAL, self._poll_jobs)
+
+    def _poll_jobs(self, *_args):
+        self._job_alarm = None
+        jobs.poll()
+
     @staticmethod
     def _exit():
         raise urwid.ExitMainLoop()
@@ -14,6 +14,21 @@ def fmt_hex(number):
         ret = '0' + ret
     return ret
 
+def parse_size(text):
+    '''
+    Parses a byte count or an offset such as 4096, 0x1000 or 64M. Numbers
+    without a 0x, 0o or 0b prefix are decimal, even with leading zeros. The
+    K, M, G and T suffixes stand for powers of 1024.
+    '''
+    match = re.match(
+        r'^(0x[0-9a-f]+|0o[0-7]+|0b[01]+|\d+)([kmgt]?)b?$',
+        text.strip().lower())
+    if not match:
+        raise ValueError('Bad size: %r' % text)
+    number, suffix = match.groups()
+    base = 10 if number.isdigit() else 0
+    return int(number, base) * 1024 ** ' kmgt'.index(suffix or ' ')
+
 def scan_file(file_buffer, direction, start_pos, buffer_size, jump_size, functor):
     '''
     Scans the file incrementally, running given function on the content
@@ -61,7 +76,11 @@ def filter_unique_paths(paths):
     for i, path in enumerate(paths):
         same = False
         for j, other_path in enumerate(paths[i+1:]):
-            if other_path and os.path.samefile(path, other_path):
+            if '-' in [path, other_path]:
+                if path == other_path:
+                    same = True
+                    break
+            elif other_path and os.path.samefile(path, other_path):
                 same = True
                 break
         if not same:
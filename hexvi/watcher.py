@@ -0,0 +1,78 @@
+''' Exports FileWatcher. '''
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+
+try:
+    _LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _LIBC.inotify_init1
+    _LIBC.inotify_add_watch
+except (OSError, AttributeError):
+    _LIBC = None
+
+class FileWatcher(object):
+    '''
+    Waits for a file to change. Uses inotify where available, which costs
+    nothing while the file stays the same, and compares the file status at
+    regular intervals otherwise.
+    '''
+
+    def __init__(self, path, use_inotify=True):
+        self._path = path
+        self._handle = None
+        self._status = self._get_status()
+        if use_inotify and _LIBC:
+            self._handle = self._add_inotify_watch(path)
+
+    @staticmethod
+    def _add_inotify_watch(path):
+        handle = _LIBC.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if handle < 0:
+            return None
+        if _LIBC.inotify_add_watch(
+                handle, os.fsencode(path), _IN_MODIFY | _IN_ATTRIB) < 0:
+            os.close(handle)
+            return None
+        return handle
+
+    def _get_status(self):
+        try:
+            status = os.stat(self._path)
+        except OSError:
+            return None
+        return (status.st_size, status.st_mtime_ns, status.st_ino)
+
+    def wait(self, timeout):
+        '''
+        Waits up to timeout seconds for the file to change. Returns whether it
+        did, which might also be the case if it changed before the call.
+        '''
+        if self._handle is None:
+            time.sleep(timeout)
+            status = self._get_status()
+            changed = status != self._status
+            self._status = status
+            return changed
+        readable, _, _ = select.select([self._handle], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self._handle, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        ''' Releases the inotify instance, if any. '''
+        if self._handle is not None:
+            os.close(self._handle)
+            self._handle = None
+
+    uses_inotify = property(lambda self: self._handle is not None)
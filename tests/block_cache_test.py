@@ -0,0 +1,68 @@
+''' Tests the BlockCache. '''
+
+import unittest
+
+from hexvi.block_cache import BlockCache
+
+class CountingLoader(object):
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+
+    def __call__(self, offset, size):
+        self.calls += 1
+        return self.content[offset:offset+size]
+
+class TestBlockCache(unittest.TestCase):
+    def test_reading(self):
+        loader = CountingLoader(bytes(range(100)))
+        cache = BlockCache(1000, block_size=16)
+        self.assertEqual(cache.read('a', 10, 30, loader), bytes(range(10, 40)))
+        self.assertEqual(cache.read('a', 90, 20, loader), bytes(range(90, 100)))
+        self.assertEqual(cache.read('a', 0, 0, loader), b'')
+
+    def test_hits_and_misses(self):
+        loader = CountingLoader(bytes(100))
+        cache = BlockCache(1000, block_size=16)
+        cache.read('a', 0, 20, loader)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        cache.read('a', 4, 8, loader)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        cache.read('b', 4, 8, loader)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertEqual(loader.calls, 3)
+
+    def test_eviction(self):
+        loader = CountingLoader(bytes(100))
+        cache = BlockCache(32, block_size=16)
+        cache.read('a', 0, 1, loader)
+        cache.read('a', 16, 1, loader)
+        cache.read('a', 0, 1, loader)
+        cache.read('a', 32, 1, loader)
+        self.assertEqual(cache.used, 32)
+        cache.read('a', 0, 1, loader)
+        self.assertEqual(loader.calls, 3)
+        cache.read('a', 16, 1, loader)
+        self.assertEqual(loader.calls, 4)
+
+    def test_shrinking_capacity(self):
+        loader = CountingLoader(bytes(100))
+        cache = BlockCache(64, block_size=16)
+        cache.read('a', 0, 64, loader)
+        cache.capacity = 16
+        self.assertEqual(cache.block_count, 1)
+        cache.capacity = 0
+        self.assertEqual(cache.block_count, 0)
+        cache.read('a', 0, 64, loader)
+        self.assertEqual(cache.block_count, 0)
+
+    def test_invalidation(self):
+        loader = CountingLoader(bytes(100))
+        cache = BlockCache(1000, block_size=16)
+        cache.read('a', 0, 32, loader)
+        cache.read('b', 0, 32, loader)
+        cache.invalidate('a')
+        self.assertEqual(cache.block_count, 2)
+        self.assertEqual(cache.used, 32)
+
+unittest.main()
@@ -1,10 +1,24 @@
 ''' Tests the FileBuffer and content window management. '''
 
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+
+from hexvi.block_cache import BlockCache
 
 from hexvi.file_buffer import BufferContentWindow
 from hexvi.file_buffer import FileBuffer
+from hexvi.file_buffer import FileSource
+from hexvi.file_buffer import StreamSource
 from hexvi.file_buffer import Window
+from hexvi.file_buffer import is_seekable
+
+FileBuffer.debug = True
 
 def parse_spec(spec):
     '''
@@ -47,6 +61,45 @@ def parse_spec(spec):
         offset = size = 0
     return Window(offset, size), all_texts, hash_texts, not_hash_texts
 
+def create_temp_file(content=b''):
+    ''' Creates a temporary file with given content and returns its path. '''
+    handle, path = tempfile.mkstemp()
+    os.write(handle, content)
+    os.close(handle)
+    return path
+
+def edit_randomly(rng, buffer, content, coalesce=False):
+    '''
+    Deletes, overwrites or inserts content at a random offset of the buffer.
+    Returns the edit as (offset, size, new_content), so that it can be
+    repeated on a reference with reference[offset:offset+size] = new_content.
+    '''
+    offset = rng.randint(0, buffer.size)
+    choice = rng.random()
+    if buffer.size and choice < 0.3:
+        buffer.delete(offset, len(content))
+        return offset, len(content), b''
+    if choice < 0.6:
+        buffer.replace(offset, content, coalesce)
+        return offset, len(content), content
+    buffer.insert(offset, content, coalesce)
+    return offset, 0, content
+
+class FileTestCase(unittest.TestCase):
+    ''' Base for the tests that need a file, which holds content. '''
+
+    content = b'0123456789'
+
+    def setUp(self):
+        self.path = create_temp_file(self.content)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def read_back(self):
+        with open(self.path, 'rb') as handle:
+            return handle.read()
+
 class TestBufferContentWindow(unittest.TestCase):
     def test_zero_position(self):
         window = BufferContentWindow(0, b'xyyy')
@@ -124,6 +177,46 @@ class TestFileBufferInsertions(unittest.TestCase):
             BufferContentWindow(5, b'efgh'),
         ])
 
+class TestFileBufferCoalescing(unittest.TestCase):
+    def test_typing(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'ab')
+        for offset, char in enumerate(b'0123456789'):
+            buffer.insert(1 + offset, bytes([char]), coalesce=True)
+        self.assertEqual(buffer.get(0, buffer.size), b'a0123456789b')
+        self.assertEqual(len(buffer.windows), 3)
+
+    def test_typing_at_start(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'a', coalesce=True)
+        buffer.insert(1, b'b', coalesce=True)
+        self.assertEqual(buffer.windows, [BufferContentWindow(0, b'ab')])
+
+    def test_no_coalescing_elsewhere(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'a', coalesce=True)
+        buffer.insert(0, b'b', coalesce=True)
+        buffer.insert(1, b'c')
+        buffer.insert(2, b'd', coalesce=True)
+        self.assertEqual(buffer.get(0, buffer.size), b'bcda')
+        self.assertEqual(len(buffer.windows), 4)
+
+    def test_replacing(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'abcdef')
+        for offset, char in enumerate(b'0123'):
+            buffer.replace(1 + offset, bytes([char]), coalesce=True)
+        self.assertEqual(buffer.get(0, buffer.size), b'a0123f')
+        self.assertEqual(len(buffer.windows), 3)
+
+    def test_shared_buffer(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'a', coalesce=True)
+        window = buffer.windows[0]
+        buffer.insert(1, b'b', coalesce=True)
+        self.assertEqual(window, BufferContentWindow(0, b'a'))
+        self.assertFalse(window.can_grow())
+
 class TestFileBufferRemovals(unittest.TestCase):
     def do_test(self, spec):
         window, input_texts, texts_wo_hash, _ = parse_spec(spec)
@@ -259,4 +352,1052 @@ class TestFileBufferRetrievals(unittest.TestCase):
         self.do_test('-|#')
         self.do_test('#|-')
 
+class TestFileBackedBuffer(FileTestCase):
+    def test_zero_copy_retrieval(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        self.assertIsInstance(buffer.get(2, 4), memoryview)
+        self.assertEqual(buffer.get(2, 4), b'2345')
+
+    def test_retrieval_across_windows(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(5, b'abc')
+        self.assertEqual(buffer.get(3, 6), b'34abc5')
+        self.assertEqual(buffer.get(0, buffer.size), b'01234abc56789')
+
+    def test_file_getting_shorter(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        os.truncate(self.path, 4)
+        self.assertEqual(buffer.get(0, 4), b'0123')
+        with self.assertRaises(RuntimeError):
+            buffer.get(2, 4)
+
+    def open_unmapped_source(self):
+        with unittest.mock.patch('mmap.mmap', side_effect=OSError):
+            return FileSource(open(self.path, 'rb'), BlockCache(16, 4))
+
+    def test_unmappable_source(self):
+        source = self.open_unmapped_source()
+        self.assertFalse(source.mapped)
+        self.assertEqual(source.read(3, 2), b'34')
+        self.assertEqual(source.read(6, 10), b'6789')
+        source.close()
+
+    def test_reading_from_threads(self):
+        source = self.open_unmapped_source()
+        source.read(0, 10)
+        errors = []
+        def read(seed):
+            rng = random.Random(seed)
+            for _ in range(1000):
+                offset = rng.randint(0, 9)
+                size = rng.randint(0, 10 - offset)
+                content = bytes(source.read(offset, size))
+                if content != b'0123456789'[offset:offset+size]:
+                    errors.append(content)
+        threads = [threading.Thread(target=read, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        source.close()
+        self.assertEqual(errors, [])
+
+class TestFileBufferOverwrites(FileTestCase):
+    def test_overwriting(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(2, b'ab')
+        buffer.replace(7, b'c')
+        self.assertEqual(buffer.get(0, buffer.size), b'01ab456c89')
+        self.assertEqual(buffer.patches, [(2, b'ab'), (7, b'c')])
+        self.assertEqual(len(buffer.windows), 5)
+
+    def test_typing_over(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        for offset, char in enumerate(b'abcd'):
+            buffer.replace(3 + offset, bytes([char]), coalesce=True)
+        self.assertEqual(buffer.get(0, buffer.size), b'012abcd789')
+        self.assertEqual(buffer.patches, [(3, b'abcd')])
+
+    def test_overwriting_past_the_end(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(8, b'abc')
+        self.assertEqual(buffer.get(0, buffer.size), b'01234567abc')
+        self.assertEqual(buffer.patches, [])
+
+    def test_structural_edits_move_patches(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(5, b'ab')
+        buffer.insert(1, b'xyz')
+        self.assertEqual(buffer.patches, [(8, b'ab')])
+        buffer.delete(0, 6)
+        self.assertEqual(buffer.get(0, buffer.size), b'34ab789')
+        self.assertEqual(buffer.patches, [(2, b'ab')])
+        buffer.delete(1, 3)
+        self.assertEqual(buffer.get(0, buffer.size), b'3789')
+        self.assertEqual(buffer.patches, [])
+        self.assertEqual(len(buffer.windows), 2)
+
+class TestFileBufferSaving(FileTestCase):
+    def test_saving_in_place(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        inode = os.stat(self.path).st_ino
+        buffer.replace(2, b'ab')
+        buffer.replace(8, b'c')
+        buffer.save_to_file(self.path, False, FileBuffer.SAVE_INPLACE)
+        self.assertEqual(self.read_back(), b'01ab4567c9')
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        self.assertEqual(buffer.patches, [])
+        self.assertEqual(buffer.get(0, buffer.size), b'01ab4567c9')
+
+    def test_saving_in_place_after_resizing(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(2, b'ab')
+        buffer.insert(0, b'x')
+        buffer.save_to_file(self.path, False, FileBuffer.SAVE_INPLACE)
+        self.assertEqual(self.read_back(), b'x01ab456789')
+        buffer.replace(0, b'y')
+        buffer.save_to_file(self.path, False, FileBuffer.SAVE_INPLACE)
+        self.assertEqual(self.read_back(), b'y01ab456789')
+        self.assertEqual(len(buffer.windows), 1)
+
+    def test_saving_mixed_windows_elsewhere(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(4, b'abc')
+        buffer.delete(0, 1)
+        buffer.replace(8, b'x')
+        target_path = self.path + '.copy'
+        buffer.save_to_file(target_path, False)
+        try:
+            with open(target_path, 'rb') as handle:
+                self.assertEqual(handle.read(), b'123abc45x789')
+        finally:
+            os.remove(target_path)
+
+    def test_saving_with_progress(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(5, b'abc')
+        reports = []
+        buffer.save_to_file(
+            self.path, False,
+            progress=lambda done, total: reports.append((done, total)))
+        self.assertEqual(reports[-1], (13, 13))
+        self.assertEqual(self.read_back(), b'01234abc56789')
+
+    def test_cancelling(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(5, b'abc')
+        def progress(_done, _total):
+            raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            buffer.save_to_file(self.path, False, progress=progress)
+        self.assertEqual(self.read_back(), b'0123456789')
+        self.assertFalse(os.path.exists(self.path + '.hexvi-tmp'))
+
+    def test_editing_while_saving(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(0, b'a')
+        operation = buffer.prepare_save(self.path, False)
+        buffer.insert(0, b'b')
+        operation.run()
+        operation.finish()
+        self.assertEqual(self.read_back(), b'a0123456789')
+        self.assertEqual(buffer.get(0, buffer.size), b'ba0123456789')
+
+    def test_saving_in_place_after_editing_while_saving(self):
+        with open(self.path, 'wb') as handle:
+            handle.write(b'a' * 10)
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(3, b'Z')
+        operation = buffer.prepare_save(self.path, False)
+        operation.run()
+        buffer.replace(7, b'Q')
+        operation.finish()
+        buffer.undo(2)
+        buffer.save_to_file(self.path, False, FileBuffer.SAVE_INPLACE)
+        self.assertEqual(buffer.get(0, buffer.size), b'a' * 10)
+        self.assertEqual(self.read_back(), b'a' * 10)
+        self.assertFalse(buffer.modified)
+
+    def test_undoing_while_saving_in_place(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(0, b'a')
+        operation = buffer.prepare_save(
+            self.path, False, FileBuffer.SAVE_INPLACE)
+        with self.assertRaises(RuntimeError):
+            buffer.undo()
+        with self.assertRaises(RuntimeError):
+            buffer.prepare_save(self.path, False, FileBuffer.SAVE_INPLACE)
+        operation.run()
+        operation.finish()
+        self.assertEqual(buffer.get(0, buffer.size), b'a123456789')
+        self.assertFalse(buffer.modified)
+        buffer.replace(1, b'b')
+        buffer.undo()
+        self.assertEqual(buffer.get(0, buffer.size), b'a123456789')
+
+    def test_abandoning_save_in_place(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(0, b'a')
+        operation = buffer.prepare_save(
+            self.path, False, FileBuffer.SAVE_INPLACE)
+        operation.abandon()
+        buffer.undo()
+        self.assertEqual(buffer.get(0, buffer.size), b'0123456789')
+        self.assertEqual(self.read_back(), b'0123456789')
+
+    def test_saving_elsewhere(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(2, b'ab')
+        target_path = self.path + '.copy'
+        buffer.save_to_file(target_path, False, FileBuffer.SAVE_INPLACE)
+        try:
+            with open(target_path, 'rb') as handle:
+                self.assertEqual(handle.read(), b'01ab456789')
+        finally:
+            os.remove(target_path)
+        self.assertEqual(self.read_back(), b'0123456789')
+        self.assertEqual(buffer.patches, [(2, b'ab')])
+
+    def test_failing_to_create_temporary_file(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(0, b'a')
+        with unittest.mock.patch(
+                'hexvi.file_buffer.open', create=True,
+                side_effect=PermissionError('denied')):
+            with self.assertRaises(PermissionError):
+                buffer.save_to_file(self.path, False)
+        self.assertEqual(self.read_back(), b'0123456789')
+
+class TestFileBufferGatheredRetrievals(unittest.TestCase):
+    def setUp(self):
+        self.buffer = FileBuffer()
+        for text in [b'abc', b'de', b'fghij']:
+            self.buffer.insert(self.buffer.size, text)
+
+    def test_chunks(self):
+        self.assertEqual(
+            [bytes(chunk) for chunk in self.buffer.iter_chunks(1, 8)],
+            [b'bc', b'de', b'fghi'])
+        self.assertEqual(
+            [bytes(chunk) for chunk in self.buffer.iter_chunks(1, 8, 3)],
+            [b'bc', b'de', b'fgh', b'i'])
+        self.assertEqual(list(self.buffer.iter_chunks(10, 0)), [])
+
+    def test_get_into(self):
+        target = bytearray(6)
+        self.assertEqual(self.buffer.get_into(2, target), 6)
+        self.assertEqual(target, b'cdefgh')
+        target = bytearray(b'......')
+        self.assertEqual(self.buffer.get_into(7, memoryview(target)[1:]), 3)
+        self.assertEqual(target, b'.hij..')
+
+class TestFileBufferManyEdits(unittest.TestCase):
+    def test_against_reference(self):
+        rng = random.Random(0)
+        buffer = FileBuffer()
+        reference = bytearray()
+        for i in range(2000):
+            content = bytes([i % 256]) * rng.randint(1, 4)
+            offset, size, new_content = edit_randomly(
+                rng, buffer, content, rng.random() < 0.5)
+            reference[offset:offset+size] = new_content
+            self.assertEqual(buffer.size, len(reference))
+        self.assertEqual(buffer.get(0, buffer.size), bytes(reference))
+        for _ in range(100):
+            offset = rng.randint(0, len(reference))
+            size = rng.randint(0, len(reference) - offset)
+            self.assertEqual(
+                buffer.get(offset, size), bytes(reference[offset:offset+size]))
+        offset = 0
+        for window in buffer.windows:
+            self.assertEqual(window.start_offset, offset)
+            offset += window.size
+        self.assertEqual(offset, buffer.size)
+
+class TestFileBufferUndo(unittest.TestCase):
+    def content(self, buffer):
+        return buffer.get(0, buffer.size)
+
+    def test_undo_and_redo(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'abcdef')
+        buffer.delete(1, 2)
+        buffer.replace(2, b'x')
+        self.assertEqual(self.content(buffer), b'adxf')
+        self.assertEqual(buffer.undo(), 2)
+        self.assertEqual(self.content(buffer), b'adef')
+        self.assertEqual(buffer.undo(2), 0)
+        self.assertEqual(self.content(buffer), b'')
+        with self.assertRaises(RuntimeError):
+            buffer.undo()
+        self.assertEqual(buffer.redo(2), 1)
+        self.assertEqual(self.content(buffer), b'adef')
+        buffer.redo()
+        self.assertEqual(self.content(buffer), b'adxf')
+        with self.assertRaises(RuntimeError):
+            buffer.redo()
+
+    def test_change_discards_undone_changes(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'abc')
+        buffer.insert(3, b'def')
+        buffer.undo()
+        buffer.insert(0, b'x')
+        self.assertEqual(buffer.history.number, 2)
+        with self.assertRaises(RuntimeError):
+            buffer.redo()
+        buffer.undo()
+        self.assertEqual(self.content(buffer), b'abc')
+
+    def test_typing_is_one_change(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'xy')
+        for offset, char in enumerate(b'abc'):
+            buffer.insert(1 + offset, bytes([char]), coalesce=True)
+        for offset, char in enumerate(b'AB'):
+            buffer.replace(offset, bytes([char]), coalesce=True)
+        self.assertEqual(self.content(buffer), b'ABbcy')
+        buffer.undo()
+        self.assertEqual(self.content(buffer), b'xabcy')
+        buffer.undo()
+        self.assertEqual(self.content(buffer), b'xy')
+
+    def test_sealing(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'a', coalesce=True)
+        buffer.history.seal()
+        buffer.insert(1, b'b', coalesce=True)
+        buffer.undo()
+        self.assertEqual(self.content(buffer), b'a')
+
+    def test_typing_after_undo(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'a', coalesce=True)
+        buffer.insert(1, b'b', coalesce=True)
+        buffer.insert(0, b'x')
+        buffer.undo()
+        buffer.insert(2, b'c', coalesce=True)
+        self.assertEqual(self.content(buffer), b'abc')
+        buffer.undo()
+        self.assertEqual(self.content(buffer), b'ab')
+
+    def test_undo_to_number(self):
+        buffer = FileBuffer()
+        for char in b'abcd':
+            buffer.insert(buffer.size, bytes([char]))
+        buffer.undo_to_number(1)
+        self.assertEqual(self.content(buffer), b'a')
+        buffer.undo_to_number(3)
+        self.assertEqual(self.content(buffer), b'abc')
+        buffer.undo_to_number(0)
+        self.assertEqual(self.content(buffer), b'')
+        with self.assertRaises(RuntimeError):
+            buffer.undo_to_number(5)
+
+    def test_undo_to_time(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'a')
+        timestamp = buffer.history.time
+        buffer.insert(1, b'b')
+        buffer.undo_to_time(timestamp)
+        self.assertEqual(self.content(buffer), b'a')
+        buffer.undo_to_time(timestamp - 3600)
+        self.assertEqual(self.content(buffer), b'')
+        buffer.undo_to_time(timestamp + 3600)
+        self.assertEqual(self.content(buffer), b'ab')
+
+    def test_max_steps(self):
+        buffer = FileBuffer()
+        buffer.history.max_steps = 2
+        for char in b'abcd':
+            buffer.insert(buffer.size, bytes([char]))
+        self.assertEqual(len(buffer.history), 3)
+        buffer.undo(10)
+        self.assertEqual(self.content(buffer), b'ab')
+        self.assertEqual(buffer.history.number, 2)
+
+    def test_max_memory(self):
+        buffer = FileBuffer()
+        buffer.history.max_memory = 12000
+        for _ in range(3):
+            buffer.insert(0, b'x' * 4000)
+        self.assertLessEqual(buffer.history.memory, 12000)
+        buffer.undo(10)
+        self.assertEqual(buffer.size, 4000)
+        buffer.redo(10)
+        buffer.history.max_memory = 0
+        self.assertEqual(len(buffer.history), 1)
+        self.assertEqual(buffer.size, 12000)
+
+    def test_snapshots(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'abc')
+        snapshot = buffer.snapshot
+        buffer.insert(1, b'x')
+        buffer.replace(0, b'y')
+        self.assertEqual(snapshot.get(0, snapshot.size), b'abc')
+        buffer.undo(2)
+        self.assertIs(buffer.snapshot, snapshot)
+
+    def test_undo_after_saving(self):
+        path = create_temp_file(b'0123456789')
+        self.addCleanup(os.remove, path)
+        buffer = FileBuffer(path)
+        self.addCleanup(buffer.close)
+        buffer.insert(0, b'ab')
+        buffer.save_to_file(path, False)
+        self.assertEqual(len(buffer.windows), 1)
+        buffer.undo()
+        self.assertEqual(self.content(buffer), b'0123456789')
+        buffer.redo()
+        self.assertEqual(self.content(buffer), b'ab0123456789')
+
+    def test_against_reference(self):
+        rng = random.Random(2)
+        buffer = FileBuffer()
+        references = [b'']
+        for _ in range(300):
+            reference = bytearray(references[-1])
+            content = bytes(rng.randint(0, 255) for _ in range(rng.randint(1, 5)))
+            offset, size, new_content = edit_randomly(rng, buffer, content)
+            reference[offset:offset+size] = new_content
+            if bytes(reference) != references[-1]:
+                references.append(bytes(reference))
+        for reference in reversed(references[:-1]):
+            buffer.undo()
+            self.assertEqual(self.content(buffer), reference)
+        buffer.redo(len(references))
+        self.assertEqual(self.content(buffer), references[-1])
+
+class TestFileBufferCompaction(unittest.TestCase):
+    def test_merging_buffer_windows(self):
+        buffer = FileBuffer()
+        for char in b'abcd':
+            buffer.insert(buffer.size, bytes([char]))
+        self.assertEqual(buffer.compact(), (4, 1))
+        self.assertEqual(buffer.windows, [BufferContentWindow(0, b'abcd')])
+        buffer.undo()
+        self.assertEqual(buffer.get(0, buffer.size), b'abc')
+
+    def test_merging_file_windows(self):
+        path = create_temp_file(b'0123456789')
+        self.addCleanup(os.remove, path)
+        buffer = FileBuffer(path)
+        self.addCleanup(buffer.close)
+        buffer.insert(5, b'x')
+        buffer.delete(5, 1)
+        buffer.replace(1, b'a')
+        buffer.replace(2, b'b')
+        self.assertEqual(buffer.compact(), (6, 4))
+        self.assertEqual(buffer.get(0, buffer.size), b'0ab3456789')
+        self.assertEqual(buffer.patches, [(1, b'ab')])
+
+    def test_buffer_size_limit(self):
+        buffer = FileBuffer()
+        buffer.compact_buffer_size = 4
+        for char in b'abcdefghij':
+            buffer.insert(buffer.size, bytes([char]))
+        self.assertEqual(buffer.compact(), (10, 3))
+        self.assertEqual(buffer.compact(), (3, 3))
+        self.assertEqual(buffer.get(0, buffer.size), b'abcdefghij')
+
+    def test_automatic_compaction(self):
+        buffer = FileBuffer()
+        buffer.compact_min_windows = 8
+        for char in range(100):
+            buffer.insert(buffer.size, bytes([char]))
+        self.assertLess(len(buffer.windows), 8)
+        self.assertEqual(buffer.get(0, buffer.size), bytes(range(100)))
+
+class TestFileBufferSpilling(unittest.TestCase):
+    def test_spilling(self):
+        buffer = FileBuffer()
+        buffer.memory_budget = 10
+        self.addCleanup(buffer.close)
+        buffer.insert(0, b'abcdef')
+        buffer.insert(6, b'ghijkl')
+        windows = buffer.windows
+        self.assertTrue(windows[0].spilled)
+        self.assertFalse(windows[1].spilled)
+        self.assertEqual(buffer.get(0, buffer.size), b'abcdefghijkl')
+        self.assertEqual(buffer.get(3, 6), b'defghi')
+
+    def test_spilling_history(self):
+        buffer = FileBuffer()
+        buffer.memory_budget = 10
+        self.addCleanup(buffer.close)
+        buffer.insert(0, b'abcdef')
+        buffer.replace(0, b'xyz')
+        buffer.insert(6, b'012345')
+        self.assertEqual(
+            [window.spilled for window in buffer.windows], [True, True, False])
+        buffer.undo(2)
+        self.assertTrue(all(window.spilled for window in buffer.windows))
+        self.assertEqual(buffer.get(0, buffer.size), b'abcdef')
+        buffer.redo(2)
+        self.assertEqual(buffer.get(0, buffer.size), b'xyzdef012345')
+
+    def test_editing_spilled_content(self):
+        buffer = FileBuffer()
+        buffer.memory_budget = 4
+        self.addCleanup(buffer.close)
+        buffer.insert(0, b'abcdef')
+        buffer.insert(0, b'x')
+        buffer.delete(2, 2)
+        buffer.insert(3, b'y', coalesce=True)
+        buffer.insert(4, b'z', coalesce=True)
+        self.assertEqual(buffer.get(0, buffer.size), b'xadyzef')
+        self.assertTrue(buffer.windows[0].spilled)
+        self.assertEqual(buffer.windows[3].buffer, b'yz')
+        self.assertFalse(buffer.windows[3].spilled)
+
+    def test_saving_spilled_content(self):
+        path = create_temp_file()
+        self.addCleanup(os.remove, path)
+        buffer = FileBuffer()
+        buffer.memory_budget = 0
+        self.addCleanup(buffer.close)
+        buffer.insert(0, b'abc')
+        buffer.insert(0, b'def')
+        buffer.save_to_file(path, True)
+        with open(path, 'rb') as handle:
+            self.assertEqual(handle.read(), b'defabc')
+
+    def test_saving_spilled_patches_in_place(self):
+        path = create_temp_file(b'0123456789')
+        self.addCleanup(os.remove, path)
+        buffer = FileBuffer(path)
+        self.addCleanup(buffer.close)
+        buffer.memory_budget = 0
+        buffer.replace(2, b'ab')
+        buffer.replace(6, b'cd')
+        self.assertTrue(buffer.windows[1].spilled)
+        self.assertEqual(buffer.windows[1].buffer, b'ab')
+        self.assertEqual(buffer.patches, [(2, b'ab'), (6, b'cd')])
+        buffer.save_to_file(path, False, FileBuffer.SAVE_INPLACE)
+        with open(path, 'rb') as handle:
+            self.assertEqual(handle.read(), b'01ab45cd89')
+
+class TestFileBufferPartialFiles(FileTestCase):
+    def test_offset_and_length(self):
+        buffer = FileBuffer(self.path, 2, 5)
+        self.addCleanup(buffer.close)
+        self.assertEqual(buffer.get(0, buffer.size), b'23456')
+        self.assertTrue(buffer.complete)
+        buffer = FileBuffer(self.path, 8, 5)
+        self.addCleanup(buffer.close)
+        self.assertEqual(buffer.get(0, buffer.size), b'89')
+        buffer = FileBuffer(self.path, 20)
+        self.addCleanup(buffer.close)
+        self.assertEqual(buffer.size, 0)
+
+    def test_saving_part_in_place(self):
+        buffer = FileBuffer(self.path, 2, 5)
+        self.addCleanup(buffer.close)
+        buffer.replace(1, b'ab')
+        buffer.save_to_file(self.path, False)
+        self.assertEqual(self.read_back(), b'012ab56789')
+        self.assertEqual(buffer.get(0, buffer.size), b'2ab56')
+
+    def test_resizing_part(self):
+        buffer = FileBuffer(self.path, 2, 5)
+        self.addCleanup(buffer.close)
+        buffer.insert(1, b'ab')
+        with self.assertRaises(RuntimeError):
+            buffer.save_to_file(self.path, False)
+        self.assertEqual(self.read_back(), b'0123456789')
+
+    @unittest.skipUnless(os.path.exists('/dev/zero'), 'needs /dev/zero')
+    def test_loading(self):
+        buffer = FileBuffer('/dev/zero', length=100)
+        self.addCleanup(buffer.close)
+        buffer.load_size = 30
+        self.assertEqual(buffer.size, 100)
+        self.assertTrue(buffer.complete)
+        buffer = FileBuffer('/dev/zero')
+        self.addCleanup(buffer.close)
+        buffer.load_size = 30
+        self.assertFalse(buffer.complete)
+        size = buffer.size
+        buffer.insert(0, b'x')
+        self.assertFalse(buffer.load(size))
+        self.assertTrue(buffer.load(size + 2))
+        self.assertEqual(buffer.size, size + 31)
+        self.assertEqual(len(buffer.windows), 2)
+        buffer.undo()
+        self.assertEqual(buffer.size, size + 30)
+        self.assertEqual(buffer.get(0, buffer.size), bytes(size + 30))
+
+    @unittest.skipUnless(os.path.exists('/dev/zero'), 'needs /dev/zero')
+    def test_loading_far(self):
+        buffer = FileBuffer('/dev/zero')
+        self.addCleanup(buffer.close)
+        buffer.source.probe_size = 4096
+        with unittest.mock.patch('os.pread', wraps=os.pread) as pread:
+            self.assertTrue(buffer.load(buffer.size + 100000))
+        self.assertLessEqual(
+            max(call.args[1] for call in pread.call_args_list), 4096)
+
+class TestFileBufferStreams(unittest.TestCase):
+    def test_receiving(self):
+        read_handle, write_handle = os.pipe()
+        stream = os.fdopen(read_handle, 'rb')
+        self.addCleanup(stream.close)
+        source = StreamSource(stream)
+        buffer = FileBuffer.from_stream(source)
+        self.addCleanup(buffer.close)
+        self.assertEqual(buffer.size, 0)
+        os.write(write_handle, b'abc')
+        source.chunk_size = 3
+        thread = threading.Thread(target=source.receive)
+        thread.start()
+        while source.size < 3:
+            time.sleep(0.01)
+        self.assertTrue(buffer.refresh())
+        self.assertEqual(buffer.get(0, buffer.size), b'abc')
+        self.assertFalse(buffer.complete)
+        buffer.insert(0, b'x')
+        os.write(write_handle, b'def')
+        os.close(write_handle)
+        thread.join()
+        self.assertTrue(buffer.refresh())
+        self.assertTrue(buffer.complete)
+        self.assertFalse(buffer.refresh())
+        self.assertEqual(buffer.get(0, buffer.size), b'xabcdef')
+        self.assertEqual(len(buffer.windows), 2)
+        buffer.undo()
+        self.assertEqual(buffer.get(0, buffer.size), b'abcdef')
+
+    def test_receiving_part(self):
+        read_handle, write_handle = os.pipe()
+        os.write(write_handle, b'0123456789')
+        os.close(write_handle)
+        stream = os.fdopen(read_handle, 'rb')
+        self.addCleanup(stream.close)
+        source = StreamSource(stream, 2, 5)
+        source.chunk_size = 3
+        source.receive()
+        buffer = FileBuffer.from_stream(source)
+        self.addCleanup(buffer.close)
+        self.assertTrue(buffer.complete)
+        self.assertEqual(buffer.get(0, buffer.size), b'23456')
+
+    def test_receiving_from_fifo(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        path = os.path.join(directory, 'fifo')
+        os.mkfifo(path)
+        self.addCleanup(os.remove, path)
+        self.assertFalse(is_seekable(path))
+        source = StreamSource(path, 2)
+        self.addCleanup(source.close)
+        def write():
+            with open(path, 'wb') as handle:
+                handle.write(b'0123456789')
+        writer = threading.Thread(target=write)
+        writer.start()
+        source.receive()
+        writer.join()
+        buffer = FileBuffer.from_stream(source)
+        self.addCleanup(buffer.close)
+        self.assertTrue(buffer.complete)
+        self.assertEqual(buffer.get(0, buffer.size), b'23456789')
+
+    def test_seekable_files(self):
+        path = create_temp_file(b'abc')
+        self.addCleanup(os.remove, path)
+        self.assertTrue(is_seekable(path))
+        self.assertTrue(is_seekable(path + '.missing'))
+
+class TestFileBufferGrowth(FileTestCase):
+    content = b'abc'
+
+    def append(self, content):
+        with open(self.path, 'ab') as handle:
+            handle.write(content)
+
+    def test_growing(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        self.assertFalse(buffer.grow())
+        buffer.get(0, 3)
+        self.append(b'def')
+        self.assertTrue(buffer.grow())
+        self.assertEqual(buffer.get(0, buffer.size), b'abcdef')
+        self.assertEqual(len(buffer.windows), 1)
+        self.assertFalse(buffer.grow())
+
+    def test_growing_edited(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(1, b'x')
+        buffer.replace(0, b'y')
+        self.append(b'def')
+        self.assertTrue(buffer.grow())
+        self.assertEqual(buffer.get(0, buffer.size), b'yxbcdef')
+        self.assertEqual(len(buffer.windows), 3)
+        buffer.undo()
+        self.assertEqual(buffer.get(0, buffer.size), b'axbcdef')
+        buffer.undo()
+        self.assertEqual(buffer.get(0, buffer.size), b'abcdef')
+
+    def test_growing_part(self):
+        buffer = FileBuffer(self.path, 1, 4)
+        self.addCleanup(buffer.close)
+        self.append(b'def')
+        self.assertTrue(buffer.grow())
+        self.assertEqual(buffer.get(0, buffer.size), b'bcde')
+        self.append(b'ghi')
+        self.assertFalse(buffer.grow())
+
+    def test_shrinking(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        open(self.path, 'wb').close()
+        self.assertFalse(buffer.grow())
+        self.assertEqual(buffer.size, 3)
+
+class TestFileBufferExternalChanges(FileTestCase):
+    content = bytes(range(256)) * 64
+
+    def modify(self, offset, new_content):
+        with open(self.path, 'r+b') as handle:
+            handle.seek(offset)
+            handle.write(new_content)
+        # make sure the change is visible even with a coarse clock
+        os.utime(self.path, ns=(0, 0))
+
+    def replace_file(self, new_content):
+        with open(self.path + '.new', 'wb') as handle:
+            handle.write(new_content)
+        os.rename(self.path + '.new', self.path)
+
+    def test_unchanged(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(10, b'x')
+        self.assertFalse(buffer.check_file())
+        self.assertEqual(buffer.rebase(), [])
+
+    def test_modified_in_place(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(10, b'x')
+        buffer.insert(9000, b'yy')
+        self.modify(5000, b'a')
+        self.assertTrue(buffer.check_file())
+        self.assertEqual(buffer.rebase(), [])
+        self.assertFalse(buffer.check_file())
+        self.assertEqual(buffer.get(10, 1), b'x')
+        self.assertEqual(buffer.get(5000, 1), b'a')
+        self.assertEqual(buffer.get(9000, 2), b'yy')
+        self.modify(9001, b'b')
+        self.assertEqual(buffer.rebase(), [(8192, 12288)])
+        self.assertEqual(buffer.rebase(), [])
+
+    def test_replaced(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.delete(4095, 2)
+        self.replace_file(self.content[:-1] + b'c')
+        self.assertTrue(buffer.check_file())
+        self.assertEqual(buffer.get(buffer.size - 1, 1), b'\xff')
+        self.assertEqual(buffer.rebase(), [])
+        self.assertEqual(buffer.get(buffer.size - 1, 1), b'c')
+        self.replace_file(
+            self.content[:4094] + b'ddd' + self.content[4097:-1] + b'c')
+        self.assertEqual(buffer.rebase(), [(0, 8192)])
+        self.assertEqual(buffer.get(4094, 1), b'd')
+        buffer.undo()
+        self.assertEqual(buffer.get(4094, 3), b'ddd')
+
+    def test_grown(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(0, b'x')
+        self.replace_file(self.content + b'abc')
+        self.assertEqual(buffer.rebase(), [])
+        self.assertEqual(buffer.get(0, 1), b'x')
+        self.assertEqual(buffer.get(len(self.content), 3), b'abc')
+
+    def test_shrunk(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(0, b'x')
+        self.replace_file(b'abc')
+        with self.assertRaises(RuntimeError):
+            buffer.rebase()
+        self.assertEqual(buffer.get(0, 2), b'x\x01')
+        buffer.reload()
+        self.assertEqual(buffer.get(0, buffer.size), b'abc')
+        self.assertEqual(len(buffer.history), 1)
+        self.assertFalse(buffer.check_file())
+
+    def test_reloading_releases_files(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.memory_budget = 0
+        buffer.replace(10, b'x')
+        buffer.replace(20, b'x')
+        self.assertTrue(buffer.windows[1].spilled)
+        buffer.prepare_save(self.path, False, FileBuffer.SAVE_INPLACE)
+        source = buffer.source
+        buffer.reload()
+        with self.assertRaises(ValueError):
+            source.fileno()
+        self.assertEqual(buffer.get(10, 1), self.content[10:11])
+        buffer.replace(0, b'y')
+        buffer.save_to_file(self.path, False, FileBuffer.SAVE_INPLACE)
+        self.assertEqual(self.read_back(), b'y' + self.content[1:])
+
+    def test_saving(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(0, b'x')
+        buffer.save_to_file(self.path, False, FileBuffer.SAVE_INPLACE)
+        self.assertFalse(buffer.check_file())
+        buffer.insert(0, b'y')
+        buffer.save_to_file(self.path, False)
+        self.assertFalse(buffer.check_file())
+
+class TestFileBufferChanges(FileTestCase):
+    content = bytes(32)
+
+    def test_changes(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        self.assertFalse(buffer.modified)
+        self.assertEqual(buffer.get_changes(), [])
+        self.assertIsNone(buffer.find_change(0))
+        buffer.replace(2, b'xy')
+        buffer.insert(10, b'abc')
+        self.assertTrue(buffer.modified)
+        self.assertEqual(buffer.get_changes(), [(2, 4), (10, 13)])
+        buffer.replace(4, b'z')
+        buffer.delete(20, 3)
+        self.assertEqual(
+            buffer.get_changes(), [(2, 5), (10, 13), (20, 21)])
+        self.assertEqual(buffer.get_changes(11, 10), [(10, 13), (20, 21)])
+        self.assertEqual(buffer.find_change(0), (2, 5))
+        self.assertEqual(buffer.find_change(2), (10, 13))
+        self.assertIsNone(buffer.find_change(20))
+        self.assertEqual(buffer.find_change(20, forward=False), (10, 13))
+        self.assertIsNone(buffer.find_change(2, forward=False))
+        buffer.delete(0, buffer.size)
+        self.assertEqual(buffer.get_changes(), [])
+        buffer.undo(5)
+        self.assertFalse(buffer.modified)
+        self.assertEqual(buffer.get_changes(), [])
+
+    def test_deleting_at_end(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.delete(30, 2)
+        self.assertEqual(buffer.get_changes(), [(29, 30)])
+        buffer.replace(28, b'abcd')
+        self.assertEqual(buffer.get_changes(), [(28, 32)])
+
+    def test_saving(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(0, b'a', coalesce=True)
+        buffer.save_to_file(self.path, False)
+        self.assertFalse(buffer.modified)
+        self.assertEqual(buffer.get_changes(), [])
+        buffer.insert(1, b'b', coalesce=True)
+        self.assertTrue(buffer.modified)
+        buffer.undo()
+        self.assertFalse(buffer.modified)
+        buffer.undo()
+        self.assertTrue(buffer.modified)
+        buffer.replace(0, b'x')
+        buffer.save_to_file(self.path, False, FileBuffer.SAVE_INPLACE)
+        self.assertFalse(buffer.modified)
+        self.assertEqual(buffer.get_changes(), [])
+
+    def test_growing(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.replace(31, b'x')
+        with open(self.path, 'ab') as handle:
+            handle.write(b'abc')
+        buffer.grow()
+        self.assertEqual(buffer.get_changes(), [(31, 32)])
+        self.assertEqual(buffer.size, 35)
+
+    def test_against_reference(self):
+        rng = random.Random(3)
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        reference = [False] * buffer.size
+        for _ in range(500):
+            offset, size, new_content = edit_randomly(
+                rng, buffer, bytes(rng.randint(1, 4)), rng.random() < 0.5)
+            reference[offset:offset+size] = [True] * len(new_content)
+            if not new_content and reference:
+                # deleting marks the byte that takes the place of the bytes
+                reference[min(offset, len(reference) - 1)] = True
+            changes = []
+            for marked, group in itertools.groupby(
+                    range(len(reference)), lambda j: reference[j]):
+                group = list(group)
+                if marked:
+                    changes.append((group[0], group[-1] + 1))
+            self.assertEqual(buffer.get_changes(), changes)
+            offset = rng.randint(0, len(reference))
+            self.assertEqual(
+                buffer.find_change(offset),
+                next((c for c in changes if c[0] > offset), None))
+            self.assertEqual(
+                buffer.find_change(offset, forward=False),
+                next((c for c in reversed(changes) if c[0] < offset), None))
+
+class TestFileBufferBatches(unittest.TestCase):
+    def test_applying_edits(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'0123456789')
+        buffer.apply_edits([
+            (0, 1, b'a'),
+            (2, 0, b'bb'),
+            (3, 3, b''),
+            (8, 2, b'cde')])
+        self.assertEqual(buffer.get(0, buffer.size), b'a1bb267cde')
+        self.assertEqual(buffer.patches, [(0, b'a')])
+        self.assertEqual(buffer.history.number, 2)
+        buffer.undo()
+        self.assertEqual(buffer.get(0, buffer.size), b'0123456789')
+        buffer.apply_edits([])
+        self.assertEqual(buffer.history.number, 1)
+
+    def test_invalid_edits(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'0123456789')
+        with self.assertRaises(RuntimeError):
+            buffer.apply_edits([(5, 1, b'a'), (2, 1, b'b')])
+        with self.assertRaises(RuntimeError):
+            buffer.apply_edits([(2, 2, b'a'), (3, 1, b'b')])
+        with self.assertRaises(RuntimeError):
+            buffer.apply_edits([(8, 3, b'a')])
+        self.assertEqual(buffer.get(0, buffer.size), b'0123456789')
+
+    def test_against_single_edits(self):
+        rng = random.Random(4)
+        buffer = FileBuffer()
+        buffer.insert(0, bytes(range(256)) * 16)
+        for _ in range(20):
+            reference = bytearray(buffer.get(0, buffer.size))
+            edits = []
+            offset = 0
+            while True:
+                offset += rng.randint(0, 300)
+                size = rng.randint(0, 8)
+                if offset + size > len(reference):
+                    break
+                edits.append((offset, size, bytes(rng.randint(0, 8))))
+                offset += size
+            for offset, size, new_content in reversed(edits):
+                reference[offset:offset+size] = new_content
+            buffer.apply_edits(edits)
+            self.assertEqual(buffer.get(0, buffer.size), bytes(reference))
+
+class TestEditsSince(FileTestCase):
+    content = bytes(range(256)) * 16
+
+    def test_same(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        self.assertIsNone(buffer.get_edit_since(buffer.version))
+
+    def test_edits(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        version = buffer.version
+        buffer.insert(10, b'abc')
+        self.assertEqual(buffer.get_edit_since(version), (10, 0, 3))
+        buffer.delete(100, 50)
+        self.assertEqual(buffer.get_edit_since(version), (10, 137, 90))
+        version = buffer.version
+        buffer.replace(200, b'xy')
+        self.assertEqual(buffer.get_edit_since(version), (200, 2, 2))
+
+    def test_undo_and_redo(self):
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        buffer.insert(10, b'abc')
+        buffer.delete(20, 5)
+        version = buffer.version
+        buffer.undo(2)
+        self.assertEqual(buffer.get_edit_since(version), (10, 10, 12))
+        buffer.redo()
+        self.assertEqual(buffer.get_edit_since(version), (10, 10, 15))
+
+    def test_forgotten_edits(self):
+        with unittest.mock.patch.object(FileBuffer, 'max_journal_size', 2):
+            buffer = FileBuffer(self.path)
+            self.addCleanup(buffer.close)
+        version = buffer.version
+        buffer.insert(0, b'a')
+        buffer.insert(0, b'b')
+        self.assertEqual(buffer.get_edit_since(version), (0, 0, 2))
+        buffer.insert(0, b'c')
+        self.assertIsNone(buffer.get_edit_since(version))
+        version = buffer.version
+        buffer.reload()
+        self.assertNotEqual(buffer.version, version)
+        self.assertIsNone(buffer.get_edit_since(version))
+
+    def test_against_reference(self):
+        rng = random.Random(3)
+        buffer = FileBuffer(self.path)
+        self.addCleanup(buffer.close)
+        for _ in range(200):
+            version = buffer.version
+            old = buffer.get(0, buffer.size)
+            for _ in range(rng.randint(1, 3)):
+                choice = rng.random()
+                if choice < 0.2 and len(buffer.history) >= 2:
+                    buffer.undo(rng.randint(1, 3))
+                elif choice < 0.3 and buffer.history.number < len(buffer.history) - 1:
+                    buffer.redo(rng.randint(1, 3))
+                else:
+                    content = bytes(
+                        rng.randint(0, 255) for _ in range(rng.randint(1, 5)))
+                    edit_randomly(rng, buffer, content, rng.random() < 0.5)
+            new = buffer.get(0, buffer.size)
+            edit = buffer.get_edit_since(version)
+            if edit is None:
+                self.assertEqual(version, buffer.version)
+                continue
+            start, size, new_size = edit
+            self.assertEqual(old[:start], new[:start])
+            self.assertEqual(old[start+size:], new[start+new_size:])
+            self.assertEqual(len(old) - size, len(new) - new_size)
+
+class TestFileBufferConsistencyChecks(unittest.TestCase):
+    def test_corruption_is_detected(self):
+        buffer = FileBuffer()
+        buffer.insert(0, b'abc')
+        buffer.insert(3, b'def')
+        buffer.windows[0].size = 2
+        with self.assertRaises(AssertionError):
+            buffer.check_consistency()
+
 unittest.main()
@@ -0,0 +1,83 @@
+''' Tests the background jobs. '''
+
+import threading
+import unittest
+
+import hexvi.events as events
+import hexvi.jobs as jobs
+
+class TestJobs(unittest.TestCase):
+    def run_job(self, job):
+        jobs.start(job)
+        job.wait()
+        self.assertFalse(jobs.poll())
+
+    def test_success(self):
+        results = []
+        def func(progress):
+            progress(1, 2)
+            progress(2, 2)
+            return 'result'
+        job = jobs.Job('test', func, on_success=results.append)
+        self.run_job(job)
+        self.assertEqual(results, ['result'])
+        self.assertEqual((job.done, job.total), (2, 2))
+
+    def test_failure(self):
+        errors = []
+        def func(_progress):
+            raise RuntimeError('error')
+        job = jobs.Job('test', func, on_failure=errors.append)
+        self.run_job(job)
+        self.assertEqual([str(error) for error in errors], ['error'])
+
+    def test_quiet_failure(self):
+        errors = []
+        messages = []
+        def func(_progress):
+            raise RuntimeError('error')
+        job = jobs.Job('test', func, on_failure=errors.append, quiet=True)
+        events.register_handler(events.PrintMessage, messages.append)
+        try:
+            self.run_job(job)
+        finally:
+            events.unregister_handler(events.PrintMessage, messages.append)
+        self.assertEqual([str(error) for error in errors], ['error'])
+        self.assertEqual(messages, [])
+
+    def test_cancelling(self):
+        started = threading.Event()
+        def func(progress):
+            started.set()
+            while True:
+                progress(0, 1)
+        job = jobs.Job('test', func)
+        jobs.start(job)
+        started.wait()
+        self.assertEqual(jobs.cancel_all(), 1)
+        job.wait()
+        self.assertFalse(jobs.poll())
+        self.assertTrue(job.cancelled)
+
+    def test_cancelling_leaves_daemons(self):
+        release = threading.Event()
+        job = jobs.Job(
+            'test', lambda _progress: release.wait(), daemon=True)
+        jobs.start(job)
+        self.assertEqual(jobs.cancel_all(), 0)
+        release.set()
+        job.wait()
+        self.assertFalse(jobs.poll())
+        self.assertFalse(job.cancelled)
+
+    def test_duplicate_keys(self):
+        release = threading.Event()
+        job = jobs.Job('test', lambda _progress: release.wait(), key='key')
+        jobs.start(job)
+        with self.assertRaises(RuntimeError):
+            jobs.start(jobs.Job('test', lambda _progress: None, key='key'))
+        release.set()
+        job.wait()
+        self.assertFalse(jobs.poll())
+
+unittest.main()
@@ -0,0 +1,175 @@
+''' Tests the MatchIndex. '''
+
+import random
+import unittest
+
+import hexvi.jobs as jobs
+from hexvi.app_state import SearchState
+from hexvi.file_buffer import FileBuffer
+from hexvi.match_index import MatchIndex
+from hexvi.searcher import Searcher
+
+def make_index(pattern, content):
+    buffer = FileBuffer()
+    buffer.insert(0, content)
+    index = MatchIndex(Searcher(pattern), buffer)
+    build(index)
+    return index
+
+def build(index):
+    index.build()
+    index.job.wait()
+    jobs.poll()
+
+def settle(index):
+    while not index.update():
+        index.job.wait()
+        jobs.poll()
+
+class TestMatchIndex(unittest.TestCase):
+    def test_building(self):
+        index = make_index('ab', b'xxabxxabab')
+        self.assertTrue(index.ready)
+        self.assertTrue(index.update())
+        self.assertEqual(index.get_matches(), [(2, 4), (6, 8), (8, 10)])
+        self.assertEqual(len(index), 3)
+
+    def test_not_ready(self):
+        buffer = FileBuffer()
+        index = MatchIndex(Searcher('a'), buffer)
+        self.assertFalse(index.ready)
+        self.assertFalse(index.update())
+
+    def test_find(self):
+        index = make_index('ab', b'xxabxxabab')
+        self.assertEqual(index.find(0), (2, True))
+        self.assertEqual(index.find(2), (6, True))
+        self.assertEqual(index.find(2, count=2), (8, True))
+        self.assertEqual(index.find(2, count=3), (8, False))
+        self.assertEqual(index.find(8), (None, False))
+        self.assertEqual(index.find(8, forward=False), (6, True))
+        self.assertEqual(index.find(9, forward=False, count=3), (2, True))
+        self.assertEqual(index.find(9, forward=False, count=4), (2, False))
+        self.assertEqual(index.find(2, forward=False), (None, False))
+
+    def test_find_against_searcher(self):
+        rng = random.Random(2)
+        for pattern in [b'ab', b'a+', b'a.{0,9}b', b'ab$', b'(?<=b)a\\b']:
+            content = bytes(rng.choice(b'abx\n') for _ in range(300))
+            index = make_index(pattern, content)
+            snapshot = index.file_buffer.snapshot
+            for _ in range(100):
+                offset = rng.randint(0, len(content))
+                match = index.searcher.find(
+                    snapshot, offset, SearchState.DIR_BACKWARD)
+                self.assertEqual(
+                    index.find(offset, forward=False)[0],
+                    match and match[0],
+                    (pattern, offset))
+                match = index.searcher.find(
+                    snapshot, offset + 1, SearchState.DIR_FORWARD)
+                self.assertEqual(
+                    index.find(offset)[0], match and match[0], (pattern, offset))
+
+    def test_numbers(self):
+        index = make_index('ab', b'xxabxxabab')
+        self.assertEqual(index.get_number(2), 1)
+        self.assertEqual(index.get_number(8), 3)
+        self.assertEqual(index.get_number(3), None)
+
+    def test_edits(self):
+        index = make_index('ab', b'xxabxxabab')
+        index.file_buffer.insert(0, b'ab')
+        self.assertTrue(index.update())
+        self.assertEqual(
+            index.get_matches(), [(0, 2), (4, 6), (8, 10), (10, 12)])
+        index.file_buffer.delete(5, 1)
+        self.assertTrue(index.update())
+        self.assertEqual(index.get_matches(), [(0, 2), (7, 9), (9, 11)])
+        index.file_buffer.undo(2)
+        self.assertTrue(index.update())
+        self.assertEqual(index.get_matches(), [(2, 4), (6, 8), (8, 10)])
+
+    def test_large_edits(self):
+        index = make_index('ab', b'xxabxxabab')
+        index.max_update_size = 100
+        index.file_buffer.insert(4, b'ab' * 100)
+        self.assertFalse(index.update())
+        self.assertFalse(index.ready)
+        index.job.wait()
+        jobs.poll()
+        self.assertTrue(index.update())
+        self.assertEqual(len(index), 103)
+
+    def test_anchored_patterns(self):
+        index = make_index('^a', b'abab')
+        index.file_buffer.replace(2, b'x')
+        self.assertTrue(index.update())
+        self.assertEqual(index.get_matches(), [(0, 1)])
+        index.file_buffer.delete(0, 1)
+        self.assertTrue(index.update())
+        self.assertEqual(index.get_matches(), [])
+
+    def test_updating_in_background(self):
+        index = make_index('ab', b'xxabxxabab')
+        index.max_sync_update_size = 8
+        index.file_buffer.insert(4, b'ab' * 4)
+        self.assertFalse(index.update())
+        self.assertFalse(index.ready)
+        index.file_buffer.insert(0, b'ab')
+        settle(index)
+        self.assertEqual(
+            index.get_matches(),
+            list(index.searcher.iter_matches(index.file_buffer.snapshot)))
+        self.assertEqual(len(index), 8)
+
+    def test_edits_against_reference(self):
+        rng = random.Random(0)
+        for pattern in [b'ab', b'a+b', b'(?<=b)a', b'a.{0,9}b']:
+            content = bytes(rng.choice(b'abx') for _ in range(1000))
+            index = make_index(pattern, content)
+            buffer = index.file_buffer
+            for _ in range(100):
+                offset = rng.randint(0, buffer.size - 1)
+                new_content = bytes(
+                    rng.choice(b'abx') for _ in range(rng.randint(1, 5)))
+                choice = rng.random()
+                if choice < 0.3:
+                    buffer.delete(offset, len(new_content))
+                elif choice < 0.6:
+                    buffer.replace(offset, new_content)
+                elif choice < 0.9 or buffer.history.number < 2:
+                    buffer.insert(offset, new_content)
+                else:
+                    buffer.undo()
+                self.assertTrue(index.update())
+                self.assertEqual(
+                    index.get_matches(),
+                    list(index.searcher.iter_matches(buffer.snapshot)),
+                    pattern)
+
+    def test_matches_longer_than_margin(self):
+        rng = random.Random(1)
+        for pattern in [
+                b'a.{0,30}b', b'a[^b]*b', b'[ab]+x', b'b$', b'a(?=x*\\Z)']:
+            content = bytes(rng.choice(b'abx\n') for _ in range(200))
+            index = make_index(pattern, content)
+            index.margin = 4
+            index.searcher.context_size = 4
+            buffer = index.file_buffer
+            for _ in range(50):
+                offset = rng.randint(0, buffer.size)
+                new_content = bytes(
+                    rng.choice(b'abx\n') for _ in range(rng.randint(1, 4)))
+                if rng.random() < 0.3:
+                    buffer.delete(offset, len(new_content))
+                else:
+                    buffer.insert(offset, new_content)
+                settle(index)
+                self.assertEqual(
+                    index.get_matches(),
+                    list(index.searcher.iter_matches(buffer.snapshot)),
+                    pattern)
+
+if __name__ == '__main__':
+    unittest.main()
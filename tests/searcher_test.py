@@ -0,0 +1,306 @@
+''' Tests the Searcher. '''
+
+import os
+import random
+import tempfile
+import unittest
+import unittest.mock
+
+import regex
+
+from hexvi.app_state import SearchState
+from hexvi.file_buffer import FileBuffer
+from hexvi.file_buffer import Snapshot
+from hexvi.file_buffer import StreamSource
+from hexvi.searcher import Searcher
+
+FORWARD = SearchState.DIR_FORWARD
+BACKWARD = SearchState.DIR_BACKWARD
+
+def make_buffer(content, piece_size=7):
+    buffer = FileBuffer()
+    for offset in range(0, len(content), piece_size):
+        buffer.insert(offset, content[offset:offset+piece_size])
+    return buffer
+
+def make_searcher(pattern, chunk_size=4, context_size=4, segment_size=16):
+    searcher = Searcher(pattern)
+    searcher.chunk_size = chunk_size
+    searcher.context_size = context_size
+    searcher.segment_size = segment_size
+    return searcher
+
+class TestSearcher(unittest.TestCase):
+    def test_simple(self):
+        buffer = make_buffer(b'abcabcabc')
+        searcher = Searcher('bc')
+        self.assertEqual(searcher.find(buffer.snapshot, 0, FORWARD), (1, 3))
+        self.assertEqual(searcher.find(buffer.snapshot, 2, FORWARD), (4, 6))
+        self.assertEqual(searcher.find(buffer.snapshot, 8, FORWARD), None)
+        self.assertEqual(searcher.find(buffer.snapshot, 8, BACKWARD), (7, 9))
+        self.assertEqual(searcher.find(buffer.snapshot, 7, BACKWARD), (4, 6))
+        self.assertEqual(searcher.find(buffer.snapshot, 1, BACKWARD), None)
+
+    def test_empty_buffer(self):
+        buffer = FileBuffer()
+        searcher = Searcher('a')
+        self.assertEqual(searcher.find(buffer.snapshot, 0, FORWARD), None)
+        self.assertEqual(searcher.find(buffer.snapshot, 0, BACKWARD), None)
+
+    def test_bad_pattern(self):
+        with self.assertRaises(RuntimeError):
+            Searcher('a(')
+
+    def test_literal_detection(self):
+        self.assertEqual(Searcher('PNG').literal, b'PNG')
+        self.assertEqual(
+            Searcher(r'\x89PNG\r\n\.').literal, b'\x89PNG\r\n.')
+        self.assertEqual(Searcher('a.b').literal, None)
+        self.assertEqual(Searcher(r'\d').literal, None)
+        self.assertEqual(Searcher('(?i)png').literal, None)
+
+    def test_literal_across_chunks(self):
+        buffer = make_buffer(b'xxxxxxhello worldxxxxhello world')
+        searcher = make_searcher('hello world', chunk_size=3)
+        self.assertEqual(searcher.literal, b'hello world')
+        self.assertEqual(searcher.find(buffer.snapshot, 0, FORWARD), (6, 17))
+        self.assertEqual(searcher.find(buffer.snapshot, 7, FORWARD), (21, 32))
+        self.assertEqual(
+            searcher.find(buffer.snapshot, buffer.size, BACKWARD), (21, 32))
+        self.assertEqual(searcher.find(buffer.snapshot, 21, BACKWARD), (6, 17))
+
+    def test_literal_in_mapped_file(self):
+        content = b'xxPNGxxxxPNGxxP' * 10
+        handle, path = tempfile.mkstemp()
+        os.write(handle, content)
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        buffer = FileBuffer(path)
+        self.addCleanup(buffer.close)
+        self.assertTrue(buffer.source.mapped)
+        searcher = make_searcher('PNG', chunk_size=16)
+        expected = [
+            (start, start + 3) for start in range(len(content))
+            if content[start:start+3] == b'PNG']
+        with unittest.mock.patch.object(
+                Snapshot, 'get_into', autospec=True,
+                side_effect=Snapshot.get_into) as get_into:
+            self.assertEqual(
+                list(searcher.iter_matches(buffer.snapshot)), expected)
+            self.assertEqual(
+                searcher.find(buffer.snapshot, 3, FORWARD), expected[1])
+            self.assertEqual(
+                searcher.find(buffer.snapshot, 100, BACKWARD),
+                [match for match in expected if match[0] < 100][-1])
+        get_into.assert_not_called()
+        # the edited chunks are read, the others still aren't
+        buffer.replace(40, b'PNG')
+        buffer.insert(100, b'xPNG')
+        content = buffer.get(0, buffer.size)
+        expected = [
+            (start, start + 3) for start in range(len(content))
+            if content[start:start+3] == b'PNG']
+        self.assertEqual(
+            list(searcher.iter_matches(buffer.snapshot)), expected)
+        self.assertEqual(searcher.find(buffer.snapshot, 38, FORWARD), (40, 43))
+        self.assertEqual(
+            searcher.find(buffer.snapshot, 105, BACKWARD), (101, 104))
+
+    def test_literal_in_stream(self):
+        content = b'xxPNGxxxxPNGxxP' * 10
+        read_handle, write_handle = os.pipe()
+        os.write(write_handle, content)
+        os.close(write_handle)
+        stream = os.fdopen(read_handle, 'rb')
+        self.addCleanup(stream.close)
+        source = StreamSource(stream)
+        source.receive()
+        buffer = FileBuffer.from_stream(source)
+        self.addCleanup(buffer.close)
+        searcher = make_searcher('PNG', chunk_size=16)
+        expected = [
+            (start, start + 3) for start in range(len(content))
+            if content[start:start+3] == b'PNG']
+        self.assertEqual(
+            list(searcher.iter_matches(buffer.snapshot)), expected)
+        self.assertEqual(
+            searcher.find(buffer.snapshot, 3, FORWARD), expected[1])
+        self.assertEqual(
+            searcher.find(buffer.snapshot, 100, BACKWARD),
+            [match for match in expected if match[0] < 100][-1])
+
+    def test_match_across_chunks(self):
+        buffer = make_buffer(b'xxxxxxhello worldxxxx')
+        searcher = make_searcher('hello world')
+        self.assertEqual(searcher.find(buffer.snapshot, 0, FORWARD), (6, 17))
+        self.assertEqual(
+            searcher.find(buffer.snapshot, buffer.size, BACKWARD), (6, 17))
+
+    def test_long_match(self):
+        content = b'x' + b'a' * 20000 + b'bx'
+        buffer = make_buffer(content, piece_size=1000)
+        searcher = make_searcher('a+b', chunk_size=64)
+        self.assertEqual(searcher.find(buffer.snapshot, 0, FORWARD), (1, 20002))
+        self.assertEqual(
+            searcher.find(buffer.snapshot, buffer.size, BACKWARD),
+            (20000, 20002))
+        searcher = make_searcher('xa+b', chunk_size=64)
+        self.assertEqual(
+            searcher.find(buffer.snapshot, buffer.size, BACKWARD), (0, 20002))
+
+    def test_greedy_match_at_chunk_end(self):
+        buffer = make_buffer(b'aaaaaaaaaa')
+        searcher = make_searcher('a+')
+        self.assertEqual(searcher.find(buffer.snapshot, 0, FORWARD), (0, 10))
+        self.assertEqual(
+            searcher.find(buffer.snapshot, buffer.size, BACKWARD), (9, 10))
+        self.assertEqual(searcher.find(buffer.snapshot, 1, BACKWARD), (0, 10))
+
+    def test_greedy_match_past_chunk_end(self):
+        buffer = make_buffer(b'axxbxxbx')
+        searcher = make_searcher(r'a.{0,9}b')
+        self.assertEqual(searcher.find(buffer.snapshot, 0, FORWARD), (0, 7))
+        buffer = make_buffer(b'xaxxaxxb')
+        searcher = make_searcher(r'a.{0,9}b')
+        self.assertEqual(
+            searcher.find(buffer.snapshot, buffer.size, BACKWARD), (4, 8))
+        self.assertEqual(searcher.find(buffer.snapshot, 4, BACKWARD), (1, 8))
+
+    def test_lookbehind_across_chunks(self):
+        buffer = make_buffer(b'abcdefgh')
+        searcher = make_searcher(r'(?<=ab)c', chunk_size=1)
+        self.assertEqual(searcher.find(buffer.snapshot, 2, FORWARD), (2, 3))
+        searcher = make_searcher(r'\bfoo', chunk_size=2)
+        buffer = make_buffer(b'xfoo foo')
+        self.assertEqual(searcher.find(buffer.snapshot, 1, FORWARD), (5, 8))
+
+    def test_backward_match_starts_before_offset(self):
+        buffer = make_buffer(b'abcabc')
+        searcher = make_searcher('abc', chunk_size=2)
+        self.assertEqual(searcher.find(buffer.snapshot, 5, BACKWARD), (3, 6))
+        self.assertEqual(searcher.find(buffer.snapshot, 3, BACKWARD), (0, 3))
+        buffer = make_buffer(b'xaaay')
+        searcher = make_searcher('a+', chunk_size=2)
+        self.assertEqual(searcher.find(buffer.snapshot, 4, BACKWARD), (3, 4))
+        buffer = make_buffer(b'ab\nab')
+        searcher = make_searcher('ab$', chunk_size=2)
+        self.assertEqual(searcher.find(buffer.snapshot, 2, BACKWARD), None)
+
+    def test_anchored_patterns(self):
+        buffer = make_buffer(b'abxa')
+        searcher = make_searcher(r'^a', chunk_size=1)
+        self.assertEqual(searcher.find(buffer.snapshot, 0, FORWARD), (0, 1))
+        self.assertEqual(searcher.find(buffer.snapshot, 1, FORWARD), None)
+        self.assertEqual(list(searcher.iter_matches(buffer.snapshot)), [(0, 1)])
+        searcher = make_searcher(r'x\Z', chunk_size=1)
+        self.assertEqual(searcher.find(buffer.snapshot, 4, BACKWARD), None)
+        self.assertEqual(searcher.find(buffer.snapshot, 3, BACKWARD), None)
+        self.assertEqual(
+            searcher.find(buffer.snapshot, 4, BACKWARD, workers=2), None)
+        self.assertEqual(searcher.find_reach(buffer.snapshot, 4, 4), 4)
+        searcher = make_searcher(r'a\Z', chunk_size=1)
+        self.assertEqual(searcher.find(buffer.snapshot, 4, BACKWARD), (3, 4))
+        self.assertEqual(searcher.find(buffer.snapshot, 3, BACKWARD), None)
+
+    def test_progress(self):
+        buffer = make_buffer(b'x' * 100)
+        searcher = make_searcher('y', chunk_size=10)
+        calls = []
+        self.assertEqual(
+            searcher.find(
+                buffer.snapshot, 0, FORWARD,
+                lambda done, total: calls.append((done, total))),
+            None)
+        self.assertEqual(calls, [(i, 100) for i in range(10, 100, 10)])
+
+    def test_parallel(self):
+        content = b'x' * 100 + b'a' * 30 + b'b' + b'x' * 100 + b'ab' + b'x' * 50
+        buffer = make_buffer(content)
+        searcher = make_searcher('a+b')
+        for offset, expected in [(0, (100, 131)), (120, (120, 131)),
+                                 (131, (231, 233)), (232, None)]:
+            self.assertEqual(
+                searcher.find(buffer.snapshot, offset, FORWARD, workers=3),
+                expected)
+        for offset, expected in [(buffer.size, (231, 233)), (231, (129, 131)),
+                                 (100, None)]:
+            self.assertEqual(
+                searcher.find(buffer.snapshot, offset, BACKWARD, workers=3),
+                expected)
+
+    def test_parallel_cancelling(self):
+        buffer = make_buffer(b'x' * 20000, piece_size=1000)
+        searcher = make_searcher('y+', chunk_size=1)
+        def progress(_done, _total):
+            raise KeyboardInterrupt()
+        searcher.progress_interval = 0
+        with self.assertRaises(KeyboardInterrupt):
+            searcher.find(buffer.snapshot, 0, FORWARD, progress, workers=2)
+
+    def test_iter_matches(self):
+        buffer = make_buffer(b'aaaxaa')
+        searcher = make_searcher('a+', chunk_size=2)
+        self.assertEqual(
+            list(searcher.iter_matches(buffer.snapshot)),
+            [(0, 3), (1, 3), (2, 3), (4, 6), (5, 6)])
+        self.assertEqual(
+            list(searcher.iter_matches(buffer.snapshot, 1, 4)),
+            [(1, 3), (2, 3)])
+        searcher = make_searcher('aa', chunk_size=2)
+        self.assertEqual(
+            list(searcher.iter_matches(buffer.snapshot)),
+            [(0, 2), (1, 3), (4, 6)])
+
+    def test_find_reach(self):
+        buffer = make_buffer(b'xxaxxxxaxx')
+        searcher = make_searcher('a.{0,3}b')
+        self.assertEqual(searcher.find_reach(buffer.snapshot, 10, 100), 7)
+        self.assertEqual(searcher.find_reach(buffer.snapshot, 9, 100), 7)
+        self.assertEqual(searcher.find_reach(buffer.snapshot, 6, 100), 2)
+        self.assertEqual(searcher.find_reach(buffer.snapshot, 2, 100), 2)
+        searcher = make_searcher('a.*b')
+        self.assertEqual(searcher.find_reach(buffer.snapshot, 10, 100), 2)
+        self.assertEqual(searcher.find_reach(buffer.snapshot, 10, 4), 7)
+        self.assertEqual(searcher.find_reach(buffer.snapshot, 10, 2), 10)
+
+    def test_randomized(self):
+        rand = random.Random(0)
+        patterns = [
+            b'ab', b'abab', b'x\\x61', b'a+b', b'(?<=b)a', b'ba*b', b'[ab]{3}',
+            b'a.{0,9}b', b'^a', b'\\Aab', b'a\\Z', b'b$', b'^x|b\\Z',
+            b'(?m)^a', b'(?m)a$', b'a(?!b)', b'x(?=a*\\Z)']
+        for _ in range(300):
+            content = bytes(
+                rand.choice(b'abx\n') for _ in range(rand.randint(0, 60)))
+            pattern = rand.choice(patterns)
+            buffer = make_buffer(content, rand.randint(1, 10))
+            searcher = make_searcher(
+                pattern,
+                chunk_size=rand.randint(1, 8),
+                context_size=16,
+                segment_size=rand.randint(1, 20))
+            offset = rand.randint(0, len(content))
+            workers = rand.randint(1, 3)
+            match = regex.search(pattern, content, pos=offset)
+            self.assertEqual(
+                searcher.find(buffer.snapshot, offset, FORWARD, workers=workers),
+                match.span() if match and offset < len(content) else None,
+                (pattern, content, offset))
+            matches = [
+                match.span() for match in regex.finditer(
+                    pattern, content, overlapped=True)
+                if match.start() < offset]
+            self.assertEqual(
+                searcher.find(buffer.snapshot, offset, BACKWARD, workers=workers),
+                matches[-1] if matches else None,
+                (pattern, content, offset))
+            end = rand.randint(offset, len(content) + 1)
+            self.assertEqual(
+                list(searcher.iter_matches(buffer.snapshot, offset, end)),
+                [match.span() for match in regex.finditer(
+                    pattern, content, pos=offset, overlapped=True)
+                 if match.start() < min(end, len(content))],
+                (pattern, content, offset, end))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+''' Tests the file watcher. '''
+
+import os
+import tempfile
+import unittest
+
+from hexvi.watcher import FileWatcher
+
+class TestFileWatcher(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def check_watching(self, watcher):
+        try:
+            self.assertFalse(watcher.wait(0.05))
+            with open(self.path, 'ab') as handle:
+                handle.write(b'abc')
+            self.assertTrue(watcher.wait(1))
+            self.assertFalse(watcher.wait(0.05))
+        finally:
+            watcher.close()
+
+    def test_inotify(self):
+        watcher = FileWatcher(self.path)
+        if not watcher.uses_inotify:
+            watcher.close()
+            self.skipTest('inotify is not available')
+        self.check_watching(watcher)
+
+    def test_polling(self):
+        watcher = FileWatcher(self.path, use_inotify=False)
+        self.assertFalse(watcher.uses_inotify)
+        self.check_watching(watcher)
+
+unittest.main()